@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Пакетное переписывание исторических постов через OpenAI Batch API (дешевле и не мешает realtime-потоку)
+"""
+
+import asyncio
+import json
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from ai.content_rewriter import CompletionResult, ContentRewriter, RewrittenPost, SourcePost
+from ai.prompts import SOURCE_POST_HEADER
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# Batch API тарифицируется за половину обычной цены
+BATCH_PRICE_MULTIPLIER = 0.5
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+@dataclass
+class BatchInfo:
+    """Состояние пакета на стороне API"""
+    batch_id: str
+    status: str
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+
+
+class BatchBackend(ABC):
+    """Бэкенд пакетной обработки"""
+    name = "base"
+    # Можно ли сохранять ответы в кэш переписывания (ответы заглушки - нельзя)
+    cache_results = True
+
+    @abstractmethod
+    async def submit(self, input_path: Path, metadata: Dict[str, str]) -> str:
+        """Загружает JSONL-файл запросов и создает пакет, возвращает его id"""
+
+    @abstractmethod
+    async def retrieve(self, batch_id: str) -> BatchInfo:
+        """Текущее состояние пакета"""
+
+    @abstractmethod
+    async def download(self, file_id: str) -> str:
+        """Содержимое файла результатов"""
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """OpenAI Batch API"""
+    name = "openai"
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, input_path: Path, metadata: Dict[str, str]) -> str:
+        with open(input_path, "rb") as f:
+            input_file = await self.client.files.create(file=f, purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+            metadata=metadata
+        )
+        return batch.id
+
+    async def retrieve(self, batch_id: str) -> BatchInfo:
+        batch = await self.client.batches.retrieve(batch_id)
+        return BatchInfo(
+            batch_id=batch.id,
+            status=batch.status,
+            output_file_id=batch.output_file_id,
+            error_file_id=batch.error_file_id
+        )
+
+    async def download(self, file_id: str) -> str:
+        content = await self.client.files.content(file_id)
+        return content.text
+
+
+def echo_source_responder(body: Dict[str, Any]) -> str:
+    """Ответ-заглушка: возвращает исходный пост из промпта"""
+    prompt = body["messages"][-1]["content"]
+    _, _, source = prompt.rpartition(f"{SOURCE_POST_HEADER}\n")
+    return source
+
+
+class LocalBatchBackend(BatchBackend):
+    """Файловая замена Batch API для работы без сети: тот же формат входа и выхода"""
+    name = "local"
+    cache_results = False
+
+    def __init__(self, work_dir: Path = Path("data/batches/local"),
+                 responder: Callable[[Dict[str, Any]], str] = echo_source_responder):
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.responder = responder
+
+    async def submit(self, input_path: Path, metadata: Dict[str, str]) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex[:16]}"
+        shutil.copyfile(input_path, self._path(batch_id, "input"))
+        return batch_id
+
+    async def retrieve(self, batch_id: str) -> BatchInfo:
+        input_path = self._path(batch_id, "input")
+        output_path = self._path(batch_id, "output")
+        if not input_path.exists():
+            return BatchInfo(batch_id=batch_id, status="failed")
+
+        if not output_path.exists():
+            await asyncio.to_thread(self._process, input_path, output_path)
+        return BatchInfo(batch_id=batch_id, status="completed", output_file_id=str(output_path))
+
+    async def download(self, file_id: str) -> str:
+        return Path(file_id).read_text(encoding="utf-8")
+
+    def _process(self, input_path: Path, output_path: Path):
+        lines = []
+        for line in input_path.read_text(encoding="utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            content = self.responder(request["body"])
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "model": request["body"].get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                        "usage": None
+                    }
+                },
+                "error": None
+            }, ensure_ascii=False))
+
+        tmp_path = output_path.with_suffix(".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        tmp_path.replace(output_path)
+
+    def _path(self, batch_id: str, kind: str) -> Path:
+        return self.work_dir / f"{batch_id}.{kind}.jsonl"
+
+
+def create_batch_backend(config, rewriter: ContentRewriter) -> Optional[BatchBackend]:
+    """OpenAI Batch API, локальная замена (только явно через BACKFILL_LOCAL) или None, если Batch API недоступен"""
+    if getattr(config, "BACKFILL_LOCAL", False):
+        return LocalBatchBackend()
+    client = getattr(rewriter, "openai_client", None)
+    if client is None:
+        # Заглушка вернула бы исходные посты как "переписанные" - без Batch API переписывает вызывающий
+        return None
+    return OpenAIBatchBackend(client)
+
+
+def _serialize_source_post(post: SourcePost) -> Dict[str, Any]:
+    data = {f.name: getattr(post, f.name) for f in fields(SourcePost)}
+    data["media_object"] = None
+    data["media_group"] = None
+    return data
+
+
+def _completion_from_body(body: Dict[str, Any]) -> CompletionResult:
+    choices = body.get("choices") or []
+    content = choices[0].get("message", {}).get("content") if choices else None
+    if not content:
+        raise ValueError("пустой ответ")
+
+    usage = body.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return CompletionResult(
+        text=content.strip(),
+        finish_reason=choices[0].get("finish_reason"),
+        prompt_tokens=usage.get("prompt_tokens"),
+        completion_tokens=usage.get("completion_tokens"),
+        cached_tokens=details.get("cached_tokens") or 0
+    )
+
+
+class BatchBackfill:
+    """JSONL-пакет запросов -> Batch API -> опрос -> переписанные посты"""
+
+    def __init__(self, rewriter: ContentRewriter, backend: BatchBackend,
+                 work_dir: Path = Path("data/batches"), poll_interval: float = 60.0):
+        self.rewriter = rewriter
+        self.backend = backend
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval
+
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "from_cache": 0, "batches": 0}
+
+    def build_batch_file(self, posts: List[SourcePost], path: Path) -> Dict[str, SourcePost]:
+        """Пишет JSONL с запросами chat completions, возвращает custom_id -> пост"""
+        requests = {}
+        with open(path, "w", encoding="utf-8") as f:
+            for post in posts:
+                custom_id = f"{post.channel_id}:{post.id}"
+                if custom_id in requests:
+                    continue
+                requests[custom_id] = post
+                f.write(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": self.rewriter.build_completion_request(post)
+                }, ensure_ascii=False) + "\n")
+        return requests
+
+    async def run(self, posts: List[SourcePost], on_post: Callable[[RewrittenPost], Awaitable[Any]]):
+        """Переписывает посты пакетом и передает результаты в on_post"""
+        pending = []
+        for post in posts:
+            # Уже переписанное (например, в прошлый запуск) не отправляем повторно
+            cached = self.rewriter.get_cached_completion(post) if self.backend.cache_results else None
+            if cached is None:
+                pending.append(post)
+                continue
+            self.stats["from_cache"] += 1
+            await on_post(self.rewriter.build_rewritten_post(post, cached, 0.0))
+
+        if not pending:
+            return
+
+        batch_id = await self.submit(pending)
+        await self.wait(batch_id, on_post)
+
+    async def submit(self, posts: List[SourcePost]) -> str:
+        """Отправляет пакет, сохраняет манифест для продолжения после перезапуска"""
+        input_path = self.work_dir / f"input_{uuid.uuid4().hex[:12]}.jsonl"
+        requests = self.build_batch_file(posts, input_path)
+        try:
+            batch_id = await self.backend.submit(input_path, {"source": "rewirater_backfill"})
+        finally:
+            input_path.unlink(missing_ok=True)
+
+        self._save_manifest(batch_id, {
+            "batch_id": batch_id,
+            "backend": self.backend.name,
+            "created_at": time.time(),
+            "posts": {custom_id: _serialize_source_post(post) for custom_id, post in requests.items()}
+        })
+        self.stats["submitted"] += len(requests)
+        self.stats["batches"] += 1
+        logger.info(f"Пакет {batch_id} отправлен: {len(requests)} постов ({self.backend.name})")
+        return batch_id
+
+    async def wait(self, batch_id: str, on_post: Callable[[RewrittenPost], Awaitable[Any]]) -> int:
+        """Ждет завершения пакета и обрабатывает результаты; возвращает число готовых постов"""
+        manifest = self._load_manifest(batch_id)
+        if manifest is None:
+            logger.error(f"Манифест пакета {batch_id} не найден")
+            return 0
+
+        started = time.monotonic()
+        while True:
+            info = await self.backend.retrieve(batch_id)
+            if info.status in TERMINAL_STATUSES:
+                break
+            logger.debug(f"Пакет {batch_id}: {info.status}, прошло {time.monotonic() - started:.0f}с")
+            await asyncio.sleep(self.poll_interval)
+
+        if info.status != "completed":
+            logger.warning(f"Пакет {batch_id} завершился со статусом {info.status}")
+
+        posts = {custom_id: SourcePost(**data) for custom_id, data in manifest["posts"].items()}
+        done = 0
+        # У просроченного пакета часть результатов все равно доступна
+        if info.output_file_id:
+            output = await self.backend.download(info.output_file_id)
+            done = await self._handle_output(output, posts, on_post)
+
+        failed = len(posts) - done
+        if failed:
+            self.stats["failed"] += failed
+            logger.warning(f"Пакет {batch_id}: {failed} постов без результата")
+
+        self._manifest_path(batch_id).unlink(missing_ok=True)
+        logger.info(f"Пакет {batch_id} обработан: {done} из {len(posts)} постов")
+        return done
+
+    async def resume(self, on_post: Callable[[RewrittenPost], Awaitable[Any]]):
+        """Дожидается пакетов, отправленных до перезапуска"""
+        for path in sorted(self.work_dir.glob("batch_*.json")):
+            try:
+                manifest = json.loads(path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.error(f"Не удалось прочитать манифест пакета {path.name}: {e}")
+                continue
+            if manifest.get("backend") != self.backend.name:
+                continue
+            logger.info(f"Продолжаем ожидание пакета {manifest['batch_id']}")
+            await self.wait(manifest["batch_id"], on_post)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика пакетной обработки"""
+        return {**self.stats, "backend": self.backend.name}
+
+    async def _handle_output(self, output: str, posts: Dict[str, SourcePost],
+                             on_post: Callable[[RewrittenPost], Awaitable[Any]]) -> int:
+        done = 0
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+                post = posts.get(result.get("custom_id"))
+                if post is None:
+                    continue
+
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    logger.warning(f"Пост {post.id} не переписан в пакете: {result.get('error') or response.get('status_code')}")
+                    continue
+
+                completion = _completion_from_body(response.get("body") or {})
+            except Exception as e:
+                logger.error(f"Ошибка разбора результата пакета: {e}")
+                continue
+
+            if completion.finish_reason == "length":
+                # Повторять в пакете нечем: обрезаем до последнего предложения и не кэшируем
+                completion = self.rewriter.trim_truncated(post, completion)
+            if self.backend.cache_results and not completion.truncated:
+                self.rewriter.cache_completion(post, completion.text)
+            rewritten_post = self.rewriter.build_rewritten_post(
+                post, completion, 0.0, price_multiplier=BATCH_PRICE_MULTIPLIER
+            )
+            done += 1
+            self.stats["completed"] += 1
+            await on_post(rewritten_post)
+        return done
+
+    def _manifest_path(self, batch_id: str) -> Path:
+        name = batch_id if batch_id.startswith("batch_") else f"batch_{batch_id}"
+        return self.work_dir / f"{name}.json"
+
+    def _save_manifest(self, batch_id: str, manifest: Dict[str, Any]):
+        path = self._manifest_path(batch_id)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, default=str), encoding="utf-8")
+        tmp_path.replace(path)
+
+    def _load_manifest(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        path = self._manifest_path(batch_id)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
@@ -6,8 +6,9 @@
 """
 
 import asyncio
+import re
 from typing import Dict, List, Optional, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 
 try:
     import openai
@@ -17,6 +18,37 @@ except ImportError:
  
 
 from loguru import logger
+from ai.rewrite_cache import RewriteCache, make_cache_key
+from ai.request_policy import AttemptMetrics, EmptyCompletionError, RetryPolicy, call_with_retry
+from ai.streaming import StreamingRewriteAssembler
+from ai.prompts import PromptTemplate, PromptUsageStats, extract_usage
+from ai.token_budget import TokenEstimator, adaptive_max_tokens, estimate_cost, get_model_prices
+from ai.providers import LLMProvider, ProviderRouter
+from ai import text_engine
+from utils.metrics import REGISTRY
+
+REWRITES = REGISTRY.counter(
+    "rewirater_rewrites_total", "Переписанные посты по провайдеру и результату", ["provider", "result"]
+)
+AI_TOKENS = REGISTRY.counter(
+    "rewirater_ai_tokens_total", "Токены AI: prompt, cached (часть prompt), completion", ["provider", "kind"]
+)
+AI_COST = REGISTRY.counter(
+    "rewirater_ai_cost_usd_total", "Стоимость запросов к AI, USD", ["provider"]
+)
+REWRITES_TRUNCATED = REGISTRY.counter(
+    "rewirater_rewrites_truncated_total", "Ответы AI, оборванные лимитом max_tokens", ["outcome"]
+)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class RewriteAbandoned(RuntimeError):
+    """Воркер, переписывавший тот же пост, отменен; ожидающие повторяют запрос сами"""
+
 
 @dataclass
 class SourcePost:
@@ -34,6 +66,8 @@ class SourcePost:
     media_url: Optional[str] = None  # URL медиа файла
     source_type: str = "telegram"  # telegram
     original_url: Optional[str] = None  # Оригинальная ссылка на пост
+    media_group: Optional[List[Any]] = None  # Медиа всех сообщений альбома (grouped_id)
+    album_message_ids: Optional[List[int]] = None  # ID сообщений альбома в канале-источнике
 
 @dataclass
 class RewrittenPost:
@@ -48,6 +82,38 @@ class RewrittenPost:
     media_type: Optional[str] = None  # Копируем медиа из исходного поста
     media_object: Optional[Any] = None
     media_url: Optional[str] = None
+    time_to_first_token: Optional[float] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cost_usd: Optional[float] = None
+    media_group: Optional[List[Any]] = None  # Альбом отправляется одним send_file
+    media_files: Optional[List[str]] = None  # Локальные копии медиа, скачанные во время переписывания
+
+@dataclass
+class CompletionResult:
+    """Ответ AI до постобработки"""
+    text: str
+    time_to_first_token: Optional[float] = None
+    from_cache: bool = False
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    provider: Optional[str] = None
+    model: Optional[str] = None
+    finish_reason: Optional[str] = None
+    # Ответ оборван лимитом токенов и обрезан до последнего предложения - в кэш не попадает
+    truncated: bool = False
+
+# Лимиты Telegram: подпись к медиа и обычное сообщение
+TELEGRAM_CAPTION_LIMIT = 1024
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Выражения резервного переписывания компилируются один раз
+_PAREN_LINK_RE = re.compile(r'\([^)]*https?://[^)]*\)')
+_PROJECT_NAME_RE = re.compile(r'\b[A-Z][a-zA-Z]+\b')
+_NEWLINES_RE = re.compile(r'\n+')
+
 
 class ContentRewriter:
     """Переписывание контента под стиль целевого канала"""
@@ -57,6 +123,17 @@ class ContentRewriter:
         self.default_model = "gpt-4o-mini"
         logger.info(f"✅ Используется модель по умолчанию: {self.default_model}")
         self.model_name = getattr(self.config, "AI_MODEL", self.default_model)
+        self.temperature = getattr(self.config, "AI_TEMPERATURE", 0.7)
+        
+        # Повторы, хеджирование и метрики отдельных попыток запросов
+        self.retry_policy = RetryPolicy.from_config(self.config)
+        self.attempt_metrics = AttemptMetrics()
+        
+        # Потоковый режим: построчная очистка и ранняя остановка генерации
+        self.streaming_enabled = getattr(self.config, "AI_STREAMING", False)
+        self.ttft_metrics = AttemptMetrics()
+        self.model_prices = getattr(self.config, "AI_MODEL_PRICES", None)
+        self.router: Optional[ProviderRouter] = None
         self.setup_ai_clients()
         
         # Стиль переписывания (будет настраиваться позже)
@@ -70,7 +147,33 @@ class ContentRewriter:
             "personal_touch": True
         }
         
-        
+        # Промпт собирается один раз: неизменный префикс позволяет API кэшировать его между запросами
+        self.prompt_template = PromptTemplate(
+            "rewrite",
+            system=self._get_system_prompt(),
+            instructions=self._get_rewriting_instructions()
+        )
+        self.prompt_version = self.prompt_template.version
+        self.usage_stats = PromptUsageStats()
+        
+        # Бюджет токенов: лимит ответа зависит от длины исходника, слишком длинные исходники обрезаются
+        self.token_estimator = TokenEstimator(self.model_name)
+        self.max_source_tokens = getattr(self.config, "AI_MAX_SOURCE_TOKENS", 3000)
+        self.min_output_tokens = getattr(self.config, "AI_MIN_TOKENS", 200)
+        self.max_output_tokens = getattr(self.config, "AI_MAX_TOKENS", 800)
+        self.output_token_ratio = getattr(self.config, "AI_OUTPUT_TOKEN_RATIO", 1.3)
+        # Лимит повторного запроса, если ответ оборвался на max_tokens
+        self.truncated_retry_tokens = getattr(self.config, "AI_TRUNCATED_RETRY_TOKENS", 2 * self.max_output_tokens)
+        
+        # Кэш результатов: одинаковые посты из разных каналов переписываем один раз
+        self.rewrite_cache = None
+        self._pending_rewrites: Dict[str, asyncio.Future] = {}
+        if getattr(self.config, "REWRITE_CACHE_ENABLED", True):
+            self.rewrite_cache = RewriteCache(
+                ttl_seconds=getattr(self.config, "REWRITE_CACHE_TTL_SECONDS", 7 * 86400),
+                max_memory_entries=getattr(self.config, "REWRITE_CACHE_MEMORY_SIZE", 1000),
+                max_disk_entries=getattr(self.config, "REWRITE_CACHE_DISK_SIZE", 50000)
+            )
     
     def setup_ai_clients(self):
         """Настройка AI клиентов (только OpenAI)."""
@@ -78,19 +181,99 @@ class ContentRewriter:
             logger.error("❌ Библиотека openai не установлена. Установите: pip install openai")
             return
         
-        if not self.config.AI_API_KEY:
+        providers_config = getattr(self.config, "AI_PROVIDERS", None)
+        if not self.config.AI_API_KEY and not providers_config:
             logger.error("❌ AI_API_KEY не указан в config.py")
             return
         
-        try:
-            openai.api_key = self.config.AI_API_KEY
-            self.model_name = getattr(self.config, "AI_MODEL", self.default_model)
-            self.openai_client = openai.AsyncOpenAI(api_key=self.config.AI_API_KEY)
-            logger.info(f"✅ OpenAI клиент для переписывания настроен (модель: {self.model_name})")
-            logger.debug(f"API ключ: {self.config.AI_API_KEY[:10]}...{self.config.AI_API_KEY[-10:]}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка создания OpenAI клиента: {e}")
-            self.openai_client = None
+        if self.config.AI_API_KEY:
+            try:
+                openai.api_key = self.config.AI_API_KEY
+                self.model_name = getattr(self.config, "AI_MODEL", self.default_model)
+                self.openai_client = openai.AsyncOpenAI(**self._get_client_options())
+                logger.info(f"✅ OpenAI клиент для переписывания настроен (модель: {self.model_name})")
+                logger.debug(f"API ключ: {self.config.AI_API_KEY[:10]}...{self.config.AI_API_KEY[-10:]}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка создания OpenAI клиента: {e}")
+                self.openai_client = None
+        
+        self.router = self._build_router(providers_config)
+    
+    def _build_router(self, providers_config: Optional[List[Dict[str, Any]]]) -> Optional[ProviderRouter]:
+        """Провайдеры из AI_PROVIDERS (OpenAI-совместимые эндпоинты) или один OpenAI по умолчанию"""
+        failure_threshold = getattr(self.config, "AI_CIRCUIT_FAILURE_THRESHOLD", 3)
+        reset_timeout = getattr(self.config, "AI_CIRCUIT_RESET_SECONDS", 30.0)
+        error_window = getattr(self.config, "AI_ROUTER_ERROR_WINDOW_SECONDS", 300.0)
+        providers = []
+        
+        if providers_config:
+            for entry in providers_config:
+                model = entry.get("model", self.model_name)
+                name = entry.get("name") or entry.get("base_url") or model
+                try:
+                    client = openai.AsyncOpenAI(**self._get_client_options(
+                        api_key=entry.get("api_key") or self.config.AI_API_KEY or "not-needed",
+                        base_url=entry.get("base_url"),
+                        timeout=entry.get("timeout")
+                    ))
+                except Exception as e:
+                    logger.error(f"❌ Ошибка создания клиента провайдера {name}: {e}")
+                    continue
+                
+                # Локальные модели бесплатны, для известных моделей OpenAI берем прайс
+                prices = get_model_prices(model, self.model_prices) or (0.0, 0.0, 0.0)
+                providers.append(LLMProvider(
+                    name,
+                    client,
+                    model,
+                    input_price=entry.get("input_price", prices[0]),
+                    cached_input_price=entry.get("cached_input_price", prices[1]),
+                    output_price=entry.get("output_price", prices[2]),
+                    failure_threshold=failure_threshold,
+                    reset_timeout=reset_timeout,
+                    error_window_seconds=error_window
+                ))
+                logger.info(f"✅ AI провайдер {name} настроен (модель: {model})")
+        elif getattr(self, "openai_client", None) is not None:
+            prices = get_model_prices(self.model_name, self.model_prices) or (0.0, 0.0, 0.0)
+            providers.append(LLMProvider(
+                self.config.AI_PROVIDER,
+                self.openai_client,
+                self.model_name,
+                *prices,
+                failure_threshold=failure_threshold,
+                reset_timeout=reset_timeout,
+                error_window_seconds=error_window
+            ))
+        
+        if not providers:
+            return None
+        return ProviderRouter(
+            providers,
+            error_penalty=getattr(self.config, "AI_ROUTER_ERROR_PENALTY", 4.0),
+            cost_weight=getattr(self.config, "AI_ROUTER_COST_WEIGHT", 0.0)
+        )
+    
+    def _get_client_options(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                            timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Параметры клиента: пул соединений, таймауты; повторы делаем сами"""
+        timeout = timeout or getattr(self.config, "AI_REQUEST_TIMEOUT", 60.0)
+        pool_size = getattr(self.config, "AI_CONNECTION_POOL_SIZE", 20)
+        options = {
+            "api_key": api_key or self.config.AI_API_KEY,
+            "timeout": timeout,
+            "max_retries": 0
+        }
+        if base_url:
+            options["base_url"] = base_url
+        
+        if httpx is not None:
+            options["http_client"] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(timeout, connect=min(10.0, timeout))
+            )
+        
+        return options
     
     async def rewrite_post(self, source_post: SourcePost) -> RewrittenPost:
         """Переписывает пост под стиль целевого канала"""
@@ -98,77 +281,353 @@ class ContentRewriter:
         start_time = time.time()
         
         try:
-            rewritten_text = await self._rewrite_with_openai(source_post)
-            
-            # Очищаем и форматируем текст
-            cleaned_text = self._clean_and_format_text(rewritten_text)
-            
-            # Убираем хештеги и подпись, если нейросеть их добавила
-            cleaned_text = self._remove_hashtags_from_text(cleaned_text)
-            
-            # Форматируем финальный пост
-            final_text = self._format_simple_post(cleaned_text, [])
-            
+            completion = await self._rewrite_cached(source_post)
             processing_time = time.time() - start_time
             
             logger.info(f"Пост переписан за {processing_time:.2f}с")
             
-            return RewrittenPost(
-                original_post=source_post,
-                rewritten_text=final_text,
-                hashtags=[],
-                style=self.rewriting_style["tone"],
-                provider=self.config.AI_PROVIDER,
-                model=getattr(self.config, "AI_MODEL", self.default_model),
-                media_type=source_post.media_type,
-                media_object=source_post.media_object,
-                media_url=source_post.media_url,
-                processing_time=processing_time
-            )
+            rewritten_post = self.build_rewritten_post(source_post, completion, processing_time)
+            REWRITES.labels(rewritten_post.provider, "cached" if completion.from_cache else "ok").inc()
+            return rewritten_post
             
         except Exception as e:
             logger.error(f"Ошибка переписывания поста: {e}")
             logger.error(f"Тип ошибки: {type(e).__name__}")
             logger.error(f"Детали: {str(e)}")
             logger.warning("Используется fallback режим (шаблонный пост). Проверьте логи выше для диагностики.")
+            REWRITES.labels("fallback", "fallback").inc()
             return self._create_fallback_post(source_post)
     
-    async def _rewrite_with_openai(self, source_post: SourcePost) -> str:
-        """Переписывание через OpenAI"""
+    def build_rewritten_post(self, source_post: SourcePost, completion: CompletionResult,
+                             processing_time: float, price_multiplier: float = 1.0) -> RewrittenPost:
+        """Постобработка ответа AI и сборка RewrittenPost"""
+        # Один проход: эмодзи, ссылки в скобках, **жирный**, экранирование HTML, хештеги и подпись от нейросети
+        cleaned_text = text_engine.normalize_post_text(completion.text).text
+        
+        # Форматируем финальный пост
+        final_text = self._format_simple_post(cleaned_text, [])
+        
+        model = completion.model or getattr(self.config, "AI_MODEL", self.default_model)
+        provider = self._get_provider(completion.provider)
+        cost_usd = None
+        if not completion.from_cache:
+            cost_usd = estimate_cost(
+                model,
+                completion.prompt_tokens or 0,
+                completion.completion_tokens or 0,
+                completion.cached_tokens or 0,
+                {provider.model: provider.prices} if provider else self.model_prices
+            )
+            if cost_usd is not None:
+                cost_usd = round(cost_usd * price_multiplier, 8)
+            self._record_token_metrics(completion.provider or self.config.AI_PROVIDER, completion, cost_usd)
+        
+        return RewrittenPost(
+            original_post=source_post,
+            rewritten_text=final_text,
+            hashtags=[],
+            style=self.rewriting_style["tone"],
+            provider=completion.provider or self.config.AI_PROVIDER,
+            model=model,
+            media_type=source_post.media_type,
+            media_object=source_post.media_object,
+            media_group=source_post.media_group,
+            media_url=source_post.media_url,
+            processing_time=processing_time,
+            time_to_first_token=completion.time_to_first_token,
+            prompt_tokens=0 if completion.from_cache else completion.prompt_tokens or 0,
+            completion_tokens=0 if completion.from_cache else completion.completion_tokens or 0,
+            cached_tokens=0 if completion.from_cache else completion.cached_tokens or 0,
+            cost_usd=cost_usd
+        )
+    
+    @staticmethod
+    def _record_token_metrics(provider: str, completion: CompletionResult, cost_usd: Optional[float]):
+        AI_TOKENS.labels(provider, "prompt").inc(completion.prompt_tokens or 0)
+        AI_TOKENS.labels(provider, "cached").inc(completion.cached_tokens or 0)
+        AI_TOKENS.labels(provider, "completion").inc(completion.completion_tokens or 0)
+        if cost_usd:
+            AI_COST.labels(provider).inc(cost_usd)
+    
+    def build_completion_request(self, source_post: SourcePost) -> Dict[str, Any]:
+        """Параметры запроса chat completions для поста"""
+        source_text = self._fit_source_text(source_post)
+        return {
+            "model": getattr(self.config, "AI_MODEL", self.default_model),
+            "messages": self.prompt_template.build_messages(source_text),
+            "max_tokens": adaptive_max_tokens(
+                self.token_estimator.count(source_text),
+                ratio=self.output_token_ratio,
+                minimum=self.min_output_tokens,
+                maximum=self.max_output_tokens
+            ),
+            "temperature": self.temperature
+        }
+    
+    def get_cached_completion(self, source_post: SourcePost) -> Optional[CompletionResult]:
+        """Готовый ответ из кэша переписывания"""
+        if self.rewrite_cache is None:
+            return None
+        cached_text = self.rewrite_cache.get(self._get_cache_key(source_post))
+        if cached_text is None:
+            return None
+        return CompletionResult(text=cached_text, from_cache=True)
+    
+    def cache_completion(self, source_post: SourcePost, text: str):
+        """Сохраняет ответ AI, полученный в обход rewrite_post (например, из пакетной обработки)"""
+        if self.rewrite_cache is not None:
+            self.rewrite_cache.put(self._get_cache_key(source_post), text)
+    
+    def _get_cache_key(self, source_post: SourcePost) -> str:
+        return make_cache_key(
+            source_post.text,
+            getattr(self.config, "AI_MODEL", self.default_model),
+            self.prompt_version,
+            self.temperature
+        )
+    
+    async def _rewrite_cached(self, source_post: SourcePost) -> CompletionResult:
+        """Переписывание с проверкой кэша результатов"""
+        if self.rewrite_cache is None:
+            return await self._rewrite_with_openai(source_post)
+        
+        cache_key = self._get_cache_key(source_post)
+        cached = self.get_cached_completion(source_post)
+        if cached is not None:
+            logger.info(f"Пост {source_post.id} найден в кэше переписывания, запрос к AI не нужен")
+            return cached
+        
+        # Если такой же пост уже переписывается другим воркером, ждем его результат
+        pending = self._pending_rewrites.get(cache_key)
+        while pending is not None:
+            logger.info(f"Пост {source_post.id} уже переписывается, ждем результат")
+            try:
+                completion = await asyncio.shield(pending)
+            except RewriteAbandoned:
+                # Владелец отменен, не дописав: переписываем сами или ждем нового владельца
+                pending = self._pending_rewrites.get(cache_key)
+                continue
+            # Запрос оплачен первым воркером, здесь он бесплатный
+            return replace(completion, from_cache=True)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._pending_rewrites[cache_key] = future
+        try:
+            completion = await self._rewrite_with_openai(source_post)
+            if not completion.truncated:
+                self.rewrite_cache.put(cache_key, completion.text)
+            future.set_result(completion)
+            return completion
+        except asyncio.CancelledError:
+            # CancelledError у ожидающих вышел бы за пределы их воркеров и остановил бы их
+            future.set_exception(RewriteAbandoned(f"Переписывание поста {source_post.id} отменено"))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже пробрасывается вызывающему, ожидающие могут его не забрать
+            future.exception()
+            raise
+        finally:
+            self._pending_rewrites.pop(cache_key, None)
+    
+    def get_request_stats(self) -> Dict:
+        """Метрики попыток запросов к AI API"""
+        stats = self.attempt_metrics.get_stats()
+        if self.streaming_enabled:
+            ttft = self.ttft_metrics.get_stats()
+            stats["time_to_first_token_p50"] = ttft["latency_p50"]
+            stats["time_to_first_token_p95"] = ttft["latency_p95"]
+            stats["stream_stops"] = ttft["outcomes"]
+        stats["prompt_version"] = self.prompt_version
+        stats["tokens"] = self.usage_stats.get_stats()
+        if self.router is not None:
+            stats["routing"] = self.router.get_stats()
+        return stats
+    
+    def get_cache_stats(self) -> Dict:
+        """Статистика кэша переписывания"""
+        if self.rewrite_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.rewrite_cache.get_stats()}
+    
+    async def _rewrite_with_openai(self, source_post: SourcePost) -> CompletionResult:
+        """Переписывание через OpenAI-совместимых провайдеров"""
         # Проверяем наличие клиента
-        if not hasattr(self, 'openai_client') or self.openai_client is None:
+        if self.router is None:
             raise Exception("OpenAI клиент не инициализирован. Проверьте API ключ и настройки.")
         
-        prompt = self._build_rewriting_prompt(source_post)
+        request = self.build_completion_request(source_post)
+        messages = request["messages"]
+        max_tokens = request["max_tokens"]
         
-        try:
-            response = await self.openai_client.chat.completions.create(
-                model=getattr(self.config, "AI_MODEL", self.default_model),
-                messages=[
-                    {"role": "system", "content": self._get_system_prompt()},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=800,
-                temperature=0.7
-            )
+        async def request_completion(max_tokens: int) -> CompletionResult:
+            async def attempt(provider: LLMProvider) -> CompletionResult:
+                if self.streaming_enabled:
+                    return await self._stream_completion(provider, source_post, messages, max_tokens)
+                return await self._complete(provider, messages, max_tokens)
             
-            if not response.choices or not response.choices[0].message.content:
-                raise Exception("OpenAI вернул пустой ответ")
+            async def routed() -> CompletionResult:
+                # Роутер сам переключается между провайдерами; повторы с задержкой - если отказали все
+                completion, provider = await self.router.call(attempt)
+                completion.provider = provider.name
+                completion.model = provider.model
+                return completion
             
-            return response.choices[0].message.content.strip()
+            completion = await call_with_retry(routed, self.retry_policy, self.attempt_metrics)
+            self._record_usage(source_post, completion, messages)
+            return completion
+        
+        try:
+            completion = await request_completion(max_tokens)
+            if completion.finish_reason == "length" and self.truncated_retry_tokens > max_tokens:
+                # Ответ оборван на середине: один повтор с большим лимитом, оба запроса оплачены
+                logger.warning(f"Пост {source_post.id}: ответ оборван на {max_tokens} токенах, повтор с {self.truncated_retry_tokens}")
+                REWRITES_TRUNCATED.labels("retried").inc()
+                first = completion
+                completion = await request_completion(self.truncated_retry_tokens)
+                completion.prompt_tokens += first.prompt_tokens
+                completion.completion_tokens += first.completion_tokens
+                completion.cached_tokens = (completion.cached_tokens or 0) + (first.cached_tokens or 0)
+            if completion.finish_reason == "length":
+                completion = self.trim_truncated(source_post, completion)
+            return completion
         except Exception as e:
             logger.error(f"Ошибка вызова OpenAI API: {e}")
             raise  # Пробрасываем дальше, чтобы было видно в логах
     
+    @staticmethod
+    def trim_truncated(source_post: SourcePost, completion: CompletionResult) -> CompletionResult:
+        """Оборванный ответ обрезается до последнего законченного предложения и не кэшируется"""
+        logger.warning(f"Пост {source_post.id}: ответ AI оборван лимитом токенов, обрезан до последнего предложения")
+        REWRITES_TRUNCATED.labels("trimmed").inc()
+        return replace(completion, text=text_engine.trim_to_last_sentence(completion.text), truncated=True)
+    
+    async def _complete(self, provider: LLMProvider, messages: List[Dict[str, str]], max_tokens: int) -> CompletionResult:
+        """Обычный (не потоковый) запрос к провайдеру"""
+        response = await provider.client.chat.completions.create(
+            model=provider.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=self.temperature
+        )
+        
+        if not response.choices or not response.choices[0].message.content:
+            raise EmptyCompletionError("OpenAI вернул пустой ответ")
+        
+        return CompletionResult(
+            text=response.choices[0].message.content.strip(),
+            finish_reason=getattr(response.choices[0], "finish_reason", None),
+            **extract_usage(getattr(response, "usage", None))
+        )
+    
+    def _get_provider(self, name: Optional[str]) -> Optional[LLMProvider]:
+        if self.router is None or name is None:
+            return None
+        for provider in self.router.providers:
+            if provider.name == name:
+                return provider
+        return None
+    
+    
+    
+    async def _stream_completion(self, provider: LLMProvider, source_post: SourcePost,
+                                 messages: List[Dict[str, str]], max_tokens: int) -> CompletionResult:
+        """Потоковый запрос: чистим текст по мере генерации и обрываем поток, когда хвост не нужен"""
+        import time
+        started = time.monotonic()
+        time_to_first_token = None
+        
+        assembler = StreamingRewriteAssembler(
+            max_chars=self._get_length_budget(source_post),
+            line_cleaner=self._remove_emojis_from_text
+        )
+        
+        stream = await provider.client.chat.completions.create(
+            model=provider.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        
+        usage = None
+        finish_reason = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    # Последний чанк потока: только usage, без choices
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = time.monotonic() - started
+                if assembler.feed(delta):
+                    break
+        finally:
+            # Закрываем соединение, чтобы не оплачивать ненужный хвост генерации
+            close = getattr(stream, "close", None)
+            if close is not None:
+                await close()
+        
+        text = assembler.finish()
+        if not text:
+            raise EmptyCompletionError("OpenAI вернул пустой ответ")
+        
+        self.ttft_metrics.record(time_to_first_token or 0.0, assembler.stop_reason or "complete")
+        logger.info(
+            f"Пост {source_post.id}: первый токен через {time_to_first_token or 0:.2f}с, "
+            f"генерация {time.monotonic() - started:.2f}с (остановка: {assembler.stop_reason or 'конец ответа'})"
+        )
+        # Поток, оборванный сборщиком, не дошел до finish_reason модели
+        return CompletionResult(text=text, time_to_first_token=time_to_first_token,
+                                finish_reason=finish_reason, **extract_usage(usage))
+    
+    def _fit_source_text(self, source_post: SourcePost) -> str:
+        """Текст исходника в пределах бюджета токенов"""
+        text = source_post.text
+        if self.token_estimator.count(text) <= self.max_source_tokens:
+            return text
+        
+        truncated = self.token_estimator.truncate(text, self.max_source_tokens)
+        logger.warning(
+            f"Пост {source_post.id} слишком длинный: обрезан до {self.max_source_tokens} токенов "
+            f"({len(text)} -> {len(truncated)} символов)"
+        )
+        return truncated
+    
+    def _record_usage(self, source_post: SourcePost, completion: CompletionResult, messages: List[Dict[str, str]]):
+        """Учет токенов запроса и попаданий в кэш промптов API"""
+        self.usage_stats.record(completion.prompt_tokens, completion.completion_tokens, completion.cached_tokens)
+        if completion.prompt_tokens is None:
+            # usage нет (поток оборван раньше) - считаем сами, чтобы не терять расход
+            completion.prompt_tokens = self.token_estimator.count_messages(messages)
+            completion.completion_tokens = self.token_estimator.count(completion.text)
+            completion.cached_tokens = 0
+        else:
+            logger.debug(
+                f"Пост {source_post.id}: токены промпта {completion.prompt_tokens} "
+                f"(из кэша {completion.cached_tokens}), ответа {completion.completion_tokens}"
+            )
     
+    def _get_length_budget(self, source_post: SourcePost) -> int:
+        """Максимальная длина текста без подписи: подпись к медиа короче обычного сообщения"""
+        limit = TELEGRAM_CAPTION_LIMIT if source_post.media_type else TELEGRAM_MESSAGE_LIMIT
+        return limit - len(self._format_simple_post("", []))
     
     def _build_rewriting_prompt(self, source_post: SourcePost) -> str:
         """Создание промпта для переписывания"""
-        prompt = f"""
-ТЫ ДОЛЖЕН ПОЛНОСТЬЮ ПЕРЕПИСАТЬ этот пост в стиле автора @marxstud. НЕ КОПИРУЙ исходный текст!
-
-ИСХОДНЫЙ ПОСТ:
-{source_post.text}
+        return self.prompt_template.build_user_prompt(source_post.text)
+    
+    def _get_rewriting_instructions(self) -> str:
+        """Инструкции для переписывания (без текста поста - он добавляется в конец)"""
+        prompt = """
+ТЫ ДОЛЖЕН ПОЛНОСТЬЮ ПЕРЕПИСАТЬ пост ниже в стиле автора @marxstud. НЕ КОПИРУЙ исходный текст!
 
 ЗАДАЧА: Полностью переписать этот пост в стиле @marxstud, сохранив КОНКРЕТНЫЕ детали из оригинала!
 
@@ -249,72 +708,11 @@ class ContentRewriter:
     
     def _clean_and_format_text(self, text: str) -> str:
         """Очистка и форматирование текста"""
-        import re
-        
-        # Сначала удаляем все эмодзи
-        text = self._remove_emojis_from_text(text)
-        
-        # Убираем ** из текста и заменяем на жирный формат
-        text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-        
-        # Убираем лишние пробелы и переносы
-        text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
-        text = text.strip()
-        
-        # Обрабатываем ссылки - извлекаем их и вставляем в похожие слова
-        # Это упрощенная версия, в реальности нужно более сложная логика
-        text = self._process_links(text)
-        
-        return text
+        return text_engine.normalize_post_text(text).text
     
     def _remove_emojis_from_text(self, text: str) -> str:
         """Удаляет все эмодзи из текста"""
-        import re
-        
-        # Паттерн для удаления эмодзи (Unicode диапазоны)
-        emoji_pattern = re.compile(
-            "["
-            "\U0001F600-\U0001F64F"  # эмоции
-            "\U0001F300-\U0001F5FF"  # символы и пиктограммы
-            "\U0001F680-\U0001F6FF"  # транспорт
-            "\U0001F1E0-\U0001F1FF"  # флаги
-            "\U00002702-\U000027B0"  # символы
-            "\U000024C2-\U0001F251"  # дополнительные символы
-            "\U0001F900-\U0001F9FF"  # дополнительные символы и пиктограммы
-            "\U0001FA70-\U0001FAFF"  # символы и пиктограммы расширенные
-            "\U00002600-\U000026FF"  # различные символы
-            "\U00002700-\U000027BF"  # Dingbats
-            "]+", 
-            flags=re.UNICODE
-        )
-        
-        return emoji_pattern.sub('', text)
-    
-    def _remove_hashtags_from_text(self, text: str) -> str:
-        """Удаляет хештеги, эмодзи из текста, если нейросеть их добавила"""
-        import re
-        
-        # Сначала удаляем эмодзи
-        text = self._remove_emojis_from_text(text)
-        
-        # Удаляем строки, которые содержат только хештеги
-        lines = text.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            # Если строка содержит только хештеги (начинается с #) или подпись @marxstud, пропускаем её
-            if line and (all(word.startswith('#') for word in line.split()) or line.startswith('@marxstud')):
-                continue
-            cleaned_lines.append(line)
-        
-        # Объединяем обратно
-        result = '\n'.join(cleaned_lines)
-        
-        # Убираем лишние переносы строк
-        result = re.sub(r'\n\s*\n\s*\n', '\n\n', result)
-        
-        return result.strip()
+        return text_engine.remove_emojis(text)
     
     def _format_simple_post(self, text: str, hashtags: List[str]) -> str:
         """Простое форматирование поста без эмодзи"""
@@ -324,48 +722,12 @@ class ContentRewriter:
     
     
     def _process_links(self, text: str) -> str:
-        """Обработка ссылок в тексте"""
-        import re
-        
-        # Находим ссылки в скобках
-        link_pattern = r'\(([^)]*https?://[^)]*)\)'
-        links = re.findall(link_pattern, text)
-        
-        # Убираем ссылки в скобках из текста
-        text = re.sub(link_pattern, '', text)
-        
-        # Пока просто убираем ссылки, позже можно добавить более сложную логику
-        # для вставки их в похожие по смыслу слова
-        
-        return text
+        """Обработка ссылок в тексте: ссылки в скобках убираются"""
+        return _PAREN_LINK_RE.sub('', text)
 
     def extract_links(self, text: str) -> List[str]:
         """Извлекает все ссылки из текста, включая встроенные в слова (markdown) и обычные URL."""
-        import re
-        urls: List[str] = []
-        
-        # Markdown-ссылки вида [текст](https://example.com/path)
-        markdown_links = re.findall(r'\[[^\]]+\]\((https?://[^)\s]+)\)', text)
-        urls.extend(markdown_links)
-        
-        # Обычные http/https URL
-        bare_urls = re.findall(r'(https?://[^\s)]+)', text)
-        urls.extend(bare_urls)
-        
-        # Ссылки, попавшие внутрь скобок, извлекаем изнутри, если они не найдены ранее
-        in_parens = re.findall(r'\(([^)]*https?://[^)]*)\)', text)
-        for chunk in in_parens:
-            for m in re.findall(r'(https?://[^\s)]+)', chunk):
-                urls.append(m)
-        
-        # Удаляем дубли, сохраняя порядок
-        seen = set()
-        unique_urls: List[str] = []
-        for u in urls:
-            if u not in seen:
-                seen.add(u)
-                unique_urls.append(u)
-        return unique_urls
+        return text_engine.extract_links(text)
     
     def _get_system_prompt(self) -> str:
         """Системный промпт для AI"""
@@ -432,7 +794,6 @@ class ContentRewriter:
     
     def _rewrite_fallback(self, source_post: SourcePost) -> str:
         """Резервное переписывание без AI в стиле автора"""
-        import re
         text = source_post.text
         
         # Удаляем эмодзи из исходного текста
@@ -440,20 +801,16 @@ class ContentRewriter:
         
         # Извлекаем ключевые слова и конкретику из оригинала
         # Ищем названия проектов (слова с заглавной буквы)
-        projects = re.findall(r'\b[A-Z][a-zA-Z]+\b', text)
-        # Ищем цифры
-        numbers = re.findall(r'\d+[.,]\d+|\d+', text)
-        # Ищем даты
-        dates = re.findall(r'\d+\s*(?:ноября|декабря|января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября)|(?:ноября|декабря|января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября)\s*\d+', text, re.IGNORECASE)
+        project = _PROJECT_NAME_RE.search(text)
         
         # Создаем заголовок на основе конкретных слов из текста
         text_words = text.split()
         # Берем первые значимые слова (пропускаем служебные)
         significant_words = [w for w in text_words[:10] if len(w) > 3 and not w.lower() in ['это', 'что', 'для', 'как', 'или', 'был', 'был', 'есть']]
         
-        if projects:
+        if project:
             # Используем название проекта для заголовка
-            header = f"<b>{projects[0]}</b>"
+            header = f"<b>{project.group()}</b>"
         elif significant_words:
             # Используем ключевые слова из текста
             header_keyword = significant_words[0].capitalize()
@@ -463,7 +820,7 @@ class ContentRewriter:
         
         # Сохраняем оригинальный текст с минимальной обработкой (только форматирование)
         # Это лучше, чем генерировать шаблоны
-        cleaned_text = re.sub(r'\n+', '\n\n', text.strip())
+        cleaned_text = _NEWLINES_RE.sub('\n\n', text.strip())
         
         # Если текст слишком длинный, обрезаем
         if len(cleaned_text) > 500:
@@ -480,8 +837,7 @@ class ContentRewriter:
         text = text.replace("**", "")
         
         # Убираем ссылки в скобках
-        import re
-        text = re.sub(r'\([^)]*https?://[^)]*\)', '', text)
+        text = self._process_links(text)
         
         # Переписываем в стиле автора (2-3 предложения)
         if "bitcoin" in text.lower() or "крипт" in text.lower():
@@ -509,6 +865,7 @@ class ContentRewriter:
             model=getattr(self.config, "AI_MODEL", self.default_model),
             media_type=source_post.media_type,
             media_object=source_post.media_object,
+            media_group=source_post.media_group,
             media_url=source_post.media_url,
             processing_time=0.0
         )
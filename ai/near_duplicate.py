@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Поиск почти-дубликатов постов (MinHash по шинглам, LSH по полосам) до отправки в AI
+"""
+
+import hashlib
+import random
+import re
+import time
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Порог по сходству Жаккара множеств словесных 3-шинглов, подобран на Posts.txt
+# (benchmarks/calibrate_near_duplicate.py): пост с добавленным или удаленным предложением
+# сохраняет сходство >= 0.47, у разных постов максимум около 0.02
+DEFAULT_THRESHOLD = 0.4
+
+NUM_PERM = 128
+BAND_ROWS = 3
+
+# Простое число Мерсенна 2^31 - 1 для универсального хэширования (a*x + b) mod p:
+# произведение a*x помещается в uint64, поэтому numpy считает все перестановки разом
+_PRIME = (1 << 31) - 1
+
+_URL_RE = re.compile(r'https?://\S+|t\.me/\S+|www\.\S+', re.IGNORECASE)
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+@dataclass
+class NearDuplicateMatch:
+    """Найденный почти-дубликат"""
+    key: str
+    similarity: float
+    age_seconds: float
+
+
+def tokenize_for_similarity(text: str) -> List[str]:
+    """Слова текста без ссылок, эмодзи и пунктуации"""
+    text = _URL_RE.sub(" ", (text or "").lower())
+    return _WORD_RE.findall(text)
+
+
+def shingles(tokens: List[str], shingle_size: int = 3) -> Set[str]:
+    """Множество словесных шинглов"""
+    if len(tokens) < shingle_size:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+
+
+_permutation_cache: Dict[int, Tuple[List[int], List[int]]] = {}
+
+
+def _permutations(num_perm: int, seed: int = 1) -> Tuple[List[int], List[int]]:
+    """Коэффициенты (a, b) хэш-функций; одинаковы между запусками"""
+    cached = _permutation_cache.get(num_perm)
+    if cached is None:
+        rng = random.Random(seed)
+        pairs = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+        cached = ([a for a, _ in pairs], [b for _, b in pairs])
+        if np is not None:
+            cached = (np.array(cached[0], dtype=np.uint64), np.array(cached[1], dtype=np.uint64))
+        _permutation_cache[num_perm] = cached
+    return cached
+
+
+def minhash(tokens: List[str], num_perm: int = NUM_PERM) -> Optional[array]:
+    """Подпись MinHash множества шинглов: доля совпавших позиций оценивает сходство Жаккара"""
+    if not tokens:
+        return None
+
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") % _PRIME
+        for shingle in shingles(tokens)
+    ]
+    a, b = _permutations(num_perm)
+    if np is not None:
+        # Матрица перестановки x шингл за одну операцию вместо num_perm циклов в Python
+        values = (np.outer(a, np.array(hashes, dtype=np.uint64)) + b[:, None]) % _PRIME
+        return array("I", values.min(axis=1).astype(np.uint32).tobytes())
+    return array("I", (min((a_i * h + b_i) % _PRIME for h in hashes) for a_i, b_i in zip(a, b)))
+
+
+def estimate_similarity(a: array, b: array) -> float:
+    """Оценка сходства Жаккара по двум подписям MinHash"""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class NearDuplicateIndex:
+    """Индекс недавних постов со скользящим окном для поиска почти-дубликатов"""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, window_seconds: float = 24 * 3600,
+                 max_entries: int = 50000, min_tokens: int = 5, num_perm: int = NUM_PERM,
+                 band_rows: int = BAND_ROWS):
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.max_entries = max(1, int(max_entries))
+        self.min_tokens = min_tokens
+        self.num_perm = num_perm
+
+        # Кандидаты - посты, у которых совпала хотя бы одна полоса из band_rows значений подписи.
+        # При 42 полосах по 3 строки пара с J=0.47 становится кандидатом с вероятностью 0.99,
+        # пара с J=0.02 - с вероятностью 0.0003
+        self.band_rows = max(1, int(band_rows))
+        self._bands = num_perm // self.band_rows
+
+        self._buckets: Dict[Tuple[int, bytes], Set[int]] = {}
+        self._entries: Dict[int, Tuple[str, array, float]] = {}
+        self._keys: Dict[str, int] = {}
+        self._order: Deque[int] = deque()
+        self._next_id = 0
+
+        self.stats = {"checked": 0, "duplicates": 0, "skipped_short": 0}
+
+    def check(self, text: str, now: Optional[float] = None) -> Optional[NearDuplicateMatch]:
+        """Ищет почти-дубликат среди постов индекса, не добавляя текст"""
+        now = time.time() if now is None else now
+        self._evict(now)
+
+        signature = self._signature(text)
+        if signature is None:
+            return None
+
+        self.stats["checked"] += 1
+        match = self._find(signature, now)
+        if match:
+            self.stats["duplicates"] += 1
+        return match
+
+    def add(self, key: str, text: str, now: Optional[float] = None):
+        """Добавляет опубликованный (поставленный в очередь) пост в индекс"""
+        now = time.time() if now is None else now
+        signature = self._signature(text, count_skipped=False)
+        if signature is not None and key not in self._keys:
+            self._add(key, signature, now)
+
+    def check_and_add(self, key: str, text: str, now: Optional[float] = None) -> Optional[NearDuplicateMatch]:
+        """Ищет почти-дубликат; если его нет, добавляет пост в индекс"""
+        match = self.check(text, now)
+        if match is None:
+            self.add(key, text, now)
+        return match
+
+    def discard(self, key: str):
+        """Убирает пост из индекса (публикация отменена)"""
+        entry_id = self._keys.get(key)
+        if entry_id is not None:
+            self._remove(entry_id)
+
+    def _signature(self, text: str, count_skipped: bool = True) -> Optional[array]:
+        tokens = tokenize_for_similarity(text)
+        if len(tokens) < self.min_tokens:
+            # На коротких текстах несколько общих слов дают слишком много ложных совпадений
+            if count_skipped:
+                self.stats["skipped_short"] += 1
+            return None
+        return minhash(tokens, self.num_perm)
+
+    def _find(self, signature: array, now: float) -> Optional[NearDuplicateMatch]:
+        best: Optional[NearDuplicateMatch] = None
+        seen: Set[int] = set()
+
+        for band in self._band_values(signature):
+            for entry_id in self._buckets.get(band, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+
+                key, other, added_at = self._entries[entry_id]
+                similarity = estimate_similarity(signature, other)
+                if similarity < self.threshold:
+                    continue
+
+                if best is None or similarity > best.similarity:
+                    best = NearDuplicateMatch(key=key, similarity=similarity, age_seconds=now - added_at)
+
+        return best
+
+    def _add(self, key: str, signature: array, now: float):
+        entry_id = self._next_id
+        self._next_id += 1
+
+        self._entries[entry_id] = (key, signature, now)
+        self._keys[key] = entry_id
+        self._order.append(entry_id)
+        for band in self._band_values(signature):
+            self._buckets.setdefault(band, set()).add(entry_id)
+
+        while len(self._entries) > self.max_entries:
+            self._drop_oldest()
+
+    def _evict(self, now: float):
+        """Удаляет посты, вышедшие из временного окна"""
+        cutoff = now - self.window_seconds
+        while self._order:
+            entry = self._entries.get(self._order[0])
+            if entry is not None and entry[2] >= cutoff:
+                break
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        entry_id = self._order.popleft()
+        # Пост мог быть уже убран через discard
+        if entry_id in self._entries:
+            self._remove(entry_id)
+
+    def _remove(self, entry_id: int):
+        key, signature, _ = self._entries.pop(entry_id)
+        self._keys.pop(key, None)
+        for band in self._band_values(signature):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _band_values(self, signature: array) -> List[Tuple[int, bytes]]:
+        rows = self.band_rows
+        return [
+            (band_index, signature[band_index * rows:(band_index + 1) * rows].tobytes())
+            for band_index in range(self._bands)
+        ]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        """Статистика индекса"""
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "threshold": self.threshold,
+            "num_perm": self.num_perm
+        }
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сборка промптов: неизменный префикс в начале, текст поста в конце (для кэширования промптов на стороне API)
+"""
+
+import hashlib
+from typing import Any, Dict, List, Optional
+
+# Заголовок, после которого идет исходный пост - всегда последняя часть запроса
+SOURCE_POST_HEADER = "ИСХОДНЫЙ ПОСТ:"
+
+
+class PromptTemplate:
+    """Шаблон промпта, собранный один раз; префикс запроса байт-в-байт одинаков для всех постов"""
+
+    def __init__(self, name: str, system: str, instructions: str, source_header: str = SOURCE_POST_HEADER):
+        self.name = name
+        self.system = system.strip()
+        self.prefix = f"{instructions.strip()}\n\n{source_header}\n"
+        self.version = hashlib.sha256(
+            "\0".join((name, self.system, self.prefix)).encode("utf-8")
+        ).hexdigest()[:12]
+
+    def build_user_prompt(self, source_text: str) -> str:
+        """Пользовательская часть: статические инструкции, затем пост"""
+        return self.prefix + (source_text or "").strip()
+
+    def build_messages(self, source_text: str) -> List[Dict[str, str]]:
+        """Сообщения для chat completions"""
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.build_user_prompt(source_text)}
+        ]
+
+
+def extract_usage(usage: Any) -> Dict[str, Optional[int]]:
+    """Токены из поля usage ответа API (в том числе закэшированные токены промпта)"""
+    if usage is None:
+        return {"prompt_tokens": None, "completion_tokens": None, "cached_tokens": None}
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "cached_tokens": cached_tokens or 0
+    }
+
+
+class PromptUsageStats:
+    """Суммарный расход токенов и доля промпта, взятая из кэша API"""
+
+    def __init__(self):
+        self.requests = 0
+        self.requests_without_usage = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, prompt_tokens: Optional[int], completion_tokens: Optional[int], cached_tokens: Optional[int]):
+        self.requests += 1
+        if prompt_tokens is None:
+            # Поток оборван до финального чанка с usage
+            self.requests_without_usage += 1
+            return
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        measured = self.requests - self.requests_without_usage
+        return {
+            "requests": self.requests,
+            "requests_without_usage": self.requests_without_usage,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "avg_prompt_tokens": round(self.prompt_tokens / measured, 1) if measured else None,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None
+        }
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Несколько OpenAI-совместимых провайдеров: выбор по латентности, ошибкам и цене, circuit breaker, failover
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from ai.request_policy import AttemptMetrics, get_retry_after, get_status_code, is_request_error
+from utils.metrics import REGISTRY
+
+AI_REQUEST_SECONDS = REGISTRY.histogram(
+    "rewirater_ai_request_seconds", "Длительность запросов к AI провайдерам", ["provider", "outcome"]
+)
+
+
+class CircuitBreaker:
+    """Размыкается после серии ошибок, через reset_timeout пропускает один пробный запрос"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self._trial_in_flight = False
+
+    def available(self) -> bool:
+        """Примет ли запрос (без захвата пробного запроса)"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.opened_until
+        return not self._trial_in_flight
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в полуоткрытом состоянии захватывает пробный запрос"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, cooldown: Optional[float] = None):
+        """Ошибка запроса; cooldown - сколько провайдер просил подождать (Retry-After)"""
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold or cooldown:
+            self.state = self.OPEN
+            self.opened_until = time.monotonic() + max(self.reset_timeout, cooldown or 0.0)
+
+    def force_trial(self):
+        """Досрочно переводит в полуоткрытое состояние"""
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+
+    def release(self):
+        """Пробный запрос отменен, не дождавшись результата"""
+        self._trial_in_flight = False
+
+    def reopens_in(self) -> float:
+        """Через сколько секунд будет пробный запрос"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_until - time.monotonic())
+
+
+class LLMProvider:
+    """OpenAI-совместимый эндпоинт (OpenAI, vLLM, llama.cpp и т.п.) со своей статистикой"""
+
+    def __init__(self, name: str, client, model: str, input_price: float = 0.0,
+                 cached_input_price: Optional[float] = None, output_price: float = 0.0,
+                 failure_threshold: int = 3, reset_timeout: float = 30.0, window: int = 100,
+                 error_window_seconds: float = 300.0):
+        self.name = name
+        self.client = client
+        self.model = model
+        # Цены за 1M токенов в USD: (вход, вход из кэша, выход)
+        self.prices = (input_price, input_price if cached_input_price is None else cached_input_price, output_price)
+
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        # Латентность только успешных запросов: быстрые отказы не должны делать провайдера "быстрым"
+        self.metrics = AttemptMetrics(window)
+        self.errors: Dict[str, int] = {}
+        # (время, успех) за последние error_window_seconds: старые ошибки забываются
+        self._outcomes: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self.error_window_seconds = error_window_seconds
+        self.in_flight = 0
+
+    @property
+    def error_rate(self) -> float:
+        cutoff = time.monotonic() - self.error_window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+        if not self._outcomes:
+            return 0.0
+        return 1.0 - sum(ok for _, ok in self._outcomes) / len(self._outcomes)
+
+    @property
+    def blended_price(self) -> float:
+        """Средняя цена за 1M токенов (вход и выход поровну)"""
+        return (self.prices[0] + self.prices[2]) / 2
+
+    def expected_latency(self) -> float:
+        """Ожидаемая латентность: между p50 и p95; без замеров - 0, чтобы провайдер попробовали"""
+        p50 = self.metrics.percentile(0.5)
+        p95 = self.metrics.percentile(0.95)
+        if p50 is None:
+            return 0.0
+        return p50 + 0.5 * (p95 - p50)
+
+    def record(self, latency: float, error: Optional[Exception] = None):
+        if error is None:
+            AI_REQUEST_SECONDS.labels(self.name, "ok").observe(latency)
+            self.metrics.record(latency, "ok")
+            self._outcomes.append((time.monotonic(), True))
+            self.breaker.record_success()
+            return
+
+        status = self._count_error(latency, error)
+        self._outcomes.append((time.monotonic(), False))
+        cooldown = get_retry_after(error) if status == 429 else None
+        self.breaker.record_failure(cooldown)
+
+    def record_rejected(self, latency: float, error: Exception):
+        """Ошибка самого запроса (400, 422, пустой ответ): провайдер исправен, breaker не трогаем"""
+        self._count_error(latency, error)
+        self.breaker.release()
+
+    def _count_error(self, latency: float, error: Exception) -> Optional[int]:
+        status = get_status_code(error)
+        key = f"error_{status or type(error).__name__}"
+        AI_REQUEST_SECONDS.labels(self.name, key).observe(latency)
+        self.errors[key] = self.errors.get(key, 0) + 1
+        return status
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = self.metrics.get_stats()
+        return {
+            "model": self.model,
+            "state": self.breaker.state,
+            "reopens_in": round(self.breaker.reopens_in(), 1),
+            "error_rate": round(self.error_rate, 3),
+            "latency_p50": stats["latency_p50"],
+            "latency_p95": stats["latency_p95"],
+            "successes": stats["attempts"],
+            "errors": dict(self.errors),
+            "in_flight": self.in_flight,
+            "prices": self.prices
+        }
+
+
+class ProviderRouter:
+    """Выбирает провайдера по оценке и переключается на следующий при ошибке"""
+
+    def __init__(self, providers: List[LLMProvider], error_penalty: float = 4.0, cost_weight: float = 0.0):
+        if not providers:
+            raise ValueError("Нужен хотя бы один провайдер")
+        self.providers = providers
+        # Штраф за долю ошибок: множитель к латентности и столько же секунд сверху
+        self.error_penalty = error_penalty
+        # Секунд ожидаемой латентности за 1 USD цены за 1M токенов
+        self.cost_weight = cost_weight
+        self.failovers = 0
+
+    def score(self, provider: LLMProvider) -> float:
+        """Оценка провайдера (меньше - лучше)"""
+        error_rate = provider.error_rate
+        return (
+            provider.expected_latency() * (1.0 + self.error_penalty * error_rate)
+            + self.error_penalty * error_rate
+            + self.cost_weight * provider.blended_price
+        )
+
+    def candidates(self) -> List[LLMProvider]:
+        """Доступные провайдеры в порядке предпочтения"""
+        ordered = sorted(
+            enumerate(self.providers),
+            key=lambda item: (self.score(item[1]), item[0])
+        )
+        return [provider for _, provider in ordered if provider.breaker.available()]
+
+    async def call(self, request: Callable[[LLMProvider], Awaitable[Any]]) -> Tuple[Any, LLMProvider]:
+        """Выполняет запрос у лучшего провайдера, при ошибке провайдера - у следующего"""
+        candidates = self.candidates()
+        if not candidates:
+            # Все разомкнуты: пробуем тот, что откроется раньше, вместо отказа
+            candidates = [min(self.providers, key=lambda provider: provider.breaker.reopens_in())]
+            candidates[0].breaker.force_trial()
+
+        last_error: Optional[Exception] = None
+        attempted = 0
+        for provider in candidates:
+            # Пробный запрос полуоткрытого провайдера мог забрать параллельный вызов
+            if not provider.breaker.allow():
+                continue
+            if attempted:
+                self.failovers += 1
+                logger.warning(f"Переключаемся на провайдера {provider.name}: {last_error}")
+            attempted += 1
+
+            started = time.monotonic()
+            provider.in_flight += 1
+            try:
+                result = await request(provider)
+            except asyncio.CancelledError:
+                provider.breaker.release()
+                raise
+            except Exception as e:
+                if is_request_error(e):
+                    # Тот же запрос у другого провайдера упадет так же: отдаем ошибку сразу;
+                    # 401/403/404 и сбои провайдера уходят в его breaker и переключают на следующего
+                    provider.record_rejected(time.monotonic() - started, e)
+                    raise
+                provider.record(time.monotonic() - started, e)
+                last_error = e
+                continue
+            finally:
+                provider.in_flight -= 1
+
+            provider.record(time.monotonic() - started)
+            return result, provider
+
+        if last_error is None:
+            raise ConnectionError("Нет доступных AI провайдеров")
+        raise last_error
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние провайдеров"""
+        return {
+            "failovers": self.failovers,
+            "providers": {provider.name: provider.get_stats() for provider in self.providers}
+        }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Повторы запросов к AI API: экспоненциальная задержка с джиттером, Retry-After, хеджирование
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from loguru import logger
+
+# HTTP-статусы, при которых имеет смысл повторить запрос
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# Ошибки самого запроса: у любого провайдера он завершится так же
+REQUEST_ERROR_STATUS_CODES = {400, 413, 422}
+REQUEST_ERROR_CODES = {"context_length_exceeded", "string_above_max_length"}
+
+
+class EmptyCompletionError(Exception):
+    """AI вернул пустой ответ"""
+
+
+@dataclass
+class RetryPolicy:
+    """Параметры повторов и хеджирования"""
+    max_attempts: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    # Через сколько секунд без ответа отправлять дублирующий запрос (None - не хеджировать)
+    hedge_after: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, config) -> "RetryPolicy":
+        return cls(
+            max_attempts=getattr(config, "AI_MAX_ATTEMPTS", 4),
+            base_delay=getattr(config, "AI_RETRY_BASE_DELAY", 1.0),
+            max_delay=getattr(config, "AI_RETRY_MAX_DELAY", 30.0),
+            hedge_after=getattr(config, "AI_HEDGE_AFTER_SECONDS", None)
+        )
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """HTTP-статус ошибки API, если он есть"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def is_retryable(error: Exception) -> bool:
+    """Временная ли ошибка (лимиты, 5xx, таймауты, обрывы соединения)"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+
+    status = get_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+
+    # Ошибки соединения и таймауты SDK не имеют статуса
+    name = type(error).__name__
+    return name in ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout")
+
+
+def is_request_error(error: Exception) -> bool:
+    """Ошибка запроса (400/422, превышение контекста, пустой ответ), а не конкретного провайдера"""
+    if isinstance(error, EmptyCompletionError):
+        return True
+    if getattr(error, "code", None) in REQUEST_ERROR_CODES:
+        return True
+    return get_status_code(error) in REQUEST_ERROR_STATUS_CODES
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Значение Retry-After (секунды или HTTP-дата) из ответа API"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff_delay(attempt: int, policy: RetryPolicy, retry_after: Optional[float] = None) -> float:
+    """Задержка перед повтором: full jitter, но не меньше Retry-After"""
+    delay = random.uniform(0, min(policy.max_delay, policy.base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, policy.max_delay * 4))
+    return delay
+
+
+class AttemptMetrics:
+    """Латентность и исходы отдельных попыток запросов"""
+
+    def __init__(self, window: int = 500):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.outcomes: Dict[str, int] = {}
+
+    def record(self, latency: float, outcome: str):
+        self.latencies.append(latency)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        values = sorted(self.latencies)
+        index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+        return values[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        p99 = self.percentile(0.99)
+        return {
+            "attempts": sum(self.outcomes.values()),
+            "outcomes": dict(self.outcomes),
+            "latency_p50": round(p50, 3) if p50 is not None else None,
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "latency_p99": round(p99, 3) if p99 is not None else None
+        }
+
+
+async def _timed(call: Callable[[], Awaitable[Any]], metrics: Optional[AttemptMetrics], label: str):
+    started = time.monotonic()
+    try:
+        result = await call()
+    except asyncio.CancelledError:
+        if metrics is not None:
+            metrics.record(time.monotonic() - started, f"{label}_cancelled")
+        raise
+    except Exception as e:
+        latency = time.monotonic() - started
+        if metrics is not None:
+            metrics.record(latency, f"{label}_error_{get_status_code(e) or type(e).__name__}")
+        logger.debug(f"Попытка запроса ({label}) завершилась ошибкой за {latency:.2f}с: {e}")
+        raise
+    latency = time.monotonic() - started
+    if metrics is not None:
+        metrics.record(latency, f"{label}_ok")
+    logger.debug(f"Попытка запроса ({label}) выполнена за {latency:.2f}с")
+    return result
+
+
+async def hedged_call(call: Callable[[], Awaitable[Any]], hedge_after: Optional[float],
+                      metrics: Optional[AttemptMetrics] = None) -> Any:
+    """Запрос с хеджированием: если ответа нет за hedge_after секунд, отправляем второй"""
+    if not hedge_after:
+        return await _timed(call, metrics, "primary")
+
+    primary = asyncio.ensure_future(_timed(call, metrics, "primary"))
+    pending = {primary}
+    last_error: Optional[BaseException] = None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        logger.debug(f"Нет ответа за {hedge_after}с, отправляем дублирующий запрос")
+        pending.add(asyncio.ensure_future(_timed(call, metrics, "hedge")))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    raise last_error
+
+
+async def call_with_retry(call: Callable[[], Awaitable[Any]], policy: RetryPolicy,
+                          metrics: Optional[AttemptMetrics] = None) -> Any:
+    """Выполняет запрос с повторами временных ошибок"""
+    for attempt in range(policy.max_attempts):
+        try:
+            return await hedged_call(call, policy.hedge_after, metrics)
+        except Exception as e:
+            if attempt + 1 >= policy.max_attempts or not is_retryable(e):
+                raise
+
+            delay = backoff_delay(attempt, policy, get_retry_after(e))
+            logger.warning(
+                f"Временная ошибка AI API ({get_status_code(e) or type(e).__name__}), "
+                f"попытка {attempt + 1}/{policy.max_attempts}, повтор через {delay:.1f}с"
+            )
+            await asyncio.sleep(delay)
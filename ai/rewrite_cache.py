@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэш результатов переписывания по нормализованному тексту исходного поста
+"""
+
+import hashlib
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_source_text(text: str) -> str:
+    """Нормализация текста для ключа кэша: регистр, Unicode-формы, пробелы"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return _WHITESPACE_RE.sub(" ", text).strip().lower()
+
+
+def make_cache_key(text: str, model: str, prompt_version: str, temperature: float) -> str:
+    """Ключ кэша: хэш нормализованного текста и параметров генерации"""
+    payload = "\x1f".join([
+        normalize_source_text(text),
+        model or "",
+        prompt_version or "",
+        f"{temperature:.3f}"
+    ])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RewriteCache:
+    """Двухуровневый кэш переписанных текстов: LRU в памяти + SQLite на диске"""
+
+    def __init__(self, db_path: Optional[Path] = Path("data/rewrite_cache.db"),
+                 ttl_seconds: float = 7 * 86400, max_memory_entries: int = 1000,
+                 max_disk_entries: int = 50000):
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max(1, int(max_memory_entries))
+        self.max_disk_entries = max(1, int(max_disk_entries))
+
+        # key -> (текст, время создания)
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._puts_since_prune = 0
+
+        self.stats = {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0}
+
+        self._conn = None
+        if db_path is not None:
+            try:
+                db_path = Path(db_path)
+                db_path.parent.mkdir(exist_ok=True)
+                self._conn = sqlite3.connect(str(db_path), isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rewrite_cache ("
+                    "key TEXT PRIMARY KEY, "
+                    "text TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, "
+                    "accessed_at REAL NOT NULL)"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_rewrite_cache_accessed ON rewrite_cache (accessed_at)"
+                )
+                self.prune()
+            except Exception as e:
+                logger.error(f"Не удалось открыть дисковый кэш переписывания {db_path}: {e}")
+                self._conn = None
+
+    def get(self, key: str) -> Optional[str]:
+        """Возвращает закэшированный текст или None"""
+        now = time.time()
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            text, created_at = entry
+            if now - created_at < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return text
+            del self._memory[key]
+
+        if self._conn is not None:
+            try:
+                row = self._conn.execute(
+                    "SELECT text, created_at FROM rewrite_cache WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE rewrite_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                    )
+                    self._remember(key, row[0], row[1])
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+            except Exception as e:
+                logger.warning(f"Ошибка чтения дискового кэша переписывания: {e}")
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, text: str):
+        """Сохраняет текст в кэш"""
+        now = time.time()
+        self._remember(key, text, now)
+
+        if self._conn is None:
+            return
+
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rewrite_cache (key, text, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, text, now, now)
+            )
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= 100:
+                self.prune()
+        except Exception as e:
+            logger.warning(f"Ошибка записи в дисковый кэш переписывания: {e}")
+
+    def prune(self):
+        """Удаляет просроченные записи и ограничивает размер дискового кэша"""
+        self._puts_since_prune = 0
+        if self._conn is None:
+            return
+
+        self._conn.execute(
+            "DELETE FROM rewrite_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+        )
+        # Вытесняем самые давно использованные записи сверх лимита
+        self._conn.execute(
+            "DELETE FROM rewrite_cache WHERE key IN ("
+            "SELECT key FROM rewrite_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+
+    def close(self):
+        """Закрытие дискового кэша"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _remember(self, key: str, text: str, created_at: float):
+        self._memory[key] = (text, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        """Счетчики попаданий и промахов"""
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            "memory_entries": len(self._memory)
+        }
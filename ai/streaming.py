@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сборка потокового ответа AI: построчная очистка и ранняя остановка
+"""
+
+from typing import Callable, List, Optional
+
+# Подпись добавляется автоматически, все после нее будет удалено
+SIGNATURE_MARKERS = ("@marxstud",)
+
+
+def is_hashtag_line(line: str) -> bool:
+    """Строка состоит только из хештегов"""
+    words = line.split()
+    return bool(words) and all(word.startswith('#') for word in words)
+
+
+class StreamingRewriteAssembler:
+    """Принимает чанки ответа, очищает готовые строки и решает, когда прекратить чтение"""
+
+    def __init__(self, max_chars: Optional[int] = None,
+                 line_cleaner: Optional[Callable[[str], str]] = None,
+                 min_paragraphs_before_hashtags: int = 2):
+        self.max_chars = max_chars
+        self.line_cleaner = line_cleaner
+        self.min_paragraphs_before_hashtags = min_paragraphs_before_hashtags
+
+        self._lines: List[str] = []
+        self._partial = ""
+        self._length = 0
+        self.stop_reason: Optional[str] = None
+
+    @property
+    def stopped(self) -> bool:
+        return self.stop_reason is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Добавляет чанк; возвращает True, если дальше читать не нужно"""
+        if self.stopped or not chunk:
+            return self.stopped
+
+        self._partial += chunk
+        while "\n" in self._partial and not self.stopped:
+            line, self._partial = self._partial.split("\n", 1)
+            self._add_line(line)
+
+        return self.stopped
+
+    def finish(self) -> str:
+        """Завершает сборку и возвращает текст"""
+        if not self.stopped and self._partial:
+            self._add_line(self._partial)
+        self._partial = ""
+        return "\n".join(self._lines).strip()
+
+    def _add_line(self, line: str):
+        stripped = line.strip()
+
+        if stripped.startswith(SIGNATURE_MARKERS):
+            # Подпись модели: дальше только то, что все равно вырежется
+            self.stop_reason = "signature"
+            return
+
+        if is_hashtag_line(stripped):
+            # Блок хештегов после основного текста - это хвост поста
+            if self._paragraphs() >= self.min_paragraphs_before_hashtags:
+                self.stop_reason = "hashtags"
+            return
+
+        if self.line_cleaner is not None:
+            line = self.line_cleaner(line)
+
+        if self.max_chars is not None and self._length + len(line) + 1 > self.max_chars:
+            # Превышение бюджета: обрезаем по последнему целому абзацу
+            self._trim_to_paragraph()
+            self.stop_reason = "length"
+            return
+
+        self._lines.append(line)
+        self._length += len(line) + 1
+
+    def _paragraphs(self) -> int:
+        count = 0
+        in_paragraph = False
+        for line in self._lines:
+            if line.strip():
+                if not in_paragraph:
+                    count += 1
+                in_paragraph = True
+            else:
+                in_paragraph = False
+        return count
+
+    def _trim_to_paragraph(self):
+        for index in range(len(self._lines) - 1, -1, -1):
+            if not self._lines[index].strip():
+                del self._lines[index:]
+                return
+        # Абзац один: оставляем как есть
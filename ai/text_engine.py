@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нормализация текста постов за один проход: ссылки, хештеги, эмодзи, жирный текст и HTML-экранирование
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+# Диапазоны эмодзи (те же, что использовались при очистке постов раньше)
+EMOJI_CLASS = (
+    "["
+    "\U0001F600-\U0001F64F"  # эмоции
+    "\U0001F300-\U0001F5FF"  # символы и пиктограммы
+    "\U0001F680-\U0001F6FF"  # транспорт
+    "\U0001F1E0-\U0001F1FF"  # флаги
+    "\U00002702-\U000027B0"  # символы
+    "\U000024C2-\U0001F251"  # дополнительные символы
+    "\U0001F900-\U0001F9FF"  # дополнительные символы и пиктограммы
+    "\U0001FA70-\U0001FAFF"  # символы и пиктограммы расширенные
+    "\U00002600-\U000026FF"  # различные символы
+    "\U00002700-\U000027BF"  # Dingbats
+    "]"
+)
+
+EMOJI_RE = re.compile(EMOJI_CLASS + "+")
+URL_RE = re.compile(r'https?://[^\s)]+')
+MARKDOWN_LINK_RE = re.compile(r'\[[^\]]+\]\((https?://[^)\s]+)\)')
+# Конец предложения: знак препинания, возможно с закрывающими кавычками или скобками
+_SENTENCE_END_RE = re.compile(r'[.!?…]+["»)\]]*(?=\s|$)')
+
+# Все токены в одном выражении. Первая ветка за один шаг забирает обычный текст - символы,
+# с которых не может начаться ни один токен; остальные ветки пробуются только на "особых" символах.
+_TOKEN_RE = re.compile(
+    r'(?P<text>[^\[(h*#<>&' + EMOJI_CLASS[1:-1] + r']+)'
+    r'|(?P<md_link>\[(?P<md_label>[^\]]+)\]\((?P<md_url>https?://[^)\s]+)\))'
+    r'|(?P<paren_link>\((?P<paren_body>[^)]*https?://[^)]*)\))'
+    r'|(?P<url>https?://[^\s)]+)'
+    # Жирный - в пределах одной строки: незакрытый ** не захватывает следующие абзацы
+    r'|(?P<bold>\*\*(?P<bold_body>[^\n]*?)\*\*)'
+    r'|(?P<hashtag>(?<![\w#])#\w+)'
+    r'|(?P<emoji>' + EMOJI_CLASS + r'+)'
+    r'|(?P<html>[<>&])'
+    r'|(?P<other>.)',
+    re.DOTALL  # нужен только ветке other, чтобы она забирала переводы строк
+)
+
+_HTML_ESCAPES = {"<": "&lt;", ">": "&gt;", "&": "&amp;"}
+_HTML_ESCAPE_RE = re.compile(r'[<>&]')
+
+# Подпись добавляется при форматировании поста, строки с ней из ответа AI удаляются
+SIGNATURE = "@marxstud"
+
+
+@dataclass
+class NormalizedText:
+    """Результат нормализации"""
+    text: str
+    links: List[str] = field(default_factory=list)
+    hashtags: List[str] = field(default_factory=list)
+    emojis: int = 0
+
+
+def _unique(items: List[str]) -> List[str]:
+    return list(dict.fromkeys(items))
+
+
+class _Scan:
+    """Состояние одного прохода по тексту"""
+
+    __slots__ = ("escape_html", "markdown_links", "links", "hashtags", "emojis")
+
+    def __init__(self, escape_html: bool):
+        self.escape_html = escape_html
+        self.markdown_links: List[str] = []
+        self.links: List[str] = []
+        self.hashtags: List[str] = []
+        self.emojis = 0
+
+    def run(self, text: str) -> str:
+        parts = []
+        for match in _TOKEN_RE.finditer(text):
+            kind = match.lastgroup
+            if kind == "text" or kind == "other":
+                parts.append(match.group())
+            elif kind == "emoji":
+                self.emojis += 1
+            elif kind == "url":
+                url = match.group("url")
+                self.links.append(url)
+                parts.append(self._escape(url))
+            elif kind == "md_link":
+                url = match.group("md_url")
+                self.markdown_links.append(url)
+                self.links.append(url)
+                # Ссылка в скобках удаляется, подпись остается
+                parts.append("[" + self.run(match.group("md_label")) + "]")
+            elif kind == "paren_link":
+                self.links.extend(URL_RE.findall(match.group("paren_body")))
+            elif kind == "bold":
+                parts.append("<b>" + self.run(match.group("bold_body")) + "</b>")
+            elif kind == "hashtag":
+                self.hashtags.append(match.group("hashtag"))
+                parts.append(match.group("hashtag"))
+            else:
+                parts.append(self._escape(match.group("html")))
+        return "".join(parts)
+
+    def _escape(self, text: str) -> str:
+        if not self.escape_html:
+            return text
+        return _HTML_ESCAPE_RE.sub(lambda match: _HTML_ESCAPES[match.group()], text)
+
+
+def is_service_line(line: str) -> bool:
+    """Строка только из хештегов или с подписью - ее добавляем сами"""
+    return bool(line) and (all(word.startswith('#') for word in line.split()) or line.startswith(SIGNATURE))
+
+
+def normalize_post_text(text: str, escape_html: bool = True) -> NormalizedText:
+    """Ответ AI -> текст поста: без эмодзи, ссылок в скобках, служебных строк; **жирный** -> <b>"""
+    scan = _Scan(escape_html)
+    body = scan.run(text or "")
+
+    # Строки без крайних пробелов, не больше одной пустой строки подряд
+    lines: List[str] = []
+    for line in body.split("\n"):
+        line = line.strip()
+        if is_service_line(line):
+            continue
+        if not line and (not lines or not lines[-1]):
+            continue
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+
+    return NormalizedText(
+        text="\n".join(lines),
+        links=_unique(scan.markdown_links + scan.links),
+        hashtags=_unique(scan.hashtags),
+        emojis=scan.emojis
+    )
+
+
+def extract_links(text: str) -> List[str]:
+    """Все ссылки текста без дублей: сначала markdown-ссылки, затем остальные по порядку"""
+    if not text or "http" not in text:
+        return []
+    # Ссылки в скобках и внутри markdown-ссылок находит и общий поиск URL
+    markdown_links = MARKDOWN_LINK_RE.findall(text) if "](" in text else []
+    return _unique(markdown_links + URL_RE.findall(text))
+
+
+def trim_to_last_sentence(text: str) -> str:
+    """Текст до конца последнего законченного предложения (ответ, оборванный лимитом токенов)"""
+    last_end = None
+    for match in _SENTENCE_END_RE.finditer(text):
+        last_end = match.end()
+    if last_end is None:
+        # Ни одного законченного предложения: отбрасываем только оборванный абзац
+        paragraph_end = text.rstrip().rfind("\n\n")
+        return text[:paragraph_end].rstrip() if paragraph_end > 0 else text.rstrip()
+    return text[:last_end]
+
+
+def remove_emojis(text: str) -> str:
+    """Удаляет эмодзи"""
+    return EMOJI_RE.sub("", text)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Оценка токенов, адаптивный max_tokens и стоимость запросов к OpenAI
+"""
+
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Служебные токены chat-формата на каждое сообщение и на ответ
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Запасная оценка без tiktoken: латиница ~4 символа на токен, кириллица и прочее ~2.5
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 2.5
+
+# Цены за 1M токенов в USD: (вход, вход из кэша, выход)
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+}
+
+_SENTENCE_END_RE = re.compile(r'[.!?…](?=\s)')
+
+
+def get_model_prices(model: str, prices: Optional[Dict[str, Tuple[float, float, float]]] = None
+                     ) -> Optional[Tuple[float, float, float]]:
+    """Цены модели (вход, вход из кэша, выход) за 1M токенов"""
+    prices = prices or MODEL_PRICES
+    price = prices.get(model)
+    if price is None:
+        # Версионированные имена (gpt-4o-mini-2024-07-18) считаем по базовой модели
+        for name in sorted(prices, key=len, reverse=True):
+            if model.startswith(name):
+                return prices[name]
+    return price
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0,
+                  prices: Optional[Dict[str, Tuple[float, float, float]]] = None) -> Optional[float]:
+    """Стоимость запроса в USD (None, если цены модели неизвестны)"""
+    price = get_model_prices(model, prices)
+    if price is None:
+        return None
+
+    input_price, cached_price, output_price = price
+    cached_tokens = min(cached_tokens or 0, prompt_tokens)
+    cost = (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+    return round(cost, 8)
+
+
+class TokenEstimator:
+    """Подсчет токенов через tiktoken, без него - приблизительно по символам"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = self._load_encoding(model)
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        """Количество токенов в тексте"""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+
+        ascii_chars = sum(1 for char in text if ord(char) < 128)
+        other_chars = len(text) - ascii_chars
+        return math.ceil(ascii_chars / ASCII_CHARS_PER_TOKEN + other_chars / OTHER_CHARS_PER_TOKEN)
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """Токены промпта для chat completions"""
+        return sum(TOKENS_PER_MESSAGE + self.count(message["content"]) for message in messages) + TOKENS_PER_REPLY
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Обрезает текст до max_tokens по границе абзаца или предложения"""
+        if self.count(text) <= max_tokens:
+            return text
+
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            cut = self._encoding.decode(tokens[:max_tokens])
+        else:
+            # Бинарный поиск длины префикса, укладывающегося в бюджет
+            low, high = 0, len(text)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count(text[:middle]) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            cut = text[:low]
+
+        # Не обрываем на полуслове: ищем конец абзаца, затем конец предложения во второй половине
+        paragraph_end = cut.rfind("\n\n")
+        if paragraph_end >= len(cut) // 2:
+            return cut[:paragraph_end].rstrip()
+
+        sentence_ends = [match.end() for match in _SENTENCE_END_RE.finditer(cut)]
+        if sentence_ends and sentence_ends[-1] >= len(cut) // 2:
+            return cut[:sentence_ends[-1]].rstrip()
+
+        return cut.rstrip()
+
+    @staticmethod
+    def _load_encoding(model: str):
+        if tiktoken is None:
+            logger.info("tiktoken не установлен, токены оцениваются приблизительно")
+            return None
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Словари tiktoken скачиваются при первом использовании - без сети их может не быть
+            logger.warning(f"Не удалось загрузить словарь tiktoken ({e}), токены оцениваются приблизительно")
+            return None
+
+
+def adaptive_max_tokens(source_tokens: int, ratio: float = 1.3, overhead: int = 60,
+                        minimum: int = 200, maximum: int = 800) -> int:
+    """Лимит ответа по длине исходника: переписанный пост примерно той же длины плюс заголовок"""
+    return max(minimum, min(maximum, int(source_tokens * ratio) + overhead))
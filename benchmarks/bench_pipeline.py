@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сквозной бенчмарк конвейера: монитор -> переписывание -> очередь -> публикация
+
+Посты из Posts.txt проходят через ChannelMonitor и TelegramUserBot._process_new_post,
+AI отвечает локальный OpenAI-совместимый сервер, Telegram заменен заглушкой.
+
+Запуск: python benchmarks/bench_pipeline.py [--posts 200] [--rate 20] [--latency 0.5] [--error-rate 0.05]
+                                            [--stream] [--json results.json] [--baseline old.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from loguru import logger
+
+from ai.content_rewriter import ContentRewriter
+from benchmarks.mock_openai import MockOpenAIServer
+from benchmarks.posts import load_posts
+from benchmarks.stub_telegram import StubTelegramClient, channel_peer_id, make_event
+from bot.channel_monitor import ChannelMonitor
+from bot.telegram_bot import TelegramUserBot
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+# Этапы в порядке прохождения поста
+STAGES = ("monitor", "rewrite", "queue", "publish", "total")
+
+
+class BenchConfig:
+    """Настройки бота для бенчмарка: без лимитов и интервалов публикации, без кэша и фильтра дублей"""
+
+    SESSION_NAME = "benchmark"
+    API_ID = 0
+    API_HASH = ""
+    TARGET_CHANNEL = "@benchmark_target"
+    MIN_POST_LENGTH = 1
+    MAX_POSTS_PER_DAY = 10 ** 9
+    PUBLISH_INTERVAL_MIN = 0
+    PUBLISH_INTERVAL_MAX = 0
+
+    AI_PROVIDER = "mock"
+    AI_API_KEY = "benchmark"
+    AI_MODEL = "gpt-4o-mini"
+    AI_RETRY_BASE_DELAY = 0.05
+    AI_RETRY_MAX_DELAY = 1.0
+
+    # Повторяющиеся тексты Posts.txt иначе отсеялись бы как дубли или взялись из кэша
+    REWRITE_CACHE_ENABLED = False
+    NEAR_DUPLICATE_ENABLED = False
+
+    def __init__(self, options: argparse.Namespace, base_url: str):
+        self.SOURCE_CHANNELS = [channel_peer_id(1000 + index) for index in range(options.channels)]
+        self.AI_PROVIDERS = [{"name": "mock", "base_url": base_url, "model": self.AI_MODEL}]
+        self.AI_STREAMING = options.stream
+        self.REWRITE_WORKERS = options.workers
+        self.REWRITE_QUEUE_SIZE = options.queue_size
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 (ближайший ранг), среднее и максимум в миллисекундах"""
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(0.5),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3)
+    }
+
+
+class StageTimer:
+    """Отметки времени поста на границах этапов; ключ - (канал, ID сообщения)"""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.marks: Dict[tuple, Dict[str, float]] = {}
+        self.done = asyncio.Event()
+        self.published = 0
+
+    def mark(self, key: tuple, name: str):
+        self.marks.setdefault(key, {})[name] = time.perf_counter()
+        if name == "published":
+            self.published += 1
+            if self.published >= self.expected:
+                self.done.set()
+
+    def durations(self) -> Dict[str, List[float]]:
+        bounds = {
+            "monitor": ("event", "submitted"),
+            "rewrite": ("submitted", "rewritten"),
+            "queue": ("rewritten", "publishing"),
+            "publish": ("publishing", "published"),
+            "total": ("event", "published")
+        }
+        result = {stage: [] for stage in STAGES}
+        for marks in self.marks.values():
+            for stage, (start, end) in bounds.items():
+                if start in marks and end in marks:
+                    result[stage].append(marks[end] - marks[start])
+        return result
+
+
+async def sample_loop_lag(samples: List[float], interval: float):
+    """Насколько позже запланированного просыпается корутина - задержка event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+def instrument(bot: TelegramUserBot, timer: StageTimer):
+    """Обертки на границах этапов; публикация ставится на "сейчас" вместо интервала 20-30 минут"""
+    rewrite_post = bot.content_rewriter.rewrite_post
+    schedule = bot.scheduler.schedule
+    publish = bot._publish_rewritten_post
+    submit = bot.rewrite_pool.submit
+
+    async def submit_post(post_data):
+        timer.mark((post_data["channel_id"], post_data["id"]), "submitted")
+        await submit(post_data)
+
+    async def timed_rewrite(source_post):
+        rewritten_post = await rewrite_post(source_post)
+        timer.mark((source_post.channel_id, source_post.id), "rewritten")
+        return rewritten_post
+
+    def schedule_now(post, publish_time, *args, **kwargs):
+        return schedule(post, datetime.now(), *args, **kwargs)
+
+    async def timed_publish(rewritten_post, *args, **kwargs):
+        key = (rewritten_post.original_post.channel_id, rewritten_post.original_post.id)
+        timer.mark(key, "publishing")
+        try:
+            return await publish(rewritten_post, *args, **kwargs)
+        finally:
+            timer.mark(key, "published")
+
+    bot.channel_monitor.set_post_processor(submit_post)
+    bot.content_rewriter.rewrite_post = timed_rewrite
+    bot.scheduler.schedule = schedule_now
+    bot._publish_rewritten_post = timed_publish
+
+
+async def run_pipeline(options: argparse.Namespace, server: MockOpenAIServer) -> Dict[str, Any]:
+    config = BenchConfig(options, server.base_url)
+    client = StubTelegramClient(send_latency=options.send_latency)
+
+    # Повторяет TelegramUserBot.start() без подключения к Telegram
+    bot = TelegramUserBot(config, ContentRewriter(config))
+    bot.client = client
+    bot.channel_monitor = ChannelMonitor(config, client)
+    bot.publish_task = asyncio.create_task(bot.scheduler.run(bot._publish_scheduled_job))
+    await bot.rewrite_pool.start()
+
+    texts = load_posts()
+    timer = StageTimer(options.posts)
+    instrument(bot, timer)
+
+    lag_samples: List[float] = []
+    lag_task = asyncio.create_task(sample_loop_lag(lag_samples, options.lag_interval))
+    handlers = []
+
+    started = time.perf_counter()
+    for index in range(options.posts):
+        peer_id = config.SOURCE_CHANNELS[index % len(config.SOURCE_CHANNELS)]
+        event = make_event(peer_id, index + 1, texts[index % len(texts)])
+        timer.mark((peer_id, event.message.id), "event")
+        # Telethon вызывает обработчик каждого события в отдельной задаче
+        handlers.append(asyncio.create_task(bot.channel_monitor._handle_new_message(event)))
+        if options.rate > 0:
+            await asyncio.sleep(1.0 / options.rate)
+
+    completed = True
+    try:
+        await asyncio.wait_for(timer.done.wait(), timeout=options.timeout)
+    except asyncio.TimeoutError:
+        completed = False
+        logger.warning(f"Бенчмарк не завершился за {options.timeout}с: опубликовано {timer.published}/{options.posts}")
+    elapsed = time.perf_counter() - started
+
+    lag_task.cancel()
+    await asyncio.gather(lag_task, *handlers, return_exceptions=True)
+    bot_stats = bot.get_stats()
+    await bot.stop()
+
+    durations = timer.durations()
+    return {
+        "completed": completed,
+        "published": timer.published,
+        "duration_seconds": round(elapsed, 3),
+        "posts_per_second": round(timer.published / elapsed, 3) if elapsed else None,
+        "stages_ms": {stage: percentiles(durations[stage]) for stage in STAGES},
+        "event_loop_lag_ms": percentiles(lag_samples),
+        "telegram_sends": len(client.sent),
+        "ai_requests": bot_stats["ai_requests"],
+        "rewrite_pool": {key: bot_stats["rewrite_pool"][key] for key in ("workers", "max_queue_depth", "submitted")}
+    }
+
+
+def run(options: argparse.Namespace) -> Dict[str, Any]:
+    server = MockOpenAIServer(
+        latency=options.latency,
+        jitter=options.jitter,
+        chunk_delay=options.chunk_delay,
+        error_rate=options.error_rate,
+        error_status=options.error_status,
+        retry_after=options.retry_after,
+        seed=options.seed
+    )
+    server.start()
+
+    # Бот пишет статистику, очередь и базы в data/ текущего каталога - работаем во временном
+    cwd = os.getcwd()
+    if options.trace_memory:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="rewirater-bench-") as work_dir:
+            os.chdir(work_dir)
+            try:
+                result = asyncio.run(run_pipeline(options, server))
+            finally:
+                os.chdir(cwd)
+    finally:
+        server.stop()
+
+    memory = {"traced_peak_mb": None, "max_rss_mb": None}
+    if options.trace_memory:
+        memory["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    if resource is not None:
+        # ru_maxrss в Linux - в килобайтах
+        memory["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+    return {
+        "benchmark": "pipeline",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "params": {key: value for key, value in vars(options).items() if key not in ("json", "baseline")},
+        **result,
+        "memory": memory,
+        "mock_server": dict(server.stats)
+    }
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print(f"Постов: {result['published']}/{result['params']['posts']} за {result['duration_seconds']}с, "
+          f"{result['posts_per_second']} постов/с")
+    if baseline:
+        print(f"  (было {baseline['posts_per_second']} постов/с)")
+
+    print(f"{'этап':<10} {'p50, мс':>10} {'p95, мс':>10} {'p99, мс':>10} {'max, мс':>10}")
+    rows = [(stage, result["stages_ms"][stage], (baseline or {}).get("stages_ms", {}).get(stage)) for stage in STAGES]
+    rows.append(("loop lag", result["event_loop_lag_ms"], (baseline or {}).get("event_loop_lag_ms")))
+    for name, stats, old in rows:
+        print(f"{name:<10} " + " ".join(f"{_format(stats[key]):>10}" for key in ("p50", "p95", "p99", "max")))
+        if old:
+            print(f"{'  было':<10} " + " ".join(f"{_format(old[key]):>10}" for key in ("p50", "p95", "p99", "max")))
+
+    memory = result["memory"]
+    print(f"Память: max RSS {memory['max_rss_mb']} МБ, пик tracemalloc {memory['traced_peak_mb']} МБ")
+    print(f"AI сервер: {result['mock_server']}")
+
+
+def _format(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=200, help="сколько постов прогнать")
+    parser.add_argument("--rate", type=float, default=0.0, help="постов в секунду на входе (0 - все сразу)")
+    parser.add_argument("--channels", type=int, default=5, help="каналов-источников")
+    parser.add_argument("--workers", type=int, default=4, help="воркеров переписывания")
+    parser.add_argument("--queue-size", type=int, default=100, help="размер очереди переписывания")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы AI")
+    parser.add_argument("--latency", type=float, default=0.5, help="время до первого токена, с")
+    parser.add_argument("--jitter", type=float, default=0.1, help="разброс задержки, с")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="задержка между чанками ответа, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов с ошибкой")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP-статус ошибки (429 - с Retry-After)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After для ошибок 429, с")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="задержка отправки в Telegram, с")
+    parser.add_argument("--lag-interval", type=float, default=0.01, help="период замера задержки event loop, с")
+    parser.add_argument("--timeout", type=float, default=600.0, help="предел времени прогона, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true", help="пик памяти через tracemalloc (медленнее)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", type=Path, help="куда сохранить результат (по умолчанию benchmarks/results/)")
+    parser.add_argument("--baseline", type=Path, help="результат прошлого прогона для сравнения")
+    options = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=options.log_level)
+
+    baseline = json.loads(options.baseline.read_text(encoding="utf-8")) if options.baseline else None
+    result = run(options)
+    print_report(result, baseline)
+
+    output = options.json or RESULTS_DIR / f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результат сохранен в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк: однопроходная нормализация текста против прежних функций ContentRewriter
+
+Запуск: python benchmarks/bench_text_engine.py [--repeat 50] [--json results.json]
+"""
+
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from ai.text_engine import extract_links, normalize_post_text, remove_emojis
+from benchmarks.posts import load_posts
+
+
+# --- Прежние реализации (до ai/text_engine.py), для сравнения ---
+
+def legacy_remove_emojis(text: str) -> str:
+    emoji_pattern = re.compile(
+        "["
+        "\U0001F600-\U0001F64F"
+        "\U0001F300-\U0001F5FF"
+        "\U0001F680-\U0001F6FF"
+        "\U0001F1E0-\U0001F1FF"
+        "\U00002702-\U000027B0"
+        "\U000024C2-\U0001F251"
+        "\U0001F900-\U0001F9FF"
+        "\U0001FA70-\U0001FAFF"
+        "\U00002600-\U000026FF"
+        "\U00002700-\U000027BF"
+        "]+",
+        flags=re.UNICODE
+    )
+    return emoji_pattern.sub('', text)
+
+
+def legacy_process_links(text: str) -> str:
+    link_pattern = r'\(([^)]*https?://[^)]*)\)'
+    re.findall(link_pattern, text)
+    return re.sub(link_pattern, '', text)
+
+
+def legacy_clean_and_format(text: str) -> str:
+    text = legacy_remove_emojis(text)
+    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
+    text = text.strip()
+    return legacy_process_links(text)
+
+
+def legacy_remove_hashtags(text: str) -> str:
+    text = legacy_remove_emojis(text)
+    cleaned_lines = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line and (all(word.startswith('#') for word in line.split()) or line.startswith('@marxstud')):
+            continue
+        cleaned_lines.append(line)
+    result = re.sub(r'\n\s*\n\s*\n', '\n\n', '\n'.join(cleaned_lines))
+    return result.strip()
+
+
+def legacy_extract_links(text: str) -> List[str]:
+    urls: List[str] = []
+    urls.extend(re.findall(r'\[[^\]]+\]\((https?://[^)\s]+)\)', text))
+    urls.extend(re.findall(r'(https?://[^\s)]+)', text))
+    for chunk in re.findall(r'\(([^)]*https?://[^)]*)\)', text):
+        for m in re.findall(r'(https?://[^\s)]+)', chunk):
+            urls.append(m)
+    seen = set()
+    unique_urls: List[str] = []
+    for u in urls:
+        if u not in seen:
+            seen.add(u)
+            unique_urls.append(u)
+    return unique_urls
+
+
+def legacy_pipeline(text: str) -> str:
+    """Постобработка ответа AI, как в rewrite_post до перехода на text_engine"""
+    return legacy_remove_hashtags(legacy_clean_and_format(text))
+
+
+def engine_pipeline(text: str) -> str:
+    return normalize_post_text(text, escape_html=False).text
+
+
+# --- Замеры ---
+
+def measure(func: Callable[[str], object], posts: List[str], repeat: int) -> float:
+    """Среднее время обработки одного поста, мкс"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for post in posts:
+            func(post)
+    return (time.perf_counter() - started) / (repeat * len(posts)) * 1e6
+
+
+# Посты в стиле Posts.txt с краевыми случаями разметки, которых нет в корпусе
+EDGE_CASES = [
+    # Незакрытый ** не должен захватывать следующие строки и абзацы
+    "**Binance запускает новый пул\n\nПодробности в **статье** (https://example.com/post) 🚀\n#crypto",
+    "Итоги недели ** по рынку\nBTC ** растет, ETH стоит на месте",
+]
+
+
+def run(repeat: int) -> Dict:
+    posts = load_posts() + EDGE_CASES
+    cases = {
+        "post_processing": (legacy_pipeline, engine_pipeline),
+        "extract_links": (legacy_extract_links, extract_links),
+        "remove_emojis": (legacy_remove_emojis, remove_emojis),
+    }
+
+    results = {"posts": len(posts), "repeat": repeat, "cases": {}}
+    for name, (legacy, engine) in cases.items():
+        mismatches = sum(1 for post in posts if legacy(post) != engine(post))
+        legacy_us = measure(legacy, posts, repeat)
+        engine_us = measure(engine, posts, repeat)
+        results["cases"][name] = {
+            "legacy_us_per_post": round(legacy_us, 2),
+            "engine_us_per_post": round(engine_us, 2),
+            "speedup": round(legacy_us / engine_us, 2) if engine_us else None,
+            "mismatches": mismatches
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк нормализации текста на Posts.txt")
+    parser.add_argument("--repeat", type=int, default=50, help="Сколько раз прогнать все посты")
+    parser.add_argument("--json", type=Path, help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print(f"Постов: {results['posts']}, повторов: {results['repeat']}")
+    print(f"{'кейс':<18}{'было, мкс':>12}{'стало, мкс':>12}{'ускорение':>12}{'расхождений':>13}")
+    for name, case in results["cases"].items():
+        print(
+            f"{name:<18}{case['legacy_us_per_post']:>12}{case['engine_us_per_post']:>12}"
+            f"{case['speedup']:>11}x{case['mismatches']:>13}"
+        )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результаты сохранены в {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Калибровка порога NEAR_DUPLICATE_THRESHOLD на Posts.txt
+
+Почти-дубликаты: пост с добавленным предложением из другого поста и пост без одного предложения.
+Разные посты: все пары различных постов корпуса. Для каждого порога считается доля найденных
+почти-дубликатов (recall) и число ложных срабатываний индекса на разных постах.
+
+Запуск: python benchmarks/calibrate_near_duplicate.py [--thresholds 0.3 0.4 0.5] [--json results.json]
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from ai.near_duplicate import NearDuplicateIndex, minhash, shingles, tokenize_for_similarity
+from benchmarks.posts import load_posts
+
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+
+
+def sentences(text: str) -> List[str]:
+    return [s for s in _SENTENCE_SPLIT_RE.split(text) if len(s.split()) >= 4]
+
+
+def jaccard(a: str, b: str) -> float:
+    first = shingles(tokenize_for_similarity(a))
+    second = shingles(tokenize_for_similarity(b))
+    return len(first & second) / len(first | second)
+
+
+def near_duplicate_pairs(posts: List[str], min_tokens: int, seed: int) -> List[Tuple[str, str]]:
+    """Пары (пост, измененный пост): +1 предложение из другого поста, -1 предложение из середины"""
+    rng = random.Random(seed)
+    all_sentences = [s for post in posts for s in sentences(post)]
+
+    pairs = []
+    for post in posts:
+        if len(tokenize_for_similarity(post)) < min_tokens:
+            continue
+        pairs.append((post, post + "\n\n" + rng.choice(all_sentences)))
+
+        own = sentences(post)
+        if len(own) >= 3:
+            pairs.append((post, post.replace(own[len(own) // 2], "")))
+    return pairs
+
+
+def quantiles(values: List[float], points=(0.0, 0.05, 0.1, 0.5)) -> Dict[str, float]:
+    values = sorted(values)
+    return {f"p{int(q * 100)}": round(values[int(q * (len(values) - 1))], 3) for q in points}
+
+
+def run(thresholds: List[float], seed: int) -> Dict:
+    posts = load_posts()
+    min_tokens = NearDuplicateIndex().min_tokens
+    pairs = near_duplicate_pairs(posts, min_tokens, seed)
+    distinct = [post for post in posts if len(tokenize_for_similarity(post)) >= min_tokens]
+
+    positive = [jaccard(a, b) for a, b in pairs]
+    negative = [jaccard(a, b) for a, b in itertools.combinations(distinct, 2)]
+
+    results = {
+        "posts": len(posts),
+        "near_duplicate_pairs": len(pairs),
+        "distinct_pairs": len(negative),
+        "near_duplicate_jaccard": quantiles(positive),
+        "distinct_jaccard_max": round(max(negative), 3),
+        "thresholds": {}
+    }
+
+    for threshold in thresholds:
+        found = 0
+        for index_id, (original, changed) in enumerate(pairs):
+            index = NearDuplicateIndex(threshold=threshold)
+            index.add(f"{index_id}:original", original, now=0)
+            found += index.check(changed, now=0) is not None
+
+        # Ложные срабатывания: разные посты корпуса, добавленные в один индекс
+        index = NearDuplicateIndex(threshold=threshold)
+        false_positives = sum(
+            index.check_and_add(str(post_id), post, now=0) is not None
+            for post_id, post in enumerate(distinct)
+        )
+
+        results["thresholds"][str(threshold)] = {
+            "recall": round(found / len(pairs), 3),
+            "false_positives": false_positives
+        }
+
+    tokens = [tokenize_for_similarity(post) for post in distinct]
+    started = time.perf_counter()
+    for post_tokens in tokens:
+        minhash(post_tokens)
+    results["minhash_ms_per_post"] = round((time.perf_counter() - started) / len(tokens) * 1000, 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Калибровка порога почти-дубликатов на Posts.txt")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.3, 0.4, 0.5, 0.6, 0.7],
+                        help="Проверяемые пороги сходства Жаккара")
+    parser.add_argument("--seed", type=int, default=1, help="Seed выбора добавляемых предложений")
+    parser.add_argument("--json", type=Path, help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    results = run(args.thresholds, args.seed)
+    print(f"Постов: {results['posts']}, почти-дубликатов: {results['near_duplicate_pairs']}, "
+          f"разных пар: {results['distinct_pairs']}")
+    print(f"Жаккар почти-дубликатов: {results['near_duplicate_jaccard']}")
+    print(f"Жаккар разных постов, максимум: {results['distinct_jaccard_max']}")
+    print(f"{'порог':<8}{'recall':>8}{'ложных':>8}")
+    for threshold, row in results["thresholds"].items():
+        print(f"{threshold:<8}{row['recall']:>8}{row['false_positives']:>8}")
+    print(f"MinHash: {results['minhash_ms_per_post']} мс на пост")
+
+    if args.json:
+        args.json.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результаты сохранены в {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальный OpenAI-совместимый сервер для бенчмарков: задержки, поток, внедрение ошибок
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from ai.prompts import SOURCE_POST_HEADER
+
+# Грубая оценка токенов для поля usage: точность для бенчмарка не важна
+CHARS_PER_TOKEN = 3
+
+
+class MockOpenAIServer:
+    """POST /v1/chat/completions в отдельном потоке со своим event loop, чтобы не мешать замерам бота"""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.1, chunk_delay: float = 0.01,
+                 words_per_chunk: int = 8, error_rate: float = 0.0, error_status: int = 500,
+                 retry_after: float = 1.0, seed: int = 1, host: str = "127.0.0.1", port: int = 0):
+        # latency - время до первого токена, chunk_delay - между чанками ответа (и в потоке, и без него)
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.words_per_chunk = max(1, words_per_chunk)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+
+        self._random = random.Random(seed)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._connections = set()
+
+        self.stats = {"requests": 0, "streamed": 0, "errors_injected": 0, "completed": 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self):
+        """Запускает сервер и ждет, пока он начнет принимать соединения"""
+        self._thread = threading.Thread(target=self._run, name="mock-openai", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(10):
+            raise RuntimeError("Mock OpenAI сервер не запустился")
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(10)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, self.host, self.port)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            # Соединения keep-alive висят в ожидании следующего запроса - закрываем их до остановки loop
+            for task in self._connections:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*self._connections, return_exceptions=True))
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 с keep-alive: клиент OpenAI держит пул соединений"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if method == "POST" and path.rstrip("/").endswith("/chat/completions"):
+                    await self._chat_completion(json.loads(body or b"{}"), writer)
+                else:
+                    self._write_json(writer, 404, {"error": {"message": f"Not found: {path}", "type": "not_found"}})
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _chat_completion(self, request: Dict[str, Any], writer: asyncio.StreamWriter):
+        self.stats["requests"] += 1
+        delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+        if self._random.random() < self.error_rate:
+            self.stats["errors_injected"] += 1
+            await asyncio.sleep(delay / 2)
+            headers = {"Retry-After": f"{self.retry_after:g}"} if self.error_status == 429 else {}
+            self._write_json(
+                writer,
+                self.error_status,
+                {"error": {"message": "Injected error", "type": "server_error", "code": None}},
+                headers
+            )
+            return
+
+        model = request.get("model", "gpt-4o-mini")
+        messages = request.get("messages", [])
+        chunks = self._build_chunks(messages)
+        usage = self._build_usage(messages, "".join(chunks))
+        completion_id = f"chatcmpl-mock-{self.stats['requests']}"
+
+        await asyncio.sleep(delay)
+        if request.get("stream"):
+            self.stats["streamed"] += 1
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n"
+            )
+            for index, text in enumerate(chunks):
+                if index:
+                    await asyncio.sleep(self.chunk_delay)
+                delta = {"role": "assistant", "content": text} if index == 0 else {"content": text}
+                self._write_event(writer, self._chunk(completion_id, model, delta, None))
+                await writer.drain()
+            self._write_event(writer, self._chunk(completion_id, model, {}, "stop"))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                final = self._chunk(completion_id, model, None, None)
+                final["choices"] = []
+                final["usage"] = usage
+                self._write_event(writer, final)
+            self._write_sse(writer, b"data: [DONE]\n\n")
+            writer.write(b"0\r\n\r\n")
+        else:
+            await asyncio.sleep(self.chunk_delay * (len(chunks) - 1))
+            self._write_json(writer, 200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(chunks)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+        self.stats["completed"] += 1
+
+    def _build_chunks(self, messages: List[Dict[str, Any]]) -> List[str]:
+        """Ответ из исходного поста: жирный заголовок, абзацы, хештеги и подпись (их бот отрезает)"""
+        prompt = messages[-1].get("content", "") if messages else ""
+        source = prompt.split(SOURCE_POST_HEADER, 1)[-1].strip()
+        paragraphs = [paragraph.strip() for paragraph in source.split("\n\n") if paragraph.strip()]
+        title = (paragraphs[0] if paragraphs else "Новость").split(".")[0][:60]
+        text = "\n\n".join([f"**{title}**"] + paragraphs[1:4] + ["#новости #крипто", "@marxstud"])
+
+        words = text.split(" ")
+        return [
+            " ".join(words[start:start + self.words_per_chunk]) + ("" if start + self.words_per_chunk >= len(words) else " ")
+            for start in range(0, len(words), self.words_per_chunk)
+        ]
+
+    def _build_usage(self, messages: List[Dict[str, Any]], completion: str) -> Dict[str, Any]:
+        prompt = "".join(message.get("content", "") for message in messages)
+        source = prompt.split(SOURCE_POST_HEADER, 1)[-1]
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        # Статический префикс кэшируется блоками по 128 токенов, начиная со второго запроса
+        cached_tokens = 0
+        if self.stats["requests"] > 1:
+            cached_tokens = (len(prompt) - len(source)) // CHARS_PER_TOKEN // 128 * 128
+        completion_tokens = len(completion) // CHARS_PER_TOKEN
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}
+        }
+
+    @staticmethod
+    def _chunk(completion_id: str, model: str, delta: Optional[Dict[str, Any]],
+               finish_reason: Optional[str]) -> Dict[str, Any]:
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]
+        }
+
+    def _write_event(self, writer: asyncio.StreamWriter, data: Dict[str, Any]):
+        self._write_sse(writer, b"data: " + json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+    @staticmethod
+    def _write_sse(writer: asyncio.StreamWriter, payload: bytes):
+        writer.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+
+    @staticmethod
+    def _write_json(writer: asyncio.StreamWriter, status: int, data: Dict[str, Any],
+                    headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+                  503: "Service Unavailable"}.get(status, "Error")
+        head = [f"HTTP/1.1 {status} {reason}", "Content-Type: application/json", f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Тексты постов из Posts.txt для бенчмарков
+"""
+
+from pathlib import Path
+from typing import List
+
+POSTS_FILE = Path(__file__).resolve().parent.parent / "Posts.txt"
+
+
+def load_posts(path: Path = POSTS_FILE) -> List[str]:
+    """Посты, разделенные строкой '---'"""
+    text = path.read_text(encoding="utf-8")
+    posts = [post.strip() for post in text.split("\n---\n")]
+    return [post for post in posts if post]
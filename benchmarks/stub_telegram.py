@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка клиента Telethon и синтетические сообщения каналов для бенчмарков
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from telethon.tl.types import PeerChannel
+
+# ID каналов в формате Telethon (-100...) получаются из положительного channel_id
+CHANNEL_ID_OFFSET = 10 ** 12
+
+
+def channel_peer_id(channel_id: int) -> int:
+    return -(CHANNEL_ID_OFFSET + channel_id)
+
+
+def make_event(peer_id: int, message_id: int, text: str) -> SimpleNamespace:
+    """Событие NewMessage с полями, которые читает ChannelMonitor"""
+    message = SimpleNamespace(
+        id=message_id,
+        chat_id=peer_id,
+        text=text,
+        date=datetime.now(timezone.utc),
+        views=0,
+        forwards=0,
+        media=None,
+        action=None,
+        fwd_from=None
+    )
+    return SimpleNamespace(message=message, chat_id=peer_id)
+
+
+class StubTelegramClient:
+    """Клиент без сети: отправка занимает send_latency, все отправленное запоминается"""
+
+    def __init__(self, send_latency: float = 0.05):
+        self.send_latency = send_latency
+        self.sent: List[Dict[str, Any]] = []
+
+    async def get_me(self):
+        return SimpleNamespace(id=1, first_name="Benchmark", username="benchmark")
+
+    async def get_entity(self, peer_id):
+        # PeerChannel понимает telethon.utils.get_peer_id, название и username добавляем сами
+        channel_id = -int(peer_id) - CHANNEL_ID_OFFSET
+        entity = PeerChannel(channel_id)
+        entity.title = f"Bench channel {channel_id}"
+        entity.username = f"bench_channel_{channel_id}"
+        return entity
+
+    async def send_message(self, entity, message, parse_mode=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent.append({"entity": entity, "kind": "message", "length": len(message or "")})
+        return SimpleNamespace(id=len(self.sent))
+
+    async def send_file(self, entity, file, caption=None, parse_mode=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent.append({"entity": entity, "kind": "file", "length": len(caption or "")})
+        return SimpleNamespace(id=len(self.sent))
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        return None
+
+    async def iter_messages(self, entity, limit=None, **kwargs):
+        return
+        yield
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+    def on(self, event):
+        return lambda callback: callback
+
+    async def disconnect(self):
+        pass
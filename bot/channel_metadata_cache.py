@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэш метаданных каналов-источников (название, username, access hash)
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from telethon import TelegramClient, events, utils
+from telethon.tl.types import PeerChannel, UpdateChannel
+
+from loguru import logger
+
+from utils.metrics import REGISTRY
+
+ENTITY_LOOKUPS = REGISTRY.counter(
+    "rewirater_entity_lookups_total", "Запросы метаданных каналов: из кэша или из Telegram", ["result"]
+)
+
+
+@dataclass
+class ChannelMetadata:
+    """Метаданные канала"""
+    channel_id: int
+    title: str
+    username: Optional[str]
+    access_hash: Optional[int]
+    fetched_at: float
+
+
+class ChannelMetadataCache:
+    """Кэш метаданных каналов с TTL, чтобы не вызывать get_entity на каждый пост"""
+
+    def __init__(self, client: TelegramClient, ttl_seconds: float = 3600):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[int, ChannelMetadata] = {}
+        # Альтернативные ID из конфига (@username, ID без -100) -> ID пира
+        self._aliases: Dict[object, int] = {}
+        # Запросы get_entity в процессе, чтобы параллельные посты не дублировали RPC
+        self._pending: Dict[object, asyncio.Future] = {}
+
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def put_entity(self, entity, *aliases) -> ChannelMetadata:
+        """Сохраняет метаданные из уже полученной сущности"""
+        peer_id = utils.get_peer_id(entity)
+        metadata = ChannelMetadata(
+            channel_id=peer_id,
+            title=getattr(entity, 'title', None) or f"Channel {peer_id}",
+            username=getattr(entity, 'username', None),
+            access_hash=getattr(entity, 'access_hash', None),
+            fetched_at=time.monotonic()
+        )
+        self._entries[peer_id] = metadata
+        for alias in aliases:
+            if alias is not None and alias != peer_id:
+                self._aliases[alias] = peer_id
+        return metadata
+
+    async def get(self, channel_id) -> ChannelMetadata:
+        """Возвращает метаданные канала, при необходимости запрашивая их у Telegram"""
+        metadata = self._lookup(channel_id)
+        if metadata and time.monotonic() - metadata.fetched_at < self.ttl_seconds:
+            self.stats["hits"] += 1
+            ENTITY_LOOKUPS.labels("hit").inc()
+            return metadata
+
+        self.stats["misses"] += 1
+        ENTITY_LOOKUPS.labels("miss").inc()
+        fetched = await self._fetch(channel_id)
+        if fetched:
+            return fetched
+
+        # Если Telegram недоступен, лучше отдать устаревшие данные, чем ничего
+        if metadata:
+            return metadata
+        return ChannelMetadata(
+            channel_id=channel_id,
+            title=f"Channel {channel_id}",
+            username=None,
+            access_hash=None,
+            fetched_at=0.0
+        )
+
+    async def refresh(self, channel_id) -> Optional[ChannelMetadata]:
+        """Принудительно обновляет метаданные канала"""
+        self.stats["refreshes"] += 1
+        return await self._fetch(channel_id)
+
+    def invalidate(self, channel_id):
+        """Удаляет канал из кэша"""
+        peer_id = self._aliases.get(channel_id, channel_id)
+        self._entries.pop(peer_id, None)
+
+    def register_update_handler(self):
+        """Подписка на UpdateChannel: при изменении канала обновляем кэш"""
+        self.client.add_event_handler(self._on_channel_update, events.Raw(UpdateChannel))
+
+    async def _on_channel_update(self, update: UpdateChannel):
+        peer_id = utils.get_peer_id(PeerChannel(update.channel_id))
+        if peer_id not in self._entries:
+            return
+
+        # Старую запись не удаляем: если обновление не удастся, она останется в кэше
+        logger.debug(f"Канал {peer_id} изменился, обновляем метаданные")
+        await self.refresh(peer_id)
+
+    def _lookup(self, channel_id) -> Optional[ChannelMetadata]:
+        peer_id = self._aliases.get(channel_id, channel_id)
+        return self._entries.get(peer_id)
+
+    async def _fetch(self, channel_id) -> Optional[ChannelMetadata]:
+        pending = self._pending.get(channel_id)
+        if pending:
+            return await pending
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[channel_id] = future
+        metadata = None
+        try:
+            entity = await self.client.get_entity(channel_id)
+            metadata = self.put_entity(entity, channel_id)
+        except Exception as e:
+            self.stats["errors"] += 1
+            ENTITY_LOOKUPS.labels("error").inc()
+            logger.warning(f"Не удалось получить метаданные канала {channel_id}: {e}")
+        finally:
+            self._pending.pop(channel_id, None)
+            if not future.done():
+                future.set_result(metadata)
+
+        return metadata
+
+    def get_stats(self) -> Dict:
+        """Статистика кэша"""
+        return {**self.stats, "channels": len(self._entries)}
@@ -5,16 +5,34 @@
 """
 
 import asyncio
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Set
-import json
-from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
 
 from telethon import TelegramClient, events
 from telethon.tl.types import Message, PeerChannel
 from telethon.errors import FloodWaitError, ChannelPrivateError
 
 from loguru import logger
+from bot.dedup_store import DedupStore
+from bot.channel_metadata_cache import ChannelMetadataCache
+from ai.near_duplicate import NearDuplicateIndex, NearDuplicateMatch
+from utils.metrics import REGISTRY, timed
+
+EVENTS_RECEIVED = REGISTRY.counter(
+    "rewirater_events_received_total", "Новые сообщения из каналов-источников", ["channel"]
+)
+EVENT_DELAY = REGISTRY.histogram(
+    "rewirater_event_delay_seconds", "Задержка от публикации в источнике до получения сообщения"
+)
+POSTS_DROPPED = REGISTRY.counter(
+    "rewirater_posts_dropped_total", "Сообщения, не переданные на переписывание", ["reason"]
+)
+POSTS_ACCEPTED = REGISTRY.counter(
+    "rewirater_posts_accepted_total", "Посты, переданные на переписывание"
+)
+ALBUMS_MERGED = REGISTRY.counter(
+    "rewirater_albums_merged_total", "Альбомы, собранные в один пост"
+)
 
 class ChannelMonitor:
     """Монитор каналов для отслеживания новых постов"""
@@ -22,11 +40,27 @@ class ChannelMonitor:
     def __init__(self, config, telegram_client: TelegramClient):
         self.config = config
         self.client = telegram_client
-        self.processed_posts_file = Path("data/processed_posts.json")
-        self.processed_posts_file.parent.mkdir(exist_ok=True)
         
-        # Загружаем список обработанных постов
-        self.processed_posts: Set[int] = self._load_processed_posts()
+        # Хранилище обработанных постов (ключ: канал + ID сообщения)
+        self.processed_posts = DedupStore(
+            retention_days=getattr(self.config, 'PROCESSED_POSTS_RETENTION_DAYS', 30),
+            hot_size=getattr(self.config, 'PROCESSED_POSTS_HOT_SIZE', 10000)
+        )
+        
+        # Кэш метаданных каналов (название, username), прогревается при проверке доступа
+        self.metadata_cache = ChannelMetadataCache(
+            self.client,
+            ttl_seconds=getattr(self.config, 'CHANNEL_METADATA_TTL_SECONDS', 3600)
+        )
+        
+        # Индекс почти-дубликатов: репосты с другой ссылкой или эмодзи не отправляем в AI
+        self.near_duplicates = None
+        if getattr(self.config, 'NEAR_DUPLICATE_ENABLED', True):
+            self.near_duplicates = NearDuplicateIndex(
+                threshold=getattr(self.config, 'NEAR_DUPLICATE_THRESHOLD', 0.4),
+                window_seconds=getattr(self.config, 'NEAR_DUPLICATE_WINDOW_HOURS', 24) * 3600,
+                max_entries=getattr(self.config, 'NEAR_DUPLICATE_MAX_ENTRIES', 50000)
+            )
         
         # Callback для обработки новых постов
         self.on_new_post_callback = None
@@ -34,7 +68,8 @@ class ChannelMonitor:
         # Статистика
         self.stats = {
             "total_monitored_channels": len(self.config.SOURCE_CHANNELS),
-            "total_processed_posts": len(self.processed_posts),
+            "total_processed_posts": self.processed_posts.count(),
+            "near_duplicates_dropped": 0,
             "last_check_time": None
         }
     
@@ -51,11 +86,22 @@ class ChannelMonitor:
             # Проверяем доступность каналов
             await self._verify_channels_access()
             
+            # Обновляем кэш метаданных при изменении каналов
+            self.metadata_cache.register_update_handler()
+            
             # Регистрируем обработчик новых сообщений для всех каналов
             @self.client.on(events.NewMessage(chats=self.config.SOURCE_CHANNELS))
             async def new_message_handler(event):
+                # Сообщения альбома приходят по одному - их собирает events.Album
+                if event.message.grouped_id:
+                    return
                 await self._handle_new_message(event)
             
+            # Альбом (общий grouped_id) - один пост: одно переписывание и одна отправка
+            @self.client.on(events.Album(chats=self.config.SOURCE_CHANNELS))
+            async def album_handler(event):
+                await self._handle_new_album(event)
+            
             logger.info("Мониторинг каналов запущен успешно")
             
             # Запускаем бесконечный цикл для поддержания соединения
@@ -87,6 +133,7 @@ class ChannelMonitor:
                     entity = await self.client.get_entity(channel_id)
                 
                 accessible_channels.append(channel_id)
+                self.metadata_cache.put_entity(entity, channel_id)
                 logger.info(f"Доступ к каналу {channel_id} подтвержден: {entity.title}")
                 
             except ChannelPrivateError:
@@ -103,12 +150,14 @@ class ChannelMonitor:
                         
                         entity = await self.client.get_entity(channel_id_corrected)
                         accessible_channels.append(channel_id)
+                        self.metadata_cache.put_entity(entity, channel_id, channel_id_corrected)
                         logger.info(f"Доступ к каналу {channel_id} подтвержден (исправленный ID): {entity.title}")
                     else:
                         # Для строковых ID пробуем через строку
                         logger.info(f"Пробуем получить канал через строку: {channel_id}")
                         entity = await self.client.get_entity(str(channel_id))
                         accessible_channels.append(channel_id)
+                        self.metadata_cache.put_entity(entity, channel_id, str(channel_id))
                         logger.info(f"Доступ к каналу {channel_id} подтвержден (через строку): {entity.title}")
                 except Exception as e2:
                     logger.error(f"Альтернативная проверка канала {channel_id} также не удалась: {e2}")
@@ -120,39 +169,120 @@ class ChannelMonitor:
     
     async def _handle_new_message(self, event):
         """Обработка нового сообщения из канала"""
+        await self._handle_post(event.chat_id, [event.message])
+    
+    async def _handle_new_album(self, event):
+        """Обработка альбома: все сообщения с одним grouped_id"""
+        await self._handle_post(event.chat_id, sorted(event.messages, key=lambda message: message.id))
+    
+    async def _handle_post(self, chat_id: int, messages: List[Message]):
+        """Пост из одного сообщения или альбома; текст и ID берутся из сообщения с подписью"""
         try:
-            message = event.message
+            message = self._get_album_caption_message(messages)
+            EVENTS_RECEIVED.labels(chat_id).inc(len(messages))
+            if message.date:
+                EVENT_DELAY.observe(max(0.0, (datetime.now(timezone.utc) - message.date).total_seconds()))
             
-            logger.info(f"Получено сообщение из канала {event.chat_id}: ID={message.id}, текст='{message.text[:50] if message.text else 'None'}...'")
+            logger.debug(f"Получено сообщение из канала {chat_id}: ID={message.id}, текст='{message.text[:50] if message.text else 'None'}...'")
             
-            # Проверяем, не обрабатывали ли мы уже этот пост
-            if message.id in self.processed_posts:
-                logger.info(f"Пост {message.id} уже обработан, пропускаем")
+            with timed("filter"):
+                drop_reason = self._get_drop_reason(chat_id, message)
+            if drop_reason:
+                POSTS_DROPPED.labels(drop_reason).inc()
                 return
             
-            # Фильтруем сообщения
-            if not self._should_process_message(message):
-                logger.info(f"Пост {message.id} не прошел фильтрацию, пропускаем")
-                return
-            
-            logger.info(f"✅ Новый пост в канале {event.chat_id}: {message.id}")
+            logger.info(f"✅ Новый пост в канале {chat_id}: {message.id}")
+            POSTS_ACCEPTED.inc()
             
             # Создаем объект поста
-            post_data = await self._extract_post_data(message, event.chat_id)
+            album = messages if len(messages) > 1 else None
+            post_data = await self._extract_post_data(message, chat_id, album)
+            if album:
+                ALBUMS_MERGED.inc()
+                logger.info(f"Альбом из {len(album)} сообщений собран в один пост {message.id}")
             
-            # Вызываем callback для обработки
+            # Передаем пост в callback (обычно это постановка в очередь переписывания)
             if self.on_new_post_callback:
-                logger.info(f"Вызываем callback для обработки поста {message.id}")
+                logger.debug(f"Передаем пост {message.id} на обработку")
                 await self.on_new_post_callback(post_data)
             else:
                 logger.warning("Callback для обработки постов не установлен!")
             
-            # Помечаем пост как обработанный
-            self._mark_post_as_processed(message.id)
+            # Помечаем пост (и все сообщения альбома) как обработанный
+            for item in messages:
+                self._mark_post_as_processed(chat_id, item.id)
             
         except Exception as e:
             logger.error(f"Ошибка обработки нового сообщения: {e}")
     
+    @staticmethod
+    def _get_album_caption_message(messages: List[Message]) -> Message:
+        """Сообщение альбома с подписью (обычно первое), иначе первое"""
+        for message in messages:
+            if message.text and message.text.strip():
+                return message
+        return messages[0]
+    
+    @staticmethod
+    def _group_albums(messages: List[Message]) -> List[List[Message]]:
+        """Группирует сообщения истории по grouped_id, одиночные - отдельными группами"""
+        groups: List[List[Message]] = []
+        albums: Dict[int, List[Message]] = {}
+        for message in sorted(messages, key=lambda item: item.id):
+            grouped_id = getattr(message, "grouped_id", None)
+            if grouped_id is None:
+                groups.append([message])
+            elif grouped_id in albums:
+                albums[grouped_id].append(message)
+            else:
+                albums[grouped_id] = [message]
+                groups.append(albums[grouped_id])
+        return groups
+    
+    def _get_drop_reason(self, chat_id: int, message: Message) -> Optional[str]:
+        """Причина не обрабатывать сообщение (None - пост новый)"""
+        # Проверяем, не обрабатывали ли мы уже этот пост
+        if self.processed_posts.contains(chat_id, message.id):
+            logger.debug(f"Пост {message.id} уже обработан, пропускаем")
+            return "already_processed"
+        
+        # Фильтруем сообщения
+        if not self._should_process_message(message):
+            logger.debug(f"Пост {message.id} не прошел фильтрацию, пропускаем")
+            return "filtered"
+        
+        # Отбрасываем почти-дубликаты постов, уже поставленных в очередь публикации;
+        # в индекс пост попадает только после постановки в очередь (remember_post)
+        if self.near_duplicates is not None:
+            match = self.near_duplicates.check(message.text)
+            if match:
+                self._log_near_duplicate(message.id, match)
+                self._mark_post_as_processed(chat_id, message.id)
+                return "near_duplicate"
+        
+        return None
+    
+    def remember_post(self, channel_id: int, post_id: int, text: str) -> Optional[NearDuplicateMatch]:
+        """Запоминает пост перед постановкой в очередь; если похожий пост попал в очередь раньше, возвращает его"""
+        if self.near_duplicates is None:
+            return None
+        
+        # Пока пост переписывался, в очередь мог попасть его почти-дубликат из другого канала
+        match = self.near_duplicates.check_and_add(f"{channel_id}:{post_id}", text)
+        if match:
+            self._log_near_duplicate(post_id, match)
+            POSTS_DROPPED.labels("near_duplicate").inc()
+        return match
+    
+    def forget_post(self, channel_id: int, post_id: int):
+        """Убирает пост, который так и не был опубликован, из индекса почти-дубликатов"""
+        if self.near_duplicates is not None:
+            self.near_duplicates.discard(f"{channel_id}:{post_id}")
+    
+    def _log_near_duplicate(self, post_id: int, match: NearDuplicateMatch):
+        logger.info(f"Пост {post_id} почти совпадает с {match.key} (сходство {match.similarity:.2f}), пропускаем")
+        self.stats["near_duplicates_dropped"] += 1
+    
     def _should_process_message(self, message: Message) -> bool:
         """Проверяет, стоит ли обрабатывать сообщение"""
         # Пропускаем сообщения без текста
@@ -178,8 +308,9 @@ class ChannelMonitor:
         logger.debug(f"Пост {message.id}: прошел все фильтры")
         return True
     
-    async def _extract_post_data(self, message: Message, channel_id: int) -> Dict:
-        """Извлекает данные из поста"""
+    async def _extract_post_data(self, message: Message, channel_id: int,
+                                 album: Optional[List[Message]] = None) -> Dict:
+        """Извлекает данные из поста (album - все сообщения альбома, включая message)"""
         # Извлекаем информацию о медиа
         media_type = None
         media_file_id = None
@@ -188,19 +319,34 @@ class ChannelMonitor:
         if message.media:
             media_type, media_file_id, media_url = await self._extract_media_info(message)
         
+        # Альбом: медиа всех сообщений по порядку, тип - по первому медиа
+        media_group = None
+        if album:
+            media_group = [item.media for item in album if item.media]
+            if media_group and not media_type:
+                media_type, media_file_id, media_url = await self._extract_media_info(
+                    next(item for item in album if item.media)
+                )
+        
+        # Название и username берем из кэша, без запросов к Telegram на каждый пост
+        with timed("entity_lookup"):
+            metadata = await self.metadata_cache.get(channel_id)
+        
         return {
             "id": message.id,
             "text": message.text,
             "date": message.date,
             "channel_id": channel_id,
-            "channel_title": await self._get_channel_title(channel_id),
+            "channel_title": metadata.title,
             "has_media": bool(message.media),
             "media_type": media_type,
             "media_object": media_file_id,  # Здесь сохраняем медиа объект
             "media_url": media_url,
+            "media_group": media_group,
+            "album_message_ids": [item.id for item in album] if album else None,
             "views": message.views or 0,
             "forwards": message.forwards or 0,
-            "url": f"https://t.me/{await self._get_channel_username(channel_id)}/{message.id}" if await self._get_channel_username(channel_id) else None
+            "url": f"https://t.me/{metadata.username}/{message.id}" if metadata.username else None
         }
     
     async def _extract_media_info(self, message: Message) -> tuple:
@@ -236,7 +382,7 @@ class ChannelMonitor:
             except:
                 media_url = None
             
-            logger.info(f"Извлечено медиа: тип={media_type}")
+            logger.debug(f"Извлечено медиа: тип={media_type}")
             return media_type, message.media, media_url
             
         except Exception as e:
@@ -245,52 +391,22 @@ class ChannelMonitor:
     
     async def _get_channel_title(self, channel_id: int) -> str:
         """Получает название канала"""
-        try:
-            entity = await self.client.get_entity(channel_id)
-            return entity.title or f"Channel {channel_id}"
-        except:
-            return f"Channel {channel_id}"
+        metadata = await self.metadata_cache.get(channel_id)
+        return metadata.title
     
     async def _get_channel_username(self, channel_id: int) -> Optional[str]:
         """Получает username канала"""
-        try:
-            entity = await self.client.get_entity(channel_id)
-            return entity.username
-        except:
-            return None
+        metadata = await self.metadata_cache.get(channel_id)
+        return metadata.username
     
-    def _mark_post_as_processed(self, post_id: int):
+    def _mark_post_as_processed(self, channel_id: int, post_id: int):
         """Помечает пост как обработанный"""
-        self.processed_posts.add(post_id)
-        self._save_processed_posts()
-        self.stats["total_processed_posts"] = len(self.processed_posts)
+        self.processed_posts.add(channel_id, post_id)
+        self.stats["total_processed_posts"] += 1
     
-    def _load_processed_posts(self) -> Set[int]:
-        """Загружает список обработанных постов"""
-        try:
-            if self.processed_posts_file.exists():
-                with open(self.processed_posts_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    return set(data.get("processed_posts", []))
-        except Exception as e:
-            logger.error(f"Ошибка загрузки обработанных постов: {e}")
-        
-        return set()
-    
-    def _save_processed_posts(self):
-        """Сохраняет список обработанных постов"""
-        try:
-            data = {
-                "processed_posts": list(self.processed_posts),
-                "last_update": datetime.now().isoformat(),
-                "total_count": len(self.processed_posts)
-            }
-            
-            with open(self.processed_posts_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                
-        except Exception as e:
-            logger.error(f"Ошибка сохранения обработанных постов: {e}")
+    def close(self):
+        """Освобождение ресурсов монитора"""
+        self.processed_posts.close()
     
     async def get_recent_posts(self, channel_id: int, limit: int = 10) -> List[Dict]:
         """Получает последние посты из канала"""
@@ -307,11 +423,37 @@ class ChannelMonitor:
             logger.error(f"Ошибка получения постов из канала {channel_id}: {e}")
             return []
     
+    async def get_backfill_posts(self, limit_per_channel: int) -> List[Dict]:
+        """Необработанные исторические посты из всех каналов-источников"""
+        posts = []
+        for channel in self.config.SOURCE_CHANNELS:
+            try:
+                messages = [message async for message in self.client.iter_messages(channel, limit=limit_per_channel)]
+                for group in self._group_albums(messages):
+                    message = self._get_album_caption_message(group)
+                    if self.processed_posts.contains(message.chat_id, message.id, include_legacy=True):
+                        continue
+                    if self._should_process_message(message):
+                        album = group if len(group) > 1 else None
+                        posts.append(await self._extract_post_data(message, message.chat_id, album))
+            except Exception as e:
+                logger.error(f"Ошибка получения истории канала {channel}: {e}")
+        
+        # Старые посты публикуем первыми
+        posts.sort(key=lambda post: post["date"])
+        return posts
+    
+    def mark_post_processed(self, channel_id: int, post_id: int):
+        """Помечает пост, обработанный вне обработчика новых сообщений"""
+        self._mark_post_as_processed(channel_id, post_id)
+    
     def get_stats(self) -> Dict:
         """Возвращает статистику мониторинга"""
         return {
             **self.stats,
-            "processed_posts_count": len(self.processed_posts),
+            "processed_posts_count": self.stats["total_processed_posts"],
+            "metadata_cache": self.metadata_cache.get_stats(),
+            "near_duplicates": self.near_duplicates.get_stats() if self.near_duplicates else {},
             "monitored_channels": self.config.SOURCE_CHANNELS,
             "last_check_time": self.stats.get("last_check_time")
         }
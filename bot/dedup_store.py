@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище обработанных постов для дедупликации (SQLite в режиме WAL)
+"""
+
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from loguru import logger
+
+# Посты из старого processed_posts.json хранились без канала; учитываются только для истории (backfill)
+LEGACY_CHANNEL_ID = 0
+
+
+class DedupStore:
+    """Обработанные посты по ключу (channel_id, message_id) с горячим набором в памяти"""
+
+    def __init__(self, db_path: Path = Path("data/processed_posts.db"),
+                 retention_days: float = 30, hot_size: int = 10000,
+                 legacy_json: Optional[Path] = Path("data/processed_posts.json")):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True)
+        self.retention_seconds = retention_days * 86400
+        self.hot_size = max(1, int(hot_size))
+
+        # Горячий набор последних ключей (LRU), чтобы не ходить в SQLite на каждый пост
+        self._hot: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self._adds_since_prune = 0
+
+        self._conn = sqlite3.connect(str(self.db_path), isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_posts ("
+            "channel_id INTEGER NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "processed_at REAL NOT NULL, "
+            "PRIMARY KEY (channel_id, message_id)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_at ON processed_posts (processed_at)"
+        )
+
+        if legacy_json is not None:
+            self._migrate_legacy_json(Path(legacy_json))
+
+        self.prune()
+
+    def contains(self, channel_id: int, message_id: int, include_legacy: bool = False) -> bool:
+        """Проверяет, обрабатывался ли пост; include_legacy - также id из старого формата без канала"""
+        key = (int(channel_id), int(message_id))
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            return True
+
+        row = self._conn.execute(
+            "SELECT 1 FROM processed_posts WHERE channel_id = ? AND message_id = ? AND processed_at >= ?",
+            (key[0], key[1], self._cutoff())
+        ).fetchone()
+        if row:
+            self._remember(key)
+            return True
+
+        # id сообщений уникальны только внутри канала: старые записи без канала совпадали бы
+        # с новыми постами других источников, поэтому они проверяются только для истории
+        if include_legacy:
+            row = self._conn.execute(
+                "SELECT 1 FROM processed_posts WHERE channel_id = ? AND message_id = ? AND processed_at >= ?",
+                (LEGACY_CHANNEL_ID, key[1], self._cutoff())
+            ).fetchone()
+            return row is not None
+        return False
+
+    def add(self, channel_id: int, message_id: int):
+        """Помечает пост как обработанный"""
+        key = (int(channel_id), int(message_id))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO processed_posts (channel_id, message_id, processed_at) VALUES (?, ?, ?)",
+            (key[0], key[1], time.time())
+        )
+        self._remember(key)
+
+        # Периодически удаляем записи старше окна хранения
+        self._adds_since_prune += 1
+        if self._adds_since_prune >= 1000:
+            self.prune()
+
+    def prune(self) -> int:
+        """Удаляет записи старше окна хранения"""
+        self._adds_since_prune = 0
+        cursor = self._conn.execute(
+            "DELETE FROM processed_posts WHERE processed_at < ?", (self._cutoff(),)
+        )
+        if cursor.rowcount:
+            logger.info(f"Удалено {cursor.rowcount} устаревших записей об обработанных постах")
+        return cursor.rowcount
+
+    def count(self) -> int:
+        """Количество обработанных постов в окне хранения"""
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM processed_posts WHERE processed_at >= ?", (self._cutoff(),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        """Закрытие базы"""
+        try:
+            self._conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка закрытия хранилища обработанных постов: {e}")
+
+    def _remember(self, key: Tuple[int, int]):
+        self._hot[key] = None
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    def _cutoff(self) -> float:
+        return time.time() - self.retention_seconds
+
+    def _migrate_legacy_json(self, legacy_json: Path):
+        """Переносит старый processed_posts.json в SQLite (один раз)"""
+        if not legacy_json.exists():
+            return
+
+        try:
+            with open(legacy_json, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+
+            post_ids = data.get("processed_posts", [])
+            now = time.time()
+            # В старом формате не было канала: записи учитываются только при
+            # переписывании истории (NewMessage старые id не присылает)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO processed_posts (channel_id, message_id, processed_at) VALUES (?, ?, ?)",
+                [(LEGACY_CHANNEL_ID, int(post_id), now) for post_id in post_ids]
+            )
+
+            legacy_json.rename(legacy_json.with_suffix(".json.migrated"))
+            logger.info(f"Перенесено {len(post_ids)} обработанных постов из {legacy_json} в {self.db_path}")
+        except Exception as e:
+            logger.error(f"Ошибка миграции {legacy_json}: {e}")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Учет FloodWait по методу и получателю: вызов откладывается, а не ждет внутри воркера
+"""
+
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from telethon.errors import FloodWaitError
+
+from loguru import logger
+
+from utils.metrics import FLOODWAIT_BUCKETS, REGISTRY
+
+FLOODWAIT_SECONDS = REGISTRY.histogram(
+    "rewirater_floodwait_seconds", "Ожидания FloodWait, запрошенные Telegram",
+    ["method", "destination"], buckets=FLOODWAIT_BUCKETS
+)
+FLOODWAIT_DEFERRED = REGISTRY.counter(
+    "rewirater_floodwait_deferred_total", "Вызовы, отложенные из-за FloodWait", ["method", "destination"]
+)
+
+
+class FloodWaitDeferred(Exception):
+    """Вызов не выполнен из-за FloodWait; повторить не раньше retry_at (unix time)"""
+
+    def __init__(self, method: str, destination: str, retry_at: float):
+        self.method = method
+        self.destination = destination
+        self.retry_at = retry_at
+        super().__init__(f"FloodWait для {method} -> {destination} до {retry_at:.0f}")
+
+
+class FloodWaitTracker:
+    """Запреты Telegram по паре (метод, получатель); пока запрет действует, вызовы сразу откладываются"""
+
+    def __init__(self):
+        self._until: Dict[Tuple[str, str], float] = {}
+        # получатель -> метод -> {count, total_seconds, max_seconds, deferred}
+        self.stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def blocked_until(self, method: str, destination: str) -> float:
+        """Момент окончания запрета (0, если запрета нет)"""
+        until = self._until.get((method, destination), 0.0)
+        if until and until <= time.time():
+            del self._until[(method, destination)]
+            return 0.0
+        return until
+
+    def record(self, method: str, destination: str, seconds: float) -> float:
+        """Запоминает FloodWait, возвращает момент, когда вызов можно повторить"""
+        until = time.time() + seconds
+        key = (method, destination)
+        self._until[key] = max(self._until.get(key, 0.0), until)
+
+        entry = self._entry(method, destination)
+        entry["count"] += 1
+        entry["total_seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        FLOODWAIT_SECONDS.labels(method, destination).observe(seconds)
+        logger.warning(f"FloodWait {seconds}с: {method} -> {destination}")
+        return self._until[key]
+
+    def check(self, method: str, destination: str):
+        """Бросает FloodWaitDeferred, если запрет для получателя еще действует"""
+        until = self.blocked_until(method, destination)
+        if until:
+            self._defer(method, destination, until)
+
+    async def call(self, method: str, destination: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет запрос или бросает FloodWaitDeferred, если получатель под запретом"""
+        self.check(method, destination)
+        try:
+            return await request()
+        except FloodWaitError as e:
+            self._defer(method, destination, self.record(method, destination, e.seconds))
+
+    def _defer(self, method: str, destination: str, until: float):
+        self._entry(method, destination)["deferred"] += 1
+        FLOODWAIT_DEFERRED.labels(method, destination).inc()
+        raise FloodWaitDeferred(method, destination, until)
+
+    def _entry(self, method: str, destination: str) -> Dict[str, float]:
+        return self.stats.setdefault(destination, {}).setdefault(
+            method, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "deferred": 0}
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "active": {
+                f"{method}:{destination}": round(until - now)
+                for (method, destination), until in self._until.items() if until > now
+            },
+            "by_destination": self.stats
+        }
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэш медиа для публикации: файлы на диске по id фото/документа, однократная загрузка в Telegram
+"""
+
+import asyncio
+import mimetypes
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.tl.types import DocumentAttributeFilename, InputMediaUploadedDocument, InputMediaUploadedPhoto
+
+from loguru import logger
+
+from utils.metrics import REGISTRY, timed
+
+MEDIA_CACHE_REQUESTS = REGISTRY.counter(
+    "rewirater_media_cache_requests_total",
+    "Подготовка медиа к отправке: upload_hit - без передачи, disk_hit - загрузка с диска, miss - скачивание",
+    ["result"]
+)
+MEDIA_CACHE_BYTES = REGISTRY.gauge(
+    "rewirater_media_cache_bytes", "Размер кэша медиа на диске"
+)
+MEDIA_CACHE_EVICTIONS = REGISTRY.counter(
+    "rewirater_media_cache_evictions_total", "Файлы, вытесненные из кэша медиа по размеру"
+)
+MEDIA_DOWNLOADED_BYTES = REGISTRY.counter(
+    "rewirater_media_downloaded_bytes_total", "Скачано байт медиа из каналов-источников"
+)
+
+# Размер одного запроса upload.getFile: максимум Telegram, кратен 4 КБ и делит 1 МБ
+REQUEST_SIZE = 512 * 1024
+
+
+def media_key(media) -> Optional[str]:
+    """Ключ кэша: тип, id и access hash фото или документа; None, если медиа не файл"""
+    photo = getattr(media, 'photo', None)
+    if photo is not None and getattr(photo, 'access_hash', None) is not None:
+        return f"photo_{photo.id}_{photo.access_hash}"
+
+    document = getattr(media, 'document', None)
+    if document is not None and getattr(document, 'access_hash', None) is not None:
+        return f"document_{document.id}_{document.access_hash}"
+
+    return None
+
+
+class MediaCache:
+    """Файлы медиа на диске с вытеснением по размеру (LRU) и переиспользуемые загрузки в Telegram"""
+
+    def __init__(self, client: TelegramClient, cache_dir: Path = Path("data/media_cache"),
+                 max_bytes: int = 512 * 1024 * 1024, max_file_bytes: int = 64 * 1024 * 1024,
+                 parallel_parts: int = 4, upload_ttl: float = 6 * 3600, max_uploads: int = 1000,
+                 pinned: Optional[Callable[[], Iterable[str]]] = None):
+        self.client = client
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max(1, int(max_bytes))
+        self.max_file_bytes = min(max(1, int(max_file_bytes)), self.max_bytes)
+        self.parallel_parts = max(1, int(parallel_parts))
+        self.upload_ttl = upload_ttl
+        self.max_uploads = max(1, int(max_uploads))
+        # Пути файлов, которые нельзя вытеснять (предзагруженные медиа постов в очереди)
+        self.pinned = pinned
+
+        # Ключ -> (медиа для send_file без повторной передачи файла, время получения)
+        self._uploads: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        # Скачивания и загрузки в процессе: один и тот же файл не передается параллельно дважды
+        self._downloads: Dict[str, asyncio.Future] = {}
+        self._preparing: Dict[str, asyncio.Future] = {}
+
+        self.stats = {"upload_hits": 0, "disk_hits": 0, "misses": 0, "skipped": 0, "errors": 0,
+                      "evictions": 0, "downloaded_bytes": 0}
+
+        self._conn = sqlite3.connect(str(self.cache_dir / "index.db"), isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_cache ("
+            "key TEXT PRIMARY KEY, "
+            "file_name TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_cache_accessed ON media_cache (accessed_at)"
+        )
+        self._total_bytes = 0
+        self._check_index()
+        MEDIA_CACHE_BYTES.set_function(lambda: self._total_bytes)
+
+    async def prepare(self, media) -> Any:
+        """Медиа для send_file: сохраненная загрузка, загрузка файла из кэша или исходный объект"""
+        key = media_key(media)
+        if key is None:
+            self.stats["skipped"] += 1
+            MEDIA_CACHE_REQUESTS.labels("skipped").inc()
+            return media
+
+        uploaded = self._get_upload(key)
+        if uploaded is not None:
+            self.stats["upload_hits"] += 1
+            MEDIA_CACHE_REQUESTS.labels("upload_hit").inc()
+            return uploaded
+
+        future = self._preparing.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._prepare(key, media))
+            self._preparing[key] = future
+            future.add_done_callback(lambda _: self._preparing.pop(key, None))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            MEDIA_CACHE_REQUESTS.labels("error").inc()
+            logger.warning(f"Не удалось подготовить медиа {key} через кэш, отправляем исходный объект: {e}")
+            return media
+
+    async def prepare_many(self, media_items: List[Any]) -> List[Any]:
+        """Подготовка альбома: элементы скачиваются и загружаются параллельно"""
+        return list(await asyncio.gather(*(self.prepare(media) for media in media_items)))
+
+    async def fetch(self, media) -> Optional[Path]:
+        """Локальный файл медиа: из кэша или скачанный; None, если медиа не кэшируется"""
+        key = media_key(media)
+        if key is None:
+            return None
+
+        path = self._lookup(key)
+        if path is not None:
+            return path
+
+        future = self._downloads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._download(key, media))
+            self._downloads[key] = future
+            future.add_done_callback(lambda _: self._downloads.pop(key, None))
+        return await asyncio.shield(future)
+
+    def remember_sent(self, media, sent_media):
+        """Медиа из отправленного сообщения: следующие отправки ссылаются на файл на сервере"""
+        key = media_key(media)
+        if key is not None and sent_media is not None and media_key(sent_media) is not None:
+            self._put_upload(key, sent_media)
+
+    def invalidate(self, media):
+        """Забывает загрузку (например, после FILE_PART_MISSING); файл на диске остается"""
+        key = media_key(media)
+        if key is not None:
+            self._uploads.pop(key, None)
+
+    async def _prepare(self, key: str, media) -> Any:
+        path = self._lookup(key)
+        if path is not None:
+            self.stats["disk_hits"] += 1
+            MEDIA_CACHE_REQUESTS.labels("disk_hit").inc()
+        else:
+            path = await self.fetch(media)
+            if path is None:
+                # Слишком большой файл: без кэша, Telegram скопирует его по ссылке
+                self.stats["skipped"] += 1
+                MEDIA_CACHE_REQUESTS.labels("skipped").inc()
+                return media
+            self.stats["misses"] += 1
+            MEDIA_CACHE_REQUESTS.labels("miss").inc()
+
+        with timed("media_upload"):
+            input_file = await self.client.upload_file(str(path), file_name=self._upload_name(key, media, path))
+
+        if key.startswith("photo_"):
+            uploaded = InputMediaUploadedPhoto(file=input_file)
+        else:
+            document = media.document
+            uploaded = InputMediaUploadedDocument(
+                file=input_file,
+                mime_type=document.mime_type or "application/octet-stream",
+                attributes=list(document.attributes or [])
+            )
+        self._put_upload(key, uploaded)
+        return uploaded
+
+    async def _download(self, key: str, media) -> Optional[Path]:
+        """Скачивание во временный файл и переименование; документы - параллельными частями"""
+        document = getattr(media, 'document', None) if key.startswith("document_") else None
+        size = getattr(document, 'size', None) if document is not None else None
+        if size and size > self.max_file_bytes:
+            logger.debug(f"Медиа {key} ({size} байт) больше лимита кэша")
+            return None
+
+        file_name = key + self._extension(key, media)
+        path = self.cache_dir / file_name
+        tmp_path = path.with_name(file_name + ".part")
+        try:
+            with timed("media_download"):
+                if document is not None and size:
+                    await self._download_parts(document, size, tmp_path)
+                else:
+                    await self.client.download_media(media, file=str(tmp_path))
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        size = path.stat().st_size
+        self.stats["downloaded_bytes"] += size
+        MEDIA_DOWNLOADED_BYTES.inc(size)
+        self._add(key, file_name, size)
+        return path
+
+    async def _download_parts(self, document, size: int, tmp_path: Path):
+        """Диапазоны файла скачиваются параллельно потоками iter_download и пишутся по своим смещениям"""
+        chunks = -(-size // REQUEST_SIZE)
+        chunks_per_part = -(-chunks // self.parallel_parts)
+
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+
+        async def download_part(first_chunk: int):
+            offset = first_chunk * REQUEST_SIZE
+            with open(tmp_path, "r+b") as f:
+                f.seek(offset)
+                async for chunk in self.client.iter_download(
+                    document, offset=offset, request_size=REQUEST_SIZE,
+                    limit=min(chunks_per_part, chunks - first_chunk), file_size=size
+                ):
+                    f.write(chunk)
+
+        await asyncio.gather(*(download_part(first) for first in range(0, chunks, chunks_per_part)))
+
+    def _lookup(self, key: str) -> Optional[Path]:
+        row = self._conn.execute("SELECT file_name FROM media_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        path = self.cache_dir / row[0]
+        if not path.exists():
+            self._remove(key)
+            return None
+
+        self._conn.execute("UPDATE media_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return path
+
+    def _add(self, key: str, file_name: str, size: int):
+        now = time.time()
+        self._remove(key)
+        self._conn.execute(
+            "INSERT INTO media_cache (key, file_name, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, file_name, size, now, now)
+        )
+        self._total_bytes += size
+        self._evict(keep=key)
+
+    def _remove(self, key: str):
+        row = self._conn.execute("SELECT size FROM media_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+            self._total_bytes -= row[0]
+
+    def _evict(self, keep: Optional[str] = None):
+        """Удаляет давно не использованные файлы, пока кэш больше лимита"""
+        if self._total_bytes <= self.max_bytes:
+            return
+
+        pinned = {Path(path).name for path in self.pinned()} if self.pinned else set()
+        rows = self._conn.execute(
+            "SELECT key, file_name, size FROM media_cache ORDER BY accessed_at"
+        ).fetchall()
+        for key, file_name, size in rows:
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key == keep or file_name in pinned:
+                continue
+            (self.cache_dir / file_name).unlink(missing_ok=True)
+            self._conn.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+            self._total_bytes -= size
+            self.stats["evictions"] += 1
+            MEDIA_CACHE_EVICTIONS.inc()
+
+    def _check_index(self):
+        """Сверка индекса с диском после перезапуска: недокачанные файлы и пропавшие записи"""
+        for tmp_path in self.cache_dir.glob("*.part"):
+            tmp_path.unlink(missing_ok=True)
+
+        for key, file_name in self._conn.execute("SELECT key, file_name FROM media_cache").fetchall():
+            if not (self.cache_dir / file_name).exists():
+                self._conn.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM media_cache").fetchone()[0]
+        self._evict()
+
+    def _get_upload(self, key: str) -> Optional[Any]:
+        entry = self._uploads.get(key)
+        if entry is None:
+            return None
+        uploaded, created_at = entry
+        if time.monotonic() - created_at > self.upload_ttl:
+            # Telegram хранит загруженные части ограниченное время
+            del self._uploads[key]
+            return None
+        self._uploads.move_to_end(key)
+        return uploaded
+
+    def _put_upload(self, key: str, uploaded):
+        self._uploads[key] = (uploaded, time.monotonic())
+        self._uploads.move_to_end(key)
+        while len(self._uploads) > self.max_uploads:
+            self._uploads.popitem(last=False)
+
+    @staticmethod
+    def _extension(key: str, media) -> str:
+        if key.startswith("photo_"):
+            return ".jpg"
+        document = media.document
+        for attribute in document.attributes or []:
+            if isinstance(attribute, DocumentAttributeFilename) and "." in attribute.file_name:
+                return os.path.splitext(attribute.file_name)[1][:16]
+        return mimetypes.guess_extension(document.mime_type or "") or ".bin"
+
+    @staticmethod
+    def _upload_name(key: str, media, path: Path) -> str:
+        """Имя файла для Telegram: исходное имя документа или имя из кэша"""
+        if key.startswith("document_"):
+            for attribute in media.document.attributes or []:
+                if isinstance(attribute, DocumentAttributeFilename):
+                    return attribute.file_name
+        return path.name
+
+    def get_stats(self) -> Dict[str, Any]:
+        files = self._conn.execute("SELECT COUNT(*) FROM media_cache").fetchone()[0]
+        return {
+            **self.stats,
+            "files": files,
+            "size_mb": round(self._total_bytes / 1024 / 1024, 1),
+            "max_size_mb": round(self.max_bytes / 1024 / 1024, 1),
+            "uploads": len(self._uploads)
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Планировщик публикаций: min-heap по времени публикации с сохранением в SQLite
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from ai.content_rewriter import RewrittenPost, SourcePost
+from utils.metrics import REGISTRY
+
+PUBLISH_QUEUE_SIZE = REGISTRY.gauge(
+    "rewirater_publish_queue_size", "Запланированных публикаций"
+)
+PUBLISH_LATENESS = REGISTRY.histogram(
+    "rewirater_publish_lateness_seconds", "Опоздание публикации относительно запланированного времени"
+)
+
+
+@dataclass
+class ScheduledJob:
+    """Запланированная публикация"""
+    job_id: str
+    publish_time: float
+    post: RewrittenPost
+    attempts: int = 0
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def publish_datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.publish_time)
+
+
+def serialize_post(post: RewrittenPost) -> Dict[str, Any]:
+    """RewrittenPost -> dict для JSON (медиа-объекты Telegram не сохраняются)"""
+    data = {f.name: getattr(post, f.name) for f in fields(RewrittenPost)}
+    data["original_post"] = {f.name: getattr(post.original_post, f.name) for f in fields(SourcePost)}
+    data["media_object"] = None
+    data["media_group"] = None
+    data["original_post"]["media_object"] = None
+    data["original_post"]["media_group"] = None
+    return data
+
+
+def deserialize_post(data: Dict[str, Any]) -> RewrittenPost:
+    """dict -> RewrittenPost"""
+    data = dict(data)
+    data["original_post"] = SourcePost(**data["original_post"])
+    return RewrittenPost(**data)
+
+
+class PublishScheduler:
+    """Очередь публикаций с пробуждением ровно к ближайшему дедлайну"""
+
+    def __init__(self, db_path: Optional[Path] = Path("data/publish_queue.db")):
+        # Куча (время, порядковый номер, job_id); отмененные записи пропускаются лениво
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._heap_seq: Dict[str, int] = {}
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self._conn = None
+        if db_path is not None:
+            db_path = Path(db_path)
+            db_path.parent.mkdir(exist_ok=True)
+            self._conn = sqlite3.connect(str(db_path), isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS publish_queue ("
+                "job_id TEXT PRIMARY KEY, "
+                "publish_time REAL NOT NULL, "
+                "payload TEXT NOT NULL)"
+            )
+            self._load()
+
+    def schedule(self, post: RewrittenPost, publish_time: datetime, job_id: Optional[str] = None,
+                 attempts: int = 0, meta: Optional[Dict[str, Any]] = None) -> str:
+        """Добавляет пост в очередь, возвращает ID задачи"""
+        job = ScheduledJob(
+            job_id=job_id or uuid.uuid4().hex,
+            publish_time=publish_time.timestamp(),
+            post=post,
+            attempts=attempts,
+            meta=meta or {}
+        )
+        self._push(job)
+        self._persist(job)
+        return job.job_id
+
+    def cancel(self, job_id: str) -> bool:
+        """Отменяет запланированную публикацию"""
+        job = self._jobs.pop(job_id, None)
+        self._heap_seq.pop(job_id, None)
+        if job is None:
+            return False
+
+        self._delete(job_id)
+        self._notify()
+        return True
+
+    def reschedule(self, job_id: str, publish_time: datetime) -> bool:
+        """Переносит публикацию на другое время"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+
+        job.publish_time = publish_time.timestamp()
+        self._push(job)
+        self._persist(job)
+        return True
+
+    def save_post(self, post: RewrittenPost) -> int:
+        """Сохраняет изменения поста во всех его задачах; возвращает число задач"""
+        jobs = [job for job in self._jobs.values() if job.post is post]
+        for job in jobs:
+            self._persist(job)
+        return len(jobs)
+
+    def get(self, job_id: str) -> Optional[ScheduledJob]:
+        """Возвращает задачу по ID"""
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[ScheduledJob]:
+        """Все задачи, отсортированные по времени публикации"""
+        return sorted(self._jobs.values(), key=lambda job: job.publish_time)
+
+    def clear(self):
+        """Удаляет все запланированные публикации"""
+        self._heap.clear()
+        self._jobs.clear()
+        self._heap_seq.clear()
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM publish_queue")
+        self._notify()
+
+    def next_deadline(self) -> Optional[datetime]:
+        """Время ближайшей публикации"""
+        job = self._peek()
+        return job.publish_datetime if job else None
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def run(self, handler: Callable[[ScheduledJob], Awaitable[None]]):
+        """Основной цикл: спит до ближайшего дедлайна и передает задачу обработчику"""
+        self._wakeup = asyncio.Event()
+        PUBLISH_QUEUE_SIZE.set_function(self.__len__)
+        logger.info(f"Планировщик публикаций запущен, в очереди: {len(self)}")
+
+        while True:
+            self._wakeup.clear()
+            job = self._peek()
+
+            if job is None:
+                await self._wakeup.wait()
+                continue
+
+            delay = job.publish_time - time.time()
+            if delay > 0:
+                # Просыпаемся к дедлайну или раньше, если очередь изменилась
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._pop(job.job_id)
+            PUBLISH_LATENESS.observe(-delay)
+            try:
+                await handler(job)
+            except asyncio.CancelledError:
+                # Остановка посреди публикации: задача остается в базе и в очереди, после перезапуска повторится
+                if job.job_id not in self._jobs:
+                    self._push(job)
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка публикации задачи {job.job_id}: {e}")
+
+            # Если обработчик перепланировал задачу, она снова в очереди
+            if job.job_id not in self._jobs:
+                self._delete(job.job_id)
+
+    def close(self):
+        """Закрытие базы очереди"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _push(self, job: ScheduledJob):
+        seq = next(self._counter)
+        self._jobs[job.job_id] = job
+        self._heap_seq[job.job_id] = seq
+        heapq.heappush(self._heap, (job.publish_time, seq, job.job_id))
+        self._notify()
+
+    def _peek(self) -> Optional[ScheduledJob]:
+        # Выкидываем с вершины устаревшие записи (отмененные или перенесенные)
+        while self._heap:
+            _, seq, job_id = self._heap[0]
+            if self._heap_seq.get(job_id) == seq:
+                return self._jobs[job_id]
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop(self, job_id: str):
+        heapq.heappop(self._heap)
+        self._jobs.pop(job_id, None)
+        self._heap_seq.pop(job_id, None)
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _persist(self, job: ScheduledJob):
+        if self._conn is None:
+            return
+        try:
+            payload = json.dumps({
+                "post": serialize_post(job.post),
+                "attempts": job.attempts,
+                "meta": job.meta
+            }, ensure_ascii=False, default=str)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO publish_queue (job_id, publish_time, payload) VALUES (?, ?, ?)",
+                (job.job_id, job.publish_time, payload)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения задачи публикации {job.job_id}: {e}")
+
+    def _delete(self, job_id: str):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute("DELETE FROM publish_queue WHERE job_id = ?", (job_id,))
+        except Exception as e:
+            logger.error(f"Ошибка удаления задачи публикации {job_id}: {e}")
+
+    def _load(self):
+        """Восстанавливает очередь после перезапуска"""
+        restored = 0
+        rows = self._conn.execute("SELECT job_id, publish_time, payload FROM publish_queue").fetchall()
+        for job_id, publish_time, payload in rows:
+            try:
+                data = json.loads(payload)
+                job = ScheduledJob(
+                    job_id=job_id,
+                    publish_time=publish_time,
+                    post=deserialize_post(data["post"]),
+                    attempts=data.get("attempts", 0),
+                    meta=data.get("meta", {})
+                )
+                self._push(job)
+                restored += 1
+            except Exception as e:
+                logger.error(f"Не удалось восстановить задачу публикации {job_id}: {e}")
+                self._delete(job_id)
+
+        if restored:
+            logger.info(f"Восстановлено {restored} запланированных публикаций")
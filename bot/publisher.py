@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Публикация одного поста в несколько целевых каналов и чатов с отдельными лимитами для каждого
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telethon.errors import ChatWriteForbiddenError
+
+from loguru import logger
+
+from bot.flood_wait import FloodWaitDeferred, FloodWaitTracker
+from utils.metrics import REGISTRY
+from utils.rate_limiter import TokenBucket
+
+POSTS_PUBLISHED = REGISTRY.counter(
+    "rewirater_posts_published_total", "Опубликованные посты", ["kind"]
+)
+PUBLISH_ERRORS = REGISTRY.counter(
+    "rewirater_publish_errors_total", "Ошибки публикации", ["reason"]
+)
+TARGET_DELIVERIES = REGISTRY.counter(
+    "rewirater_target_deliveries_total", "Результаты доставки поста в целевые каналы", ["target", "status"]
+)
+
+# Статусы доставки в один целевой канал
+PUBLISHED = "published"
+DEFERRED = "deferred"
+CAPPED = "capped"
+FAILED = "failed"
+
+# Причины отложенной доставки
+REASON_FLOOD_WAIT = "flood_wait"
+REASON_RATE_LIMIT = "rate_limit"
+
+
+@dataclass
+class PublishTarget:
+    """Целевой канал или чат со своим темпом и дневным лимитом (FloodWait - в FloodWaitTracker)"""
+    name: str
+    entity: Any
+    max_posts_per_day: int
+    bucket: Optional[TokenBucket] = None
+    posts_today: int = 0
+    day: date = field(default_factory=date.today)
+    stats: Dict[str, int] = field(default_factory=lambda: {PUBLISHED: 0, DEFERRED: 0, CAPPED: 0, FAILED: 0})
+
+    def published_today(self) -> int:
+        """Сколько постов опубликовано сегодня"""
+        if self.day != date.today():
+            # Новый день: счетчик сбрасывается без отдельной задачи в полночь
+            self.day = date.today()
+            self.posts_today = 0
+        return self.posts_today
+
+    def remaining_today(self) -> int:
+        """Сколько постов еще можно опубликовать сегодня"""
+        return max(0, self.max_posts_per_day - self.published_today())
+
+
+@dataclass
+class DeliveryResult:
+    """Результат доставки поста в один целевой канал"""
+    target: str
+    status: str
+    retry_at: Optional[float] = None  # unix time для отложенной доставки
+    reason: Optional[str] = None
+    error: Optional[str] = None
+
+
+def load_targets(config) -> List[PublishTarget]:
+    """Целевые каналы из PUBLISH_TARGETS; без настройки - один TARGET_CHANNEL с MAX_POSTS_PER_DAY"""
+    default_cap = getattr(config, 'MAX_POSTS_PER_DAY', 50)
+    entries = getattr(config, 'PUBLISH_TARGETS', None) or [{"entity": config.TARGET_CHANNEL}]
+
+    targets = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {"entity": entry}
+
+        # Темп канала: не чаще раза в min_interval_minutes, с запасом burst постов подряд
+        bucket = None
+        min_interval = float(entry.get("min_interval_minutes", 0)) * 60
+        name = str(entry.get("name") or entry["entity"])
+        if min_interval > 0:
+            bucket = TokenBucket(entry.get("burst", 1), 1 / min_interval, name=name)
+
+        targets.append(PublishTarget(
+            name=name,
+            entity=entry["entity"],
+            max_posts_per_day=int(entry.get("max_posts_per_day", default_cap)),
+            bucket=bucket
+        ))
+    return targets
+
+
+class FanoutPublisher:
+    """Отправляет пост во все целевые каналы параллельно; занятый канал откладывается, а не ждет"""
+
+    def __init__(self, targets: List[PublishTarget], send: Callable[[PublishTarget, Any], Awaitable[None]],
+                 flood_waits: Optional[FloodWaitTracker] = None):
+        self.targets = targets
+        self.send = send
+        self.flood_waits = flood_waits or FloodWaitTracker()
+        self._by_name = {target.name: target for target in targets}
+
+    def get(self, name: str) -> Optional[PublishTarget]:
+        return self._by_name.get(name)
+
+    async def publish(self, post, target_names: Optional[List[str]] = None) -> List[DeliveryResult]:
+        """Доставка во все (или перечисленные) целевые каналы; FloodWait одного канала не задерживает остальные"""
+        if target_names is None:
+            targets = self.targets
+        else:
+            targets = [self._by_name[name] for name in target_names if name in self._by_name]
+        return list(await asyncio.gather(*(self._deliver(target, post) for target in targets)))
+
+    async def _deliver(self, target: PublishTarget, post) -> DeliveryResult:
+        if target.remaining_today() <= 0:
+            logger.info(f"Дневной лимит {target.max_posts_per_day} постов в {target.name} исчерпан")
+            return self._result(target, CAPPED)
+
+        try:
+            # Канал под FloodWait откладывается сразу, не тратя токен темпа
+            self.flood_waits.check("publish", target.name)
+
+            if target.bucket is not None and not target.bucket.try_acquire():
+                retry_at = time.time() + target.bucket.time_until_available()
+                return self._result(target, DEFERRED, retry_at=retry_at, reason=REASON_RATE_LIMIT)
+
+            try:
+                await self.flood_waits.call("publish", target.name, lambda: self.send(target, post))
+            except BaseException:
+                # Пост не опубликован: токен темпа возвращается, следующий пост не ждет лишний интервал
+                if target.bucket is not None:
+                    target.bucket.refund()
+                raise
+        except FloodWaitDeferred as e:
+            PUBLISH_ERRORS.labels("flood_wait").inc()
+            return self._result(target, DEFERRED, retry_at=e.retry_at, reason=REASON_FLOOD_WAIT)
+        except ChatWriteForbiddenError:
+            logger.error(f"Нет прав на запись в {target.name}")
+            PUBLISH_ERRORS.labels("write_forbidden").inc()
+            return self._result(target, FAILED, error="write_forbidden")
+        except Exception as e:
+            logger.error(f"Ошибка публикации в {target.name}: {e}")
+            PUBLISH_ERRORS.labels("error").inc()
+            return self._result(target, FAILED, error=str(e))
+
+        target.posts_today += 1
+        return self._result(target, PUBLISHED)
+
+    @staticmethod
+    def _result(target: PublishTarget, status: str, retry_at: Optional[float] = None,
+                reason: Optional[str] = None, error: Optional[str] = None) -> DeliveryResult:
+        target.stats[status] += 1
+        TARGET_DELIVERIES.labels(target.name, status).inc()
+        return DeliveryResult(target=target.name, status=status, retry_at=retry_at, reason=reason, error=error)
+
+    def has_capacity(self, queued: Dict[str, int]) -> bool:
+        """Есть ли канал, куда сегодня поместится еще один пост с учетом очереди"""
+        return any(target.remaining_today() - queued.get(target.name, 0) > 0 for target in self.targets)
+
+    def posts_today(self) -> int:
+        """Публикаций за сегодня в самом загруженном канале"""
+        return max((target.published_today() for target in self.targets), default=0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            target.name: {
+                **target.stats,
+                "posts_today": target.published_today(),
+                "max_posts_per_day": target.max_posts_per_day,
+                "flood_wait_left": round(max(0.0, self.flood_waits.blocked_until("publish", target.name) - now)),
+                "bucket": target.bucket.get_stats() if target.bucket else None
+            }
+            for target in self.targets
+        }
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Пул воркеров переписывания: ограниченная очередь между монитором каналов и AI
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from utils.metrics import REGISTRY, STAGE_SECONDS
+
+REWRITE_QUEUE_DEPTH = REGISTRY.gauge(
+    "rewirater_rewrite_queue_depth", "Постов в очереди на переписывание"
+)
+
+
+class RewriteWorkerPool:
+    """Ограниченная очередь входящих постов с несколькими воркерами переписывания"""
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int = 4, queue_size: int = 100):
+        self.handler = handler
+        self.workers_count = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+
+        # Очередь создается в start(), чтобы она была привязана к рабочему event loop
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+        # Статистика по каждому воркеру
+        self.worker_stats: Dict[int, Dict[str, Any]] = {
+            worker_id: {
+                "processed": 0,
+                "errors": 0,
+                "last_latency": None,
+                "avg_latency": None,
+                "max_latency": 0.0,
+                "last_wait_time": None,
+                "queue_depth": 0
+            }
+            for worker_id in range(self.workers_count)
+        }
+        self.submitted = 0
+        self.max_queue_depth = 0
+
+    async def start(self):
+        """Запуск воркеров"""
+        if self._workers:
+            return
+
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        REWRITE_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self._workers = [
+            asyncio.create_task(self._worker(worker_id))
+            for worker_id in range(self.workers_count)
+        ]
+        logger.info(f"Пул переписывания запущен: воркеров={self.workers_count}, размер очереди={self.queue_size}")
+
+    async def submit(self, item: Any):
+        """Ставит пост в очередь; при заполненной очереди ждет освобождения места"""
+        if self.queue is None:
+            raise RuntimeError("Пул переписывания не запущен")
+
+        if self.queue.full():
+            logger.warning(f"Очередь переписывания заполнена ({self.queue_size}), ожидаем освобождения места")
+
+        await self.queue.put((item, time.monotonic()))
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    async def _worker(self, worker_id: int):
+        """Воркер: берет посты из очереди и передает их обработчику"""
+        stats = self.worker_stats[worker_id]
+
+        while True:
+            item, enqueued_at = await self.queue.get()
+            started_at = time.monotonic()
+            stats["last_wait_time"] = started_at - enqueued_at
+            STAGE_SECONDS.labels("rewrite_queue_wait").observe(stats["last_wait_time"])
+
+            try:
+                await self.handler(item)
+            except Exception as e:
+                stats["errors"] += 1
+                logger.error(f"Воркер переписывания #{worker_id}: ошибка обработки: {e}")
+            finally:
+                latency = time.monotonic() - started_at
+                stats["processed"] += 1
+                stats["last_latency"] = latency
+                stats["max_latency"] = max(stats["max_latency"], latency)
+                if stats["avg_latency"] is None:
+                    stats["avg_latency"] = latency
+                else:
+                    # Скользящее среднее, чтобы не хранить историю
+                    stats["avg_latency"] = stats["avg_latency"] * 0.9 + latency * 0.1
+                stats["queue_depth"] = self.queue.qsize()
+                self.queue.task_done()
+
+                logger.debug(
+                    f"Воркер #{worker_id}: пост обработан за {latency:.2f}с "
+                    f"(ожидание в очереди {stats['last_wait_time']:.2f}с, в очереди: {stats['queue_depth']})"
+                )
+
+    async def join(self):
+        """Ожидает обработки всех постов из очереди"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self):
+        """Остановка воркеров"""
+        for task in self._workers:
+            task.cancel()
+
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+        self._workers = []
+        logger.info("Пул переписывания остановлен")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика очереди и воркеров"""
+        return {
+            "workers": self.workers_count,
+            "queue_size": self.queue_size,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "submitted": self.submitted,
+            "worker_stats": {worker_id: dict(stats) for worker_id, stats in self.worker_stats.items()}
+        }
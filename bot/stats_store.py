@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище статистики бота: изменения в памяти, запись на диск пачками из фонового потока
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator
+
+from loguru import logger
+
+from utils.metrics import REGISTRY
+
+STATS_FLUSHES = REGISTRY.counter(
+    "rewirater_stats_flushes_total", "Записи статистики на диск", ["result"]
+)
+
+
+class StatsStore:
+    """Словарь статистики с отметкой изменений; на диск - по таймеру или после N изменений, атомарно"""
+
+    def __init__(self, path: Path = Path("data/stats.json"), flush_interval: float = 5.0, flush_every: int = 20):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.flush_every = max(1, int(flush_every))
+
+        self.data: Dict[str, Any] = self._load()
+
+        # Блокировка защищает data от сериализации посреди изменения
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pending = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stats-flush", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def update(self) -> Iterator[Dict[str, Any]]:
+        """Изменение статистики: with store.update() as stats: stats["x"] = ..."""
+        with self._lock:
+            yield self.data
+            self._dirty = True
+            self._pending += 1
+            pending = self._pending
+        if pending >= self.flush_every:
+            self._wakeup.set()
+
+    def flush(self) -> bool:
+        """Записывает статистику, если она менялась с прошлой записи"""
+        with self._lock:
+            if not self._dirty:
+                return True
+            try:
+                payload = json.dumps(self.data, ensure_ascii=False, indent=2)
+            except Exception as e:
+                logger.error(f"Ошибка сериализации статистики: {e}")
+                STATS_FLUSHES.labels("error").inc()
+                return False
+            self._dirty = False
+            self._pending = 0
+
+        try:
+            # Временный файл рядом и переименование: при падении на диске остается прежняя версия
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            STATS_FLUSHES.labels("ok").inc()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики: {e}")
+            STATS_FLUSHES.labels("error").inc()
+            with self._lock:
+                self._dirty = True
+            return False
+
+    def close(self):
+        """Останавливает фоновый поток и записывает последние изменения"""
+        if self._thread.is_alive():
+            self._stopped.set()
+            self._wakeup.set()
+            self._thread.join(10)
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _load(self) -> Dict[str, Any]:
+        """Загрузка статистики из файла"""
+        try:
+            if self.path.exists():
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки статистики: {e}")
+
+        return {}
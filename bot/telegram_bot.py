@@ -6,17 +6,27 @@ Telegram User Bot для мониторинга каналов и публика
 
 import asyncio
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
-import json
+from typing import Optional, Dict, Any, List
 from pathlib import Path
 
 from telethon import TelegramClient, events
-from telethon.errors import FloodWaitError, ChatWriteForbiddenError
+from telethon.errors import FloodWaitError
 from telethon.tl.types import PeerChannel
 
 from loguru import logger
 from bot.channel_monitor import ChannelMonitor
+from bot.rewrite_pool import RewriteWorkerPool
+from bot.publish_scheduler import PublishScheduler, ScheduledJob
+from bot.stats_store import StatsStore
+from bot.media_cache import MediaCache
+from bot.flood_wait import FloodWaitDeferred, FloodWaitTracker
+from bot.publisher import (
+    DEFERRED, PUBLISHED, POSTS_PUBLISHED, PUBLISH_ERRORS, REASON_FLOOD_WAIT, FanoutPublisher, load_targets
+)
 from ai.content_rewriter import ContentRewriter, SourcePost
+from ai.batch_backfill import BatchBackfill, create_batch_backend
+from utils.loop_watchdog import LoopWatchdog
+from utils.metrics import MetricsServer, set_span_attributes, setup_tracing, shutdown_tracing, timed
 
 class TelegramUserBot:
     """Telegram User Bot для мониторинга и публикации переработанного контента"""
@@ -27,27 +37,82 @@ class TelegramUserBot:
         self.client = None
         self.channel_monitor = None
         self.stats_file = Path("data/stats.json")
-        self.stats_file.parent.mkdir(exist_ok=True)
         
-        # Статистика
-        self.stats = self._load_stats()
+        # Статистика: меняется в памяти, на диск пишется фоновым потоком
+        self.stats_store = StatsStore(
+            self.stats_file,
+            flush_interval=getattr(self.config, 'STATS_FLUSH_SECONDS', 5.0),
+            flush_every=getattr(self.config, 'STATS_FLUSH_EVERY', 20)
+        )
+        self.stats = self.stats_store.data
         
         # Настройки публикации
         self.last_post_time = None
-        self.posts_today = 0
         
-        # Система очереди постов с таймингом
-        self.post_queue = []
+        # Очередь постов с таймингом (переживает перезапуск)
+        self.scheduler = PublishScheduler()
         self.publish_task = None
         
+        # FloodWait не пережидается в воркере: вызов откладывается до конца запрета
+        self.flood_waits = FloodWaitTracker()
+        self.publish_max_attempts = getattr(self.config, 'PUBLISH_MAX_ATTEMPTS', 10)
+        self.dm_max_attempts = getattr(self.config, 'DM_MAX_ATTEMPTS', 5)
+        self._dm_retry_tasks = set()
+        # Скачивание медиа постов, уже стоящих в очереди
+        self._prefetch_tasks = set()
+        
+        # Целевые каналы: у каждого свой темп, дневной лимит и FloodWait
+        self.publisher = FanoutPublisher(load_targets(self.config), self._send_to_target, self.flood_waits)
+        
+        # Пул воркеров переписывания (очередь между монитором и AI)
+        self.rewrite_pool = RewriteWorkerPool(
+            self._process_new_post,
+            workers=getattr(self.config, 'REWRITE_WORKERS', 4),
+            queue_size=getattr(self.config, 'REWRITE_QUEUE_SIZE', 100)
+        )
+        
+        # Пакетное переписывание истории каналов (Batch API, вне realtime-потока);
+        # без Batch API (AI_PROVIDERS, локальная LLM) история переписывается обычными запросами
+        self.backfill = None
+        batch_backend = create_batch_backend(self.config, content_rewriter)
+        if batch_backend is not None:
+            self.backfill = BatchBackfill(
+                content_rewriter,
+                batch_backend,
+                poll_interval=getattr(self.config, 'BACKFILL_POLL_SECONDS', 60)
+            )
+        self.backfill_task = None
+        
+        # Кэш медиа (создается после подключения клиента)
+        self.media_cache = None
+        
+        # Эндпоинт /metrics и (по настройке) экспорт спанов OpenTelemetry
+        self.metrics_server = None
+        
+        # Сторож event loop: задержки и зависания (синхронный код в обработчиках)
+        self.loop_watchdog = None
+        if getattr(self.config, 'LOOP_WATCHDOG_ENABLED', True):
+            self.loop_watchdog = LoopWatchdog(
+                threshold=getattr(self.config, 'LOOP_SLOW_CALLBACK_SECONDS', 0.25),
+                interval=getattr(self.config, 'LOOP_LAG_INTERVAL_SECONDS', 0.1),
+                asyncio_debug=getattr(self.config, 'ASYNCIO_DEBUG', False),
+                dump_path=Path(getattr(self.config, 'LOOP_WATCHDOG_DUMP', 'data/loop_watchdog.json')),
+                ring_size=getattr(self.config, 'LOOP_WATCHDOG_RING_SIZE', 50)
+            )
+        
     async def start(self):
         """Запуск бота"""
         try:
+            self._start_observability()
+            
             # Создаем клиент
+            # Telethon сам спит на FloodWait короче порога (по умолчанию 60с), блокируя публикацию;
+            # длинные ожидания обрабатывает FloodWaitTracker
             self.client = TelegramClient(
                 self.config.SESSION_NAME,
                 self.config.API_ID,
-                self.config.API_HASH
+                self.config.API_HASH,
+                flood_sleep_threshold=getattr(self.config, 'FLOOD_SLEEP_THRESHOLD', 5)
             )
             
             # Пытаемся запустить с существующей сессией
@@ -70,11 +135,34 @@ class TelegramUserBot:
             me = await self.client.get_me()
             logger.info(f"Подключен как: {me.first_name} (@{me.username})")
             
-            # Инициализируем монитор каналов
+            # Медиа публикуются из своего кэша: работает и для каналов с запретом пересылки
+            if getattr(self.config, 'MEDIA_CACHE_ENABLED', True):
+                self.media_cache = MediaCache(
+                    self.client,
+                    cache_dir=Path(getattr(self.config, 'MEDIA_CACHE_DIR', 'data/media_cache')),
+                    max_bytes=int(getattr(self.config, 'MEDIA_CACHE_MAX_MB', 512) * 1024 * 1024),
+                    max_file_bytes=int(getattr(self.config, 'MEDIA_CACHE_MAX_FILE_MB', 64) * 1024 * 1024),
+                    parallel_parts=getattr(self.config, 'MEDIA_DOWNLOAD_PARALLEL_PARTS', 4),
+                    upload_ttl=getattr(self.config, 'MEDIA_UPLOAD_TTL_SECONDS', 6 * 3600),
+                    pinned=self._queued_media_files
+                )
+            
+            # Запускаем планировщик публикаций (включая посты, восстановленные после перезапуска)
+            self.publish_task = asyncio.create_task(self.scheduler.run(self._publish_scheduled_job))
+            
+            # Запускаем воркеров переписывания
+            await self.rewrite_pool.start()
+            
+            # Инициализируем монитор каналов: новые посты попадают в очередь пула
             self.channel_monitor = ChannelMonitor(self.config, self.client)
-            self.channel_monitor.set_post_processor(self._process_new_post)
+            self.channel_monitor.set_post_processor(self.rewrite_pool.submit)
             logger.info("Монитор каналов инициализирован")
             
+            # Пакеты, отправленные до перезапуска, и (по настройке) переписывание истории каналов
+            self.backfill_task = asyncio.create_task(
+                self.run_backfill(getattr(self.config, 'BACKFILL_POSTS_PER_CHANNEL', 0))
+            )
+            
             
             # Запускаем мониторинг каналов (включает основной цикл)
             logger.info("Запускаем мониторинг каналов...")
@@ -85,11 +173,30 @@ class TelegramUserBot:
             raise
     
     
+    def _start_observability(self):
+        """Запуск эндпоинта метрик, экспорта спанов и сторожа event loop"""
+        if getattr(self.config, 'METRICS_ENABLED', True) and self.metrics_server is None:
+            self.metrics_server = MetricsServer(
+                host=getattr(self.config, 'METRICS_HOST', '127.0.0.1'),
+                port=getattr(self.config, 'METRICS_PORT', 9108)
+            )
+            if not self.metrics_server.start():
+                self.metrics_server = None
+        
+        if getattr(self.config, 'OTEL_ENABLED', False):
+            setup_tracing(
+                service_name=getattr(self.config, 'OTEL_SERVICE_NAME', 'rewirater'),
+                endpoint=getattr(self.config, 'OTEL_EXPORTER_ENDPOINT', None)
+            )
+        
+        if self.loop_watchdog:
+            self.loop_watchdog.start()
+    
     async def _process_new_post(self, post_data: Dict):
         """Обработка нового поста из канала-источника"""
         try:
             logger.info(f"Обработка нового поста: {post_data['id']} из {post_data['channel_title']}")
-            logger.info(f"Текст поста: {post_data['text'][:100]}...")
+            logger.debug(f"Текст поста: {post_data['text'][:100]}...")
             
             # Проверяем лимиты публикации
             if not self._should_publish():
@@ -97,24 +204,10 @@ class TelegramUserBot:
                 return
             
             # Создаем объект исходного поста
-            source_post = SourcePost(
-                id=post_data['id'],
-                text=post_data['text'],
-                channel_id=post_data['channel_id'],
-                channel_title=post_data['channel_title'],
-                date=post_data['date'].isoformat(),
-                views=post_data['views'],
-                forwards=post_data['forwards'],
-                url=post_data.get('url'),
-                media_type=post_data.get('media_type'),
-                media_object=post_data.get('media_object'),
-                media_url=post_data.get('media_url')
-            )
+            source_post = self._build_source_post(post_data)
             
             # Отправляем в ЛС ссылку на оригинальный пост и ссылки из него
             try:
-                recipient = getattr(self.config, 'DM_RECIPIENT', None) or 'me'
-                
                 # Формируем ссылку на оригинальный пост
                 post_url = source_post.url
                 if not post_url:
@@ -130,87 +223,316 @@ class TelegramUserBot:
                 if links:
                     msg += f"\n\n🔗 Ссылки из поста ({len(links)}):\n" + "\n".join(links)
                 
-                await self.client.send_message(entity=recipient, message=msg)
-                logger.info(f"Отправлена ссылка на пост и {len(links) if links else 0} ссылок в ЛС")
+                await self._send_dm(msg)
             except Exception as e:
                 logger.warning(f"Не удалось отправить ссылку на пост и ссылки в ЛС: {e}")
 
+            # Медиа скачивается параллельно с переписыванием, пока ссылки на файлы свежие
+            prefetch = None
+            if self.media_cache and source_post.media_type and source_post.media_object is not None:
+                prefetch = asyncio.create_task(self._prefetch_media(source_post))
+            
             # Переписываем пост под стиль целевого канала
-            logger.info("Начинаем переписывание поста...")
-            rewritten_post = await self.content_rewriter.rewrite_post(source_post)
-            logger.info(f"Пост переписан: {rewritten_post.rewritten_text[:100]}...")
+            logger.debug("Начинаем переписывание поста...")
+            try:
+                with timed("rewrite", channel=source_post.channel_title, post_id=source_post.id) as span:
+                    rewritten_post = await self.content_rewriter.rewrite_post(source_post)
+                    set_span_attributes(
+                        span,
+                        provider=rewritten_post.provider,
+                        model=rewritten_post.model,
+                        prompt_tokens=rewritten_post.prompt_tokens,
+                        cached_tokens=rewritten_post.cached_tokens,
+                        completion_tokens=rewritten_post.completion_tokens,
+                        cost_usd=rewritten_post.cost_usd
+                    )
+            except BaseException:
+                if prefetch:
+                    prefetch.cancel()
+                raise
+            logger.debug(f"Пост переписан: {rewritten_post.rewritten_text[:100]}...")
+            self._update_token_stats(rewritten_post)
+            
+            # В индекс почти-дубликатов попадают только посты, поставленные в очередь
+            if self.channel_monitor and self.channel_monitor.remember_post(
+                    source_post.channel_id, source_post.id, source_post.text):
+                if prefetch:
+                    prefetch.cancel()
+                return
             
             # Добавляем пост в очередь для публикации с таймингом
-            logger.info("Добавляем пост в очередь...")
-            await self._add_post_to_queue(rewritten_post)
+            logger.debug("Добавляем пост в очередь...")
+            try:
+                await self._add_post_to_queue(rewritten_post)
+            except BaseException:
+                self._forget_post(rewritten_post)
+                if prefetch:
+                    prefetch.cancel()
+                raise
+            
+            if prefetch:
+                # Воркер не ждет скачивания: файлы прикрепятся к задаче в очереди, когда будут готовы
+                self._prefetch_tasks.add(prefetch)
+                prefetch.add_done_callback(lambda task: self._attach_media_files(rewritten_post, task))
             
         except Exception as e:
             logger.error(f"Ошибка обработки поста: {e}")
     
-    async def _publish_rewritten_post(self, rewritten_post):
-        """Публикация переписанного поста"""
+    async def _send_dm(self, msg: str, attempt: int = 0):
+        """Сообщение в ЛС; при FloodWait повторяется фоновой задачей после запрета, не задерживая воркер"""
+        recipient = getattr(self.config, 'DM_RECIPIENT', None) or 'me'
         try:
-            logger.info(f"Публикуем пост в {self.config.TARGET_CHANNEL}")
+            with timed("dm_notify"):
+                await self.flood_waits.call(
+                    "dm", str(recipient), lambda: self.client.send_message(entity=recipient, message=msg)
+                )
+            logger.debug("Отправлено уведомление в ЛС")
+        except FloodWaitDeferred as e:
+            if attempt + 1 >= self.dm_max_attempts:
+                logger.warning(f"Уведомление в ЛС не отправлено после {attempt + 1} попыток (FloodWait)")
+                return
+            task = asyncio.create_task(self._retry_dm(msg, e.retry_at, attempt + 1))
+            self._dm_retry_tasks.add(task)
+            task.add_done_callback(self._dm_retry_tasks.discard)
+    
+    async def _retry_dm(self, msg: str, retry_at: float, attempt: int):
+        await asyncio.sleep(max(0.0, retry_at - datetime.now().timestamp()))
+        try:
+            await self._send_dm(msg, attempt)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление в ЛС: {e}")
+    
+    async def _prefetch_media(self, source_post: SourcePost) -> Optional[List[str]]:
+        """Скачивает медиа поста в кэш; пути нужны публикации после перезапуска, когда объектов медиа нет"""
+        media_items = source_post.media_group or [source_post.media_object]
+        try:
+            with timed("media_prefetch", media_type=source_post.media_type):
+                paths = await asyncio.gather(*(self.media_cache.fetch(media) for media in media_items))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Не удалось заранее скачать медиа поста {source_post.id}: {e}")
+            return None
+        
+        if any(path is None for path in paths):
+            # Часть медиа не кэшируется - при публикации используются исходные объекты
+            return None
+        logger.debug(f"Медиа поста {source_post.id} скачано заранее: {len(paths)} файл(ов)")
+        return [str(path) for path in paths]
+    
+    def _attach_media_files(self, rewritten_post, prefetch: asyncio.Task):
+        """Прикрепляет скачанные файлы к посту в очереди и сохраняет задачу для публикации после перезапуска"""
+        self._prefetch_tasks.discard(prefetch)
+        if prefetch.cancelled() or not prefetch.result():
+            # Без файлов публикация возьмет исходные объекты медиа или скачает их заново
+            return
+        rewritten_post.media_files = prefetch.result()
+        if not self.scheduler.save_post(rewritten_post):
+            logger.debug(f"Пост {rewritten_post.original_post.id} опубликован раньше, чем скачалось медиа")
+    
+    def _queued_media_files(self) -> List[str]:
+        """Предзагруженные файлы постов в очереди - их нельзя вытеснять из кэша"""
+        return [path for job in self.scheduler.jobs() for path in job.post.media_files or []]
+    
+    @staticmethod
+    def _local_media_files(rewritten_post) -> Optional[List[str]]:
+        """Предзагруженные файлы поста, если все они на месте"""
+        if rewritten_post.media_files and all(Path(path).exists() for path in rewritten_post.media_files):
+            return rewritten_post.media_files
+        return None
+    
+    def _build_source_post(self, post_data: Dict) -> SourcePost:
+        """Исходный пост из данных монитора каналов"""
+        return SourcePost(
+            id=post_data['id'],
+            text=post_data['text'],
+            channel_id=post_data['channel_id'],
+            channel_title=post_data['channel_title'],
+            date=post_data['date'].isoformat(),
+            views=post_data['views'],
+            forwards=post_data['forwards'],
+            url=post_data.get('url'),
+            media_type=post_data.get('media_type'),
+            media_object=post_data.get('media_object'),
+            media_url=post_data.get('media_url'),
+            media_group=post_data.get('media_group'),
+            album_message_ids=post_data.get('album_message_ids')
+        )
+    
+    async def run_backfill(self, posts_per_channel: int = 0):
+        """Переписывает историю каналов пакетом и ставит посты в очередь публикации"""
+        try:
+            if self.backfill:
+                await self.backfill.resume(self._accept_backfill_post)
+            
+            if posts_per_channel <= 0:
+                return
+            
+            posts = await self.channel_monitor.get_backfill_posts(posts_per_channel)
+            if not posts:
+                logger.info("Нет необработанных постов для пакетного переписывания")
+                return
+            
+            source_posts = [self._build_source_post(post) for post in posts]
+            if self.backfill:
+                logger.info(f"Пакетное переписывание истории: {len(posts)} постов")
+                await self.backfill.run(source_posts, self._accept_backfill_post)
+                return
             
+            logger.info(f"Batch API недоступен, история переписывается обычными запросами: {len(posts)} постов")
+            for source_post in source_posts:
+                rewritten_post = await self.content_rewriter.rewrite_post(source_post)
+                await self._accept_backfill_post(rewritten_post)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакетного переписывания: {e}")
+    
+    async def _accept_backfill_post(self, rewritten_post) -> bool:
+        """Ставит пост из пакета в очередь, если позволяет дневной лимит"""
+        original_post = rewritten_post.original_post
+        self._update_token_stats(rewritten_post)
+        
+        if not self._should_publish():
+            # Результат остался в кэше переписывания, следующий запуск возьмет его без запроса к AI
+            logger.info(f"Пост {original_post.id} из пакета не помещается в дневной лимит")
+            return False
+        
+        duplicate = self.channel_monitor and self.channel_monitor.remember_post(
+            original_post.channel_id, original_post.id, original_post.text)
+        if not duplicate:
+            await self._add_post_to_queue(rewritten_post, after_queue=True)
+        if self.channel_monitor:
+            for post_id in original_post.album_message_ids or [original_post.id]:
+                self.channel_monitor.mark_post_processed(original_post.channel_id, post_id)
+        return not duplicate
+    
+    async def _publish_rewritten_post(self, rewritten_post, targets: Optional[List[str]] = None) -> List:
+        """Публикация переписанного поста во все (или перечисленные) целевые каналы"""
+        # После перезапуска медиа-объекта нет в памяти: отправляем предзагруженные файлы
+        # или получаем сообщение заново (если файлов нет)
+        if (rewritten_post.media_type and rewritten_post.media_object is None
+                and not self._local_media_files(rewritten_post)):
+            await self._restore_media(rewritten_post)
+        
+        results = await self.publisher.publish(rewritten_post, targets)
+        if any(result.status == PUBLISHED for result in results):
+            self.last_post_time = datetime.now()
+        return results
+    
+    async def _send_to_target(self, target, rewritten_post):
+        """Отправка поста в один целевой канал; ошибки разбирает FanoutPublisher"""
+        logger.info(f"Публикуем пост в {target.name}")
+        has_media = bool(rewritten_post.media_type
+                         and (rewritten_post.media_object or self._local_media_files(rewritten_post)))
+        with timed("publish", target=target.name, media_type=rewritten_post.media_type or "text"):
             # Если есть медиа, отправляем с медиа
-            if rewritten_post.media_type and rewritten_post.media_object:
+            if has_media:
                 logger.info(f"Отправляем пост с медиа: {rewritten_post.media_type}")
-                await self._send_media_post(rewritten_post)
+                await self._send_media_post(rewritten_post, target)
             else:
                 # Отправляем простой текст
                 logger.info("Отправляем текстовый пост")
                 await self.client.send_message(
-                    entity=self.config.TARGET_CHANNEL,
+                    entity=target.entity,
                     message=rewritten_post.rewritten_text,
                     parse_mode='html'
                 )
+        POSTS_PUBLISHED.labels("media" if has_media else "text").inc()
+        logger.info(f"Переписанный пост опубликован в {target.name}")
+    
+    async def _restore_media(self, rewritten_post):
+        """Получает медиа исходного сообщения для поста, восстановленного из очереди"""
+        original_post = rewritten_post.original_post
+        try:
+            if original_post.album_message_ids:
+                messages = await self.client.get_messages(original_post.channel_id, ids=original_post.album_message_ids)
+                media_group = [message.media for message in messages or [] if message and message.media]
+                if media_group:
+                    rewritten_post.media_group = original_post.media_group = media_group
+                    rewritten_post.media_object = original_post.media_object = media_group[0]
+                return
             
-            logger.info(f"Переписанный пост опубликован в {self.config.TARGET_CHANNEL}")
-            self.last_post_time = datetime.now()
-            self.posts_today += 1
-            
-        except FloodWaitError as e:
-            logger.warning(f"Превышен лимит запросов, ждем {e.seconds} секунд")
-            await asyncio.sleep(e.seconds)
-        except ChatWriteForbiddenError:
-            logger.error("Нет прав на запись в целевой канал")
+            message = await self.client.get_messages(original_post.channel_id, ids=original_post.id)
+            if message and message.media:
+                rewritten_post.media_object = message.media
+                original_post.media_object = message.media
         except Exception as e:
-            logger.error(f"Ошибка публикации переписанного поста: {e}")
-            raise
+            logger.warning(f"Не удалось получить медиа поста {original_post.id}: {e}")
     
-    async def _send_media_post(self, rewritten_post):
+    async def _send_media_post(self, rewritten_post, target):
         """Отправка поста с медиа"""
         try:
             media_type = rewritten_post.media_type
-            media_object = rewritten_post.media_object
+            # Альбом уходит одним send_file со списком медиа, подпись - у первого элемента
+            if rewritten_post.media_object is not None:
+                media_items = rewritten_post.media_group or [rewritten_post.media_object]
+            else:
+                # Пост восстановлен из очереди: Telethon загрузит предзагруженные файлы
+                media_items = list(rewritten_post.media_files)
             
-            # Отправляем медиа с подписью
-            await self.client.send_file(
-                entity=self.config.TARGET_CHANNEL,
-                file=media_object,
-                caption=rewritten_post.rewritten_text,
-                parse_mode='html'
-            )
+            if self.media_cache and rewritten_post.media_object is not None:
+                files = await self.media_cache.prepare_many(media_items)
+                try:
+                    sent = await self._send_media_files(rewritten_post, files, target)
+                except FloodWaitError:
+                    raise
+                except Exception as e:
+                    # Сохраненная загрузка могла устареть - загружаем файлы из кэша заново
+                    logger.warning(f"Не удалось отправить медиа из кэша, загружаем заново: {e}")
+                    for media in media_items:
+                        self.media_cache.invalidate(media)
+                    files = await self.media_cache.prepare_many(media_items)
+                    sent = await self._send_media_files(rewritten_post, files, target)
                 
-            logger.info(f"Пост с медиа ({media_type}) опубликован в {self.config.TARGET_CHANNEL}")
+                sent_messages = sent if isinstance(sent, list) else [sent]
+                for media, message in zip(media_items, sent_messages):
+                    self.media_cache.remember_sent(media, getattr(message, 'media', None))
+            else:
+                await self._send_media_files(rewritten_post, media_items, target)
             
+            if len(media_items) > 1:
+                logger.info(f"Альбом из {len(media_items)} медиа опубликован в {target.name}")
+            else:
+                logger.info(f"Пост с медиа ({media_type}) опубликован в {target.name}")
+            
+        except FloodWaitError:
+            # Текст в тот же канал тоже упрется в лимит - доставку откладывает FanoutPublisher
+            raise
         except Exception as e:
             logger.error(f"Ошибка отправки медиа поста: {e}")
+            PUBLISH_ERRORS.labels("media_fallback").inc()
             # Если не удалось отправить с медиа, отправляем только текст
             await self.client.send_message(
-                entity=self.config.TARGET_CHANNEL,
+                entity=target.entity,
                 message=rewritten_post.rewritten_text,
                 parse_mode='html'
             )
             logger.info("Отправлен только текст из-за ошибки с медиа")
     
-    async def _add_post_to_queue(self, rewritten_post):
+    async def _send_media_files(self, rewritten_post, files, target):
+        """Один send_file: одно медиа или альбом, с подписью поста"""
+        return await self.client.send_file(
+            entity=target.entity,
+            file=files if len(files) > 1 else files[0],
+            caption=rewritten_post.rewritten_text,
+            parse_mode='html'
+        )
+    
+    async def _add_post_to_queue(self, rewritten_post, after_queue: bool = False):
         """Добавляет пост в очередь для публикации с таймингом"""
         import random
-        from datetime import datetime, timedelta
         
         # Вычисляем время публикации
-        if self.last_post_time is None:
+        queued_jobs = self.scheduler.jobs() if after_queue else []
+        if queued_jobs:
+            # Пакет постов: каждый следующий - через интервал после последнего в очереди
+            interval_minutes = random.randint(
+                self.config.PUBLISH_INTERVAL_MIN,
+                self.config.PUBLISH_INTERVAL_MAX
+            )
+            publish_time = max(queued_jobs[-1].publish_datetime, datetime.now()) + timedelta(minutes=interval_minutes)
+        elif self.last_post_time is None:
             # Первый пост публикуем сразу
             publish_time = datetime.now() + timedelta(minutes=1)
         else:
@@ -222,136 +544,133 @@ class TelegramUserBot:
             publish_time = self.last_post_time + timedelta(minutes=interval_minutes)
         
         # Добавляем пост в очередь
-        self.post_queue.append({
-            'post': rewritten_post,
-            'publish_time': publish_time
-        })
-        
-        logger.info(f"Пост добавлен в очередь на {publish_time.strftime('%H:%M:%S')}")
-        logger.info(f"Всего постов в очереди: {len(self.post_queue)}")
-        
-        # Запускаем обработчик очереди, если он еще не запущен
-        if self.publish_task is None or self.publish_task.done():
-            logger.info("Запускаем обработчик очереди...")
-            self.publish_task = asyncio.create_task(self._process_post_queue())
+        job_id = self.scheduler.schedule(rewritten_post, publish_time)
+        
+        logger.info(f"Пост добавлен в очередь на {publish_time.strftime('%H:%M:%S')} (задача {job_id}, всего в очереди: {len(self.scheduler)})")
+        return job_id
+    
+    def cancel_scheduled_post(self, job_id: str) -> bool:
+        """Отменяет запланированную публикацию"""
+        job = self.scheduler.get(job_id)
+        if not self.scheduler.cancel(job_id):
+            return False
+        if not job.meta.get("counted"):
+            # Пост нигде не опубликован: его почти-дубликаты снова можно публиковать
+            self._forget_post(job.post)
+        return True
     
-    async def _process_post_queue(self):
-        """Обрабатывает очередь постов и публикует их по расписанию"""
-        logger.info("Обработчик очереди запущен")
+    def _forget_post(self, rewritten_post):
+        if self.channel_monitor:
+            original_post = rewritten_post.original_post
+            self.channel_monitor.forget_post(original_post.channel_id, original_post.id)
+    
+    def reschedule_post(self, job_id: str, publish_time: datetime) -> bool:
+        """Переносит запланированную публикацию"""
+        return self.scheduler.reschedule(job_id, publish_time)
+    
+    async def _publish_scheduled_job(self, job: ScheduledJob):
+        """Публикует пост, у которого наступило время публикации"""
+        logger.info(f"Пост готов к публикации: {job.publish_datetime.strftime('%H:%M:%S')}")
+        results = await self._publish_rewritten_post(job.post, job.meta.get("targets"))
         
-        while self.post_queue:
-            now = datetime.now()
-            logger.info(f"Проверяем очередь: {len(self.post_queue)} постов")
-            
-            # Находим посты, готовые к публикации
-            ready_posts = []
-            remaining_posts = []
-            
-            for item in self.post_queue:
-                if item['publish_time'] <= now:
-                    ready_posts.append(item)
-                    logger.info(f"Пост готов к публикации: {item['publish_time'].strftime('%H:%M:%S')}")
-                else:
-                    remaining_posts.append(item)
-            
-            # Публикуем готовые посты
-            for item in ready_posts:
-                try:
-                    await self._publish_rewritten_post(item['post'])
-                    self._update_stats(item['post'])
-                    self.last_post_time = datetime.now()
-                    self.posts_today += 1
-                    logger.info(f"Пост опубликован из очереди")
-                except Exception as e:
-                    logger.error(f"Ошибка публикации поста из очереди: {e}")
-            
-            # Обновляем очередь
-            self.post_queue = remaining_posts
-            
-            if self.post_queue:
-                # Ждем до следующего поста
-                next_post_time = min(item['publish_time'] for item in self.post_queue)
-                wait_seconds = (next_post_time - now).total_seconds()
-                if wait_seconds > 0:
-                    await asyncio.sleep(wait_seconds)
-            else:
-                break
+        # Пост учитывается в статистике один раз - при первой доставке в любой канал;
+        # отметка переходит в задачи отложенных доставок
+        if any(result.status == PUBLISHED for result in results):
+            if not job.meta.get("counted"):
+                job.meta["counted"] = True
+                self._update_stats(job.post)
+            logger.info("Пост опубликован из очереди")
         
-        logger.info("Обработка очереди постов завершена")
+        # Занятые каналы (FloodWait, темп) получают пост отдельной задачей, остальные уже получили
+        for result in results:
+            if result.status == DEFERRED:
+                self._requeue_deferred(job, result)
+    
+    def _requeue_deferred(self, job: ScheduledJob, result):
+        """Ставит отложенную доставку обратно в очередь на момент окончания FloodWait или темпа канала"""
+        # Попыткой считается только FloodWait: ожидание темпа канала - штатная работа
+        attempts = job.attempts + 1 if result.reason == REASON_FLOOD_WAIT else job.attempts
+        if attempts >= self.publish_max_attempts:
+            logger.error(f"Публикация в {result.target} отменена после {attempts} FloodWait подряд")
+            PUBLISH_ERRORS.labels("retries_exhausted").inc()
+            return
+        
+        retry_time = datetime.fromtimestamp(result.retry_at)
+        self.scheduler.schedule(job.post, retry_time, attempts=attempts, meta={**job.meta, "targets": [result.target]})
+        logger.info(f"Публикация в {result.target} отложена до {retry_time.strftime('%H:%M:%S')} ({result.reason})")
     
     def _should_publish(self) -> bool:
         """Проверяет, можно ли добавлять посты в очередь"""
-        now = datetime.now()
-        
-        # Проверяем лимит постов в день (включая очередь)
-        total_posts = self.posts_today + len(self.post_queue)
-        if total_posts >= self.config.MAX_POSTS_PER_DAY:
-            # Сбрасываем счетчик в полночь
-            if now.hour == 0 and now.minute < 5:
-                self.posts_today = 0
-                self.post_queue = []  # Очищаем очередь
-                logger.info("Сброс счетчика постов на новый день")
-            return False
-        
-        return True
+        # Дневной лимит каждого канала с учетом очереди: пост нужен, если хоть один канал его примет
+        queued: Dict[str, int] = {}
+        for job in self.scheduler.jobs():
+            for name in job.meta.get("targets") or [target.name for target in self.publisher.targets]:
+                queued[name] = queued.get(name, 0) + 1
+        return self.publisher.has_capacity(queued)
     
-    def _update_daily_stats(self):
-        """Обновление дневной статистики"""
-        now = datetime.now()
-        if now.hour == 0 and now.minute < 5:
-            self.posts_today = 0
-            logger.info("Статистика обновлена на новый день")
+    @property
+    def posts_today(self) -> int:
+        """Постов за сегодня (по самому загруженному каналу); счетчики каналов сбрасываются по дате"""
+        return self.publisher.posts_today()
     
     
     def _update_stats(self, rewritten_post):
-        """Обновление статистики"""
-        self.stats["total_posts"] = self.stats.get("total_posts", 0) + 1
-        self.stats["posts_today"] = self.posts_today
-        self.stats["last_post_time"] = datetime.now().isoformat()
-        self.stats["provider_stats"] = self.stats.get("provider_stats", {})
-        
-        provider = rewritten_post.provider
-        self.stats["provider_stats"][provider] = self.stats["provider_stats"].get(provider, 0) + 1
-        
-        # Статистика по источникам
-        self.stats["source_stats"] = self.stats.get("source_stats", {})
-        source_channel = rewritten_post.original_post.channel_title
-        self.stats["source_stats"][source_channel] = self.stats["source_stats"].get(source_channel, 0) + 1
-        
-        # Сохраняем статистику
-        self._save_stats()
+        """Обновление статистики (на диск попадет при следующей записи хранилища)"""
+        with self.stats_store.update() as stats:
+            stats["total_posts"] = stats.get("total_posts", 0) + 1
+            stats["posts_today"] = self.posts_today
+            stats["last_post_time"] = datetime.now().isoformat()
+            stats["provider_stats"] = stats.get("provider_stats", {})
+            
+            provider = rewritten_post.provider
+            stats["provider_stats"][provider] = stats["provider_stats"].get(provider, 0) + 1
+            
+            # Статистика по источникам
+            stats["source_stats"] = stats.get("source_stats", {})
+            source_channel = rewritten_post.original_post.channel_title
+            stats["source_stats"][source_channel] = stats["source_stats"].get(source_channel, 0) + 1
     
-    def _load_stats(self) -> Dict[str, Any]:
-        """Загрузка статистики из файла"""
-        try:
-            if self.stats_file.exists():
-                with open(self.stats_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки статистики: {e}")
+    def _update_token_stats(self, rewritten_post):
+        """Учет токенов и стоимости AI по каналам-источникам"""
+        if not rewritten_post.prompt_tokens and not rewritten_post.completion_tokens:
+            return
         
-        return {}
-    
-    def _save_stats(self):
-        """Сохранение статистики в файл"""
-        try:
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения статистики: {e}")
+        with self.stats_store.update() as stats:
+            channel_stats = stats.setdefault("token_stats", {}).setdefault(
+                rewritten_post.original_post.channel_title,
+                {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+            )
+            channel_stats["requests"] += 1
+            channel_stats["prompt_tokens"] += rewritten_post.prompt_tokens
+            channel_stats["cached_tokens"] += rewritten_post.cached_tokens
+            channel_stats["completion_tokens"] += rewritten_post.completion_tokens
+            channel_stats["cost_usd"] = round(channel_stats["cost_usd"] + (rewritten_post.cost_usd or 0.0), 6)
+            
+            stats["total_cost_usd"] = round(stats.get("total_cost_usd", 0.0) + (rewritten_post.cost_usd or 0.0), 6)
     
     def get_stats(self) -> Dict[str, Any]:
         """Получение текущей статистики"""
         stats = {
             "total_posts": self.stats.get("total_posts", 0),
             "posts_today": self.posts_today,
-            "posts_in_queue": len(self.post_queue),
-            "max_posts_per_day": self.config.MAX_POSTS_PER_DAY,
+            "posts_in_queue": len(self.scheduler),
+            "next_publish_time": self.scheduler.next_deadline().isoformat() if self.scheduler.next_deadline() else None,
+            "max_posts_per_day": getattr(self.config, 'MAX_POSTS_PER_DAY', None),
+            "targets": self.publisher.get_stats(),
+            "flood_waits": self.flood_waits.get_stats(),
             "last_post_time": self.last_post_time.isoformat() if self.last_post_time else None,
             "publish_interval": f"{self.config.PUBLISH_INTERVAL_MIN}-{self.config.PUBLISH_INTERVAL_MAX} мин",
             "provider_stats": self.stats.get("provider_stats", {}),
             "source_stats": self.stats.get("source_stats", {}),
-            "monitoring_stats": self.channel_monitor.get_stats() if self.channel_monitor else {}
+            "token_stats": self.stats.get("token_stats", {}),
+            "total_cost_usd": self.stats.get("total_cost_usd", 0.0),
+            "monitoring_stats": self.channel_monitor.get_stats() if self.channel_monitor else {},
+            "rewrite_pool": self.rewrite_pool.get_stats(),
+            "rewrite_cache": self.content_rewriter.get_cache_stats(),
+            "ai_requests": self.content_rewriter.get_request_stats(),
+            "backfill": self.backfill.get_stats() if self.backfill else {},
+            "media_cache": self.media_cache.get_stats() if self.media_cache else {},
+            "event_loop": self.loop_watchdog.get_stats() if self.loop_watchdog else {}
         }
         
         
@@ -359,6 +678,35 @@ class TelegramUserBot:
     
     async def stop(self):
         """Остановка бота"""
+        await self.rewrite_pool.stop()
+        
+        for task in list(self._dm_retry_tasks) + list(self._prefetch_tasks):
+            task.cancel()
+        await asyncio.gather(*self._dm_retry_tasks, *self._prefetch_tasks, return_exceptions=True)
+        
+        if self.backfill_task:
+            self.backfill_task.cancel()
+            await asyncio.gather(self.backfill_task, return_exceptions=True)
+        
+        if self.publish_task:
+            self.publish_task.cancel()
+            await asyncio.gather(self.publish_task, return_exceptions=True)
+        self.scheduler.close()
+        self.stats_store.close()
+        
+        if self.channel_monitor:
+            self.channel_monitor.close()
+        
+        if self.media_cache:
+            self.media_cache.close()
+        
+        if self.loop_watchdog:
+            self.loop_watchdog.stop()
+        
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        shutdown_tracing()
         
         if self.client:
             await self.client.disconnect()
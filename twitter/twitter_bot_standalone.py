@@ -6,6 +6,7 @@
 
 import asyncio
 import sys
+import time
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Any
@@ -80,7 +81,8 @@ class TwitterBot:
                 try:
                     logger.info(f"Проверяем Twitter аккаунты (интервал: {self.config.TWITTER_CHECK_INTERVAL_MINUTES} мин)")
                     
-                    # Проверяем все аккаунты
+                    # Проверяем все аккаунты (опросы распределяются по интервалу проверки)
+                    cycle_started = time.monotonic()
                     new_tweets = await self.twitter_monitor.check_all_accounts()
                     
                     if new_tweets:
@@ -89,16 +91,18 @@ class TwitterBot:
                     else:
                         logger.info("Новых твитов не найдено")
                     
-                    # Ждем до следующей проверки
-                    logger.info(f"Ждем {self.config.TWITTER_CHECK_INTERVAL_MINUTES} минут до следующей проверки")
-                    await asyncio.sleep(self.config.TWITTER_CHECK_INTERVAL_MINUTES * 60)
+                    # Ждем до следующей проверки: часть интервала уже ушла на опрос аккаунтов
+                    delay = max(0.0, self.config.TWITTER_CHECK_INTERVAL_MINUTES * 60 - (time.monotonic() - cycle_started))
+                    logger.info(f"Ждем {delay / 60:.1f} минут до следующей проверки")
+                    await asyncio.sleep(delay)
                     
                 except Exception as e:
                     logger.error(f"Ошибка в цикле Twitter мониторинга: {e}")
-                    # При rate limit ждем дольше, при других ошибках - меньше
-                    if "Rate limit exceeded" in str(e):
-                        logger.warning("Rate limit Twitter API, ждем 15 минут")
-                        await asyncio.sleep(900)  # 15 минут
+                    # При rate limit ждем до сброса лимита endpoint, при других ошибках - 5 минут
+                    rate_limit_delay = self.twitter_monitor.get_rate_limit_delay() if self.twitter_monitor else 0
+                    if "Rate limit exceeded" in str(e) or rate_limit_delay > 0:
+                        logger.warning(f"Rate limit Twitter API, ждем {rate_limit_delay:.0f} секунд")
+                        await asyncio.sleep(rate_limit_delay if rate_limit_delay > 0 else 900)
                     else:
                         logger.warning("Ошибка Twitter API, ждем 5 минут")
                         await asyncio.sleep(300)  # 5 минут
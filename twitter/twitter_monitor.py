@@ -4,15 +4,53 @@ Twitter Monitor Module
 """
 
 import asyncio
+import functools
+import json
 import logging
+import os
+import re
+import time
 from datetime import datetime, timedelta
+from pathlib import Path
 from typing import List, Dict, Optional, Any
+from urllib.parse import urlparse
 from dataclasses import dataclass
 import tweepy
 from config import Config
+from utils.rate_limiter import TokenBucket
 
 logger = logging.getLogger(__name__)
 
+# Окно лимитов Twitter API v2
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+# Максимум username в одном запросе users/by
+USERS_LOOKUP_BATCH_SIZE = 100
+
+ENDPOINT_USER_BY_USERNAME = "users/by/username"
+ENDPOINT_USERS_BY = "users/by"
+ENDPOINT_USER_TWEETS = "users/:id/tweets"
+
+# Документированные лимиты Twitter API v2 (app-auth) на окно 15 минут; TWITTER_RATE_LIMITS переопределяет
+DEFAULT_RATE_LIMITS = {
+    ENDPOINT_USER_TWEETS: 1500,
+    ENDPOINT_USER_BY_USERNAME: 300,
+    ENDPOINT_USERS_BY: 300,
+}
+# Для endpoint без документированного лимита
+FALLBACK_RATE_LIMIT = 15
+
+_NUMERIC_SEGMENT_RE = re.compile(r'^\d+$')
+
+
+def endpoint_from_url(url: str) -> str:
+    """Шаблон endpoint по URL запроса: /2/users/123/tweets -> users/:id/tweets"""
+    segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    if segments and segments[0] == '2':
+        segments = segments[1:]
+    if segments[:3] == ['users', 'by', 'username']:
+        return ENDPOINT_USER_BY_USERNAME
+    return '/'.join(':id' if _NUMERIC_SEGMENT_RE.match(segment) else segment for segment in segments)
+
 @dataclass
 class TwitterPost:
     """Структура данных для Twitter поста"""
@@ -31,6 +69,75 @@ class TwitterPost:
     hashtags: List[str]
     mentions: List[str]
 
+class RateLimitExhausted(Exception):
+    """Лимит endpoint исчерпан до сброса окна: запрос не отправлялся"""
+    
+    def __init__(self, endpoint: str, retry_after: float):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f"Лимит {endpoint} исчерпан, сброс через {retry_after:.0f}с")
+
+class TwitterStateStore:
+    """Сохраняемое состояние мониторинга: username -> user_id и последний since_id по аккаунтам"""
+    
+    def __init__(self, state_file: Path = Path("data/twitter_state.json")):
+        self.state_file = Path(state_file)
+        self.state_file.parent.mkdir(exist_ok=True)
+        self.users: Dict[str, Dict[str, str]] = {}
+        self.since_ids: Dict[str, str] = {}
+        self._dirty = False
+        self._load()
+    
+    def get_user(self, username: str) -> Optional[Dict[str, str]]:
+        """Данные пользователя из кэша (id, name, username)"""
+        return self.users.get(username.lower())
+    
+    def set_user(self, username: str, user_id, name: str, screen_name: str):
+        """Сохраняет соответствие username -> user_id"""
+        self.users[username.lower()] = {"id": str(user_id), "name": name, "username": screen_name}
+        self._dirty = True
+    
+    def forget_user(self, username: str):
+        """Удаляет пользователя из кэша (например, если аккаунт переименован)"""
+        if self.users.pop(username.lower(), None) is not None:
+            self._dirty = True
+    
+    def get_since_id(self, username: str) -> Optional[str]:
+        """ID самого нового обработанного твита аккаунта"""
+        return self.since_ids.get(username.lower())
+    
+    def update_since_id(self, username: str, tweet_id):
+        """Сдвигает since_id вперед, если твит новее"""
+        key = username.lower()
+        current = self.since_ids.get(key)
+        if current is None or int(tweet_id) > int(current):
+            self.since_ids[key] = str(tweet_id)
+            self._dirty = True
+    
+    def save(self):
+        """Сохраняет состояние на диск (атомарно, только при изменениях)"""
+        if not self._dirty:
+            return
+        
+        try:
+            tmp_file = self.state_file.with_suffix(".json.tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"users": self.users, "since_ids": self.since_ids}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.state_file)
+            self._dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния Twitter монитора: {e}")
+    
+    def _load(self):
+        try:
+            if self.state_file.exists():
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.users = data.get("users", {})
+                self.since_ids = data.get("since_ids", {})
+        except Exception as e:
+            logger.error(f"Ошибка загрузки состояния Twitter монитора: {e}")
+
 class TwitterMonitor:
     """Класс для мониторинга Twitter аккаунтов"""
     
@@ -41,6 +148,85 @@ class TwitterMonitor:
         self.last_check_times: Dict[str, datetime] = {}
         self.is_running = False
         
+        # user_id и since_id сохраняются между запусками
+        self.state = TwitterStateStore()
+        
+        # Ограничение параллельных запросов к Twitter API (создается в рабочем event loop)
+        self.max_concurrent_requests = getattr(self.config, 'TWITTER_MAX_CONCURRENT_REQUESTS', 10)
+        self._request_semaphore: Optional[asyncio.Semaphore] = None
+        
+        # Token bucket на каждый endpoint, подстраивается по заголовкам x-rate-limit-*
+        self.rate_limiters: Dict[str, TokenBucket] = {}
+        # С какого аккаунта начинать цикл: пропущенные из-за лимита опрашиваются первыми
+        self._poll_offset = 0
+        # monotonic-время конца текущего цикла опроса: дольше запросы токен не ждут
+        self._cycle_deadline: Optional[float] = None
+    
+    def _get_rate_limiter(self, endpoint: str) -> TokenBucket:
+        """Token bucket для endpoint (до первых заголовков - документированный лимит на окно)"""
+        limiter = self.rate_limiters.get(endpoint)
+        if limiter is None:
+            limits = {**DEFAULT_RATE_LIMITS, **(getattr(self.config, 'TWITTER_RATE_LIMITS', None) or {})}
+            limit = limits.get(endpoint, FALLBACK_RATE_LIMIT)
+            # Без запаса: запросы идут равномерно по окну, темп подстраивается по заголовкам
+            limiter = TokenBucket(
+                capacity=1,
+                refill_rate=limit / RATE_LIMIT_WINDOW_SECONDS,
+                name=endpoint
+            )
+            self.rate_limiters[endpoint] = limiter
+        return limiter
+    
+    def _on_api_response(self, response, *args, **kwargs):
+        """Хук requests: обновляет лимиты endpoint по заголовкам ответа (вызывается в потоке)"""
+        try:
+            limiter = self._get_rate_limiter(endpoint_from_url(response.url))
+            headers = response.headers
+            
+            if 'x-rate-limit-remaining' in headers and 'x-rate-limit-reset' in headers:
+                limiter.update_from_headers(
+                    limit=int(headers.get('x-rate-limit-limit', 0)) or None,
+                    remaining=int(headers['x-rate-limit-remaining']),
+                    reset_epoch=float(headers['x-rate-limit-reset']),
+                    window_seconds=RATE_LIMIT_WINDOW_SECONDS
+                )
+            elif response.status_code == 429:
+                self._on_rate_limited(endpoint_from_url(response.url), response)
+        except Exception as e:
+            logger.debug(f"Не удалось разобрать заголовки лимитов Twitter: {e}")
+    
+    def _on_rate_limited(self, endpoint: str, response=None):
+        """429: endpoint закрыт до сброса окна из x-rate-limit-reset (без заголовка - на полное окно)"""
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            reset_epoch = float(headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            reset_epoch = time.time() + RATE_LIMIT_WINDOW_SECONDS
+        self._get_rate_limiter(endpoint).block_until(reset_epoch)
+    
+    async def _call_api(self, endpoint: str, method, *args, reserved: bool = False, **kwargs):
+        """Вызов синхронного метода tweepy в отдельном потоке с учетом лимитов endpoint
+        
+        reserved - токен уже получен вызывающим (опрос аккаунтов в check_all_accounts)
+        """
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        
+        if not reserved:
+            # Ждем токен, но не дольше текущего цикла опроса: иначе запрос переходит в следующий
+            limiter = self._get_rate_limiter(endpoint)
+            wait = limiter.time_until_available()
+            if self._cycle_deadline is not None and time.monotonic() + wait > self._cycle_deadline:
+                raise RateLimitExhausted(endpoint, wait)
+            await limiter.acquire()
+        
+        async with self._request_semaphore:
+            return await asyncio.to_thread(functools.partial(method, *args, **kwargs))
+    
+    def get_rate_limit_delay(self) -> float:
+        """Сколько секунд осталось до следующего доступного запроса твитов"""
+        return self._get_rate_limiter(ENDPOINT_USER_TWEETS).time_until_available()
+        
     async def setup_twitter_client(self) -> bool:
         """Настройка Twitter API клиента"""
         try:
@@ -51,7 +237,8 @@ class TwitterMonitor:
             # Создаем клиент с Bearer Token и дополнительными ключами
             client_kwargs = {
                 'bearer_token': self.config.TWITTER_BEARER_TOKEN,
-                'wait_on_rate_limit': True
+                # Лимиты соблюдаем сами по endpoint, а не сном внутри tweepy
+                'wait_on_rate_limit': False
             }
             
             # Добавляем дополнительные ключи, если они есть
@@ -64,12 +251,13 @@ class TwitterMonitor:
                 client_kwargs['access_token_secret'] = self.config.TWITTER_ACCESS_TOKEN_SECRET
             
             self.client = tweepy.Client(**client_kwargs)
+            self.client.session.hooks['response'].append(self._on_api_response)
             
             # Проверяем подключение простым запросом
             try:
                 logger.info("Проверяем подключение к Twitter API...")
                 # Пробуем получить информацию о пользователе для проверки токена
-                test_user = self.client.get_user(username="twitter")
+                test_user = await self._call_api(ENDPOINT_USER_BY_USERNAME, self.client.get_user, username="twitter")
                 if test_user.data:
                     logger.info(f"Twitter API подключен успешно. Тестовый пользователь: @{test_user.data.username}")
                     return True
@@ -86,20 +274,61 @@ class TwitterMonitor:
             logger.error(f"Ошибка настройки Twitter API: {e}")
             return False
     
-    async def get_user_tweets(self, username: str, since_id: Optional[str] = None) -> List[TwitterPost]:
-        """Получение твитов пользователя"""
+    async def _resolve_user(self, username: str) -> Optional[Dict[str, str]]:
+        """ID пользователя по username: из кэша, при промахе через API"""
+        user = self.state.get_user(username)
+        if user:
+            return user
+        
+        response = await self._call_api(ENDPOINT_USER_BY_USERNAME, self.client.get_user, username=username)
+        if not response.data:
+            return None
+        
+        self.state.set_user(username, response.data.id, response.data.name, response.data.username)
+        return self.state.get_user(username)
+    
+    async def _resolve_users(self, usernames: List[str]):
+        """Пакетное получение user_id для аккаунтов, которых нет в кэше (до 100 за запрос)"""
+        missing = [username for username in usernames if not self.state.get_user(username)]
+        
+        for start in range(0, len(missing), USERS_LOOKUP_BATCH_SIZE):
+            batch = missing[start:start + USERS_LOOKUP_BATCH_SIZE]
+            try:
+                response = await self._call_api(ENDPOINT_USERS_BY, self.client.get_users, usernames=batch)
+            except RateLimitExhausted as e:
+                # Оставшиеся аккаунты разрешатся по одному или в следующем цикле
+                logger.warning(f"Пакетное получение пользователей Twitter отложено: {e}")
+                return
+            except Exception as e:
+                logger.error(f"Ошибка пакетного получения пользователей Twitter: {e}")
+                continue
+            
+            by_username = {user.username.lower(): user for user in (response.data or [])}
+            for username in batch:
+                user = by_username.get(username.lower())
+                if user:
+                    self.state.set_user(username, user.id, user.name, user.username)
+                else:
+                    logger.warning(f"Пользователь @{username} не найден")
+    
+    async def get_user_tweets(self, username: str, since_id: Optional[str] = None,
+                              start_time: Optional[datetime] = None, reserved: bool = False) -> List[TwitterPost]:
+        """Получение твитов пользователя (только новее since_id, если он задан)
+        
+        RateLimitExhausted - лимит исчерпан или получен 429, аккаунт нужно опросить позже
+        """
         if not self.client:
             logger.error("Twitter клиент не инициализирован")
             return []
             
         try:
-            # Получаем ID пользователя по username
-            user = self.client.get_user(username=username)
-            if not user.data:
+            # Получаем ID пользователя по username (обычно из кэша, без запроса к API)
+            user = await self._resolve_user(username)
+            if not user:
                 logger.warning(f"Пользователь @{username} не найден")
                 return []
                 
-            user_id = user.data.id
+            user_id = user["id"]
             
             # Получаем твиты пользователя
             exclude_list = []
@@ -108,9 +337,13 @@ class TwitterMonitor:
             if not self.config.TWITTER_INCLUDE_REPLIES:
                 exclude_list.append('replies')
             
-            tweets = self.client.get_users_tweets(
+            tweets = await self._call_api(
+                ENDPOINT_USER_TWEETS,
+                self.client.get_users_tweets,
+                reserved=reserved,
                 id=user_id,
                 since_id=since_id,
+                start_time=start_time if not since_id else None,
                 max_results=min(self.config.TWITTER_MAX_TWEETS_PER_CHECK, 100),
                 tweet_fields=[
                     'created_at', 'public_metrics', 'context_annotations',
@@ -159,10 +392,10 @@ class TwitterMonitor:
                 twitter_post = TwitterPost(
                     id=tweet.id,
                     text=tweet.text,
-                    author=user.data.name,
-                    author_username=user.data.username,
+                    author=user["name"],
+                    author_username=user["username"],
                     created_at=tweet.created_at,
-                    url=f"https://twitter.com/{user.data.username}/status/{tweet.id}",
+                    url=f"https://twitter.com/{user['username']}/status/{tweet.id}",
                     retweet_count=metrics.get('retweet_count', 0),
                     like_count=metrics.get('like_count', 0),
                     reply_count=metrics.get('reply_count', 0),
@@ -177,56 +410,98 @@ class TwitterMonitor:
             
             return twitter_posts
             
+        except RateLimitExhausted:
+            raise
+        except tweepy.TooManyRequests as e:
+            # В отличие от "новых твитов нет": endpoint закрывается до сброса окна, аккаунт - в начало следующего цикла
+            self._on_rate_limited(ENDPOINT_USER_TWEETS, getattr(e, 'response', None))
+            raise RateLimitExhausted(ENDPOINT_USER_TWEETS, self.get_rate_limit_delay())
         except Exception as e:
             logger.error(f"Ошибка получения твитов для @{username}: {e}")
             return []
     
     async def check_all_accounts(self) -> List[TwitterPost]:
-        """Проверка всех аккаунтов на новые твиты"""
+        """Проверка всех аккаунтов на новые твиты, равномерно в пределах интервала проверки"""
         if not self.config.TWITTER_MONITORING_ENABLED or not self.client:
             return []
-            
-        all_new_tweets = []
         
-        for username in self.config.TWITTER_ACCOUNTS:
-            try:
-                # Получаем время последней проверки
-                last_check = self.last_check_times.get(username)
-                since_id = None
-                
-                # Если это первая проверка, берем твиты за последний час
-                if not last_check:
-                    last_check = datetime.utcnow() - timedelta(hours=1)
-                
-                # Получаем новые твиты
-                new_tweets = await self.get_user_tweets(username, since_id)
-                
-                # Фильтруем по времени
-                filtered_tweets = []
-                for tweet in new_tweets:
-                    if tweet.created_at.replace(tzinfo=None) > last_check:
-                        filtered_tweets.append(tweet)
-                
-                if filtered_tweets:
-                    logger.info(f"Найдено {len(filtered_tweets)} новых твитов от @{username}")
-                    all_new_tweets.extend(filtered_tweets)
-                
-                # Обновляем время последней проверки
-                self.last_check_times[username] = datetime.utcnow()
-                
-                # Небольшая задержка между запросами
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Ошибка проверки аккаунта @{username}: {e}")
-                # При rate limit или других ошибках, пропускаем остальные аккаунты
-                if "Rate limit exceeded" in str(e):
-                    logger.warning("Превышен лимит Twitter API, пропускаем остальные аккаунты")
-                    break
+        self._cycle_deadline = time.monotonic() + self.config.TWITTER_CHECK_INTERVAL_MINUTES * 60
+        try:
+            # Недостающие user_id получаем пакетно, а не запросом на каждый аккаунт
+            await self._resolve_users(self.config.TWITTER_ACCOUNTS)
+            return await self._poll_accounts()
+        finally:
+            self._cycle_deadline = None
+            # Один раз за цикл сохраняем user_id и since_id
+            self.state.save()
+    
+    async def _poll_accounts(self) -> List[TwitterPost]:
+        accounts = list(self.config.TWITTER_ACCOUNTS)
+        if not accounts:
+            return []
+        offset = self._poll_offset % len(accounts)
+        accounts = accounts[offset:] + accounts[:offset]
+        
+        # Аккаунт запускается, как только для него есть токен: запросы идут с темпом лимита,
+        # а не пачкой; число одновременных запросов ограничено семафором
+        limiter = self._get_rate_limiter(ENDPOINT_USER_TWEETS)
+        tasks = []
+        for username in accounts:
+            if time.monotonic() + limiter.time_until_available() > self._cycle_deadline:
+                # До конца цикла токена не будет: остальные аккаунты - в начале следующего
+                break
+            await limiter.acquire()
+            tasks.append(asyncio.create_task(self._check_account(username, reserved=True)))
+        results = await asyncio.gather(*tasks)
+        
+        all_new_tweets = []
+        first_skipped = len(tasks)
+        for position, new_tweets in enumerate(results):
+            if new_tweets is None:
+                first_skipped = min(first_skipped, position)
                 continue
+            all_new_tweets.extend(new_tweets)
+        
+        skipped = len(accounts) - len(tasks) + sum(new_tweets is None for new_tweets in results)
+        if skipped:
+            self._poll_offset += first_skipped
+            logger.warning(
+                f"Лимит Twitter API исчерпан: {skipped} аккаунтов отложено до следующего цикла, "
+                f"следующий запрос через {self.get_rate_limit_delay():.0f}с"
+            )
         
         return all_new_tweets
     
+    async def _check_account(self, username: str, reserved: bool = False) -> Optional[List[TwitterPost]]:
+        """Проверка одного аккаунта на новые твиты (None - пропущен из-за лимита)"""
+        try:
+            # Инкрементальный запрос: API вернет только твиты новее since_id
+            since_id = self.state.get_since_id(username)
+            
+            # Если аккаунт проверяется впервые, берем твиты за последний час
+            start_time = None
+            if not since_id:
+                start_time = datetime.utcnow() - timedelta(hours=1)
+            
+            new_tweets = await self.get_user_tweets(username, since_id, start_time=start_time, reserved=reserved)
+            
+            for tweet in new_tweets:
+                self.state.update_since_id(username, tweet.id)
+            
+            if new_tweets:
+                logger.info(f"Найдено {len(new_tweets)} новых твитов от @{username}")
+            
+            # Обновляем время последней проверки
+            self.last_check_times[username] = datetime.utcnow()
+            return new_tweets
+            
+        except RateLimitExhausted:
+            # since_id не сдвигается: твиты аккаунта будут получены в следующем цикле
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка проверки аккаунта @{username}: {e}")
+            return []
+    
     async def initialize(self):
         """Инициализация Twitter клиента"""
         if not await self.setup_twitter_client():
@@ -248,5 +523,8 @@ class TwitterMonitor:
                 username: last_check.isoformat() if last_check else None
                 for username, last_check in self.last_check_times.items()
             },
-            "check_interval_minutes": self.config.TWITTER_CHECK_INTERVAL_MINUTES
+            "check_interval_minutes": self.config.TWITTER_CHECK_INTERVAL_MINUTES,
+            "cached_user_ids": len(self.state.users),
+            "rate_limits": {endpoint: limiter.get_stats() for endpoint, limiter in self.rate_limiters.items()},
+            "since_ids": dict(self.state.since_ids)
         }
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сторож event loop: задержка цикла, зависания со стеком блокирующего кода, медленные колбэки asyncio
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Deque, Dict, Optional
+
+from loguru import logger
+
+from utils.metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram(
+    "rewirater_event_loop_lag_seconds", "Задержка срабатывания таймера event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_LAG_CURRENT = REGISTRY.gauge(
+    "rewirater_event_loop_lag_current_seconds", "Последний замер задержки event loop"
+)
+LOOP_STALLS = REGISTRY.counter(
+    "rewirater_event_loop_stalls_total", "Зависания event loop дольше порога (со снятым стеком)"
+)
+SLOW_CALLBACKS = REGISTRY.counter(
+    "rewirater_slow_callbacks_total", "Шаги корутин и колбэки дольше порога (asyncio debug)"
+)
+
+_SLOW_CALLBACK_RE = re.compile(r'^Executing (?P<handle>.*) took (?P<seconds>[\d.]+) seconds$', re.DOTALL)
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Перехватывает сообщения asyncio "Executing <Handle ...> took N seconds" в режиме отладки"""
+
+    def __init__(self, watchdog: "LoopWatchdog"):
+        super().__init__(logging.WARNING)
+        self.watchdog = watchdog
+
+    def emit(self, record: logging.LogRecord):
+        match = _SLOW_CALLBACK_RE.match(record.getMessage())
+        if match:
+            self.watchdog.record_slow_callback(match.group("handle"), float(match.group("seconds")))
+
+
+class LoopWatchdog:
+    """Пульс в event loop и поток-наблюдатель: если пульса нет дольше порога, снимает стек потока цикла"""
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.1, asyncio_debug: bool = False,
+                 dump_path: Optional[Path] = Path("data/loop_watchdog.json"), ring_size: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.asyncio_debug = asyncio_debug
+        self.dump_path = Path(dump_path) if dump_path else None
+
+        # Кольцевой буфер последних инцидентов, пишется в файл из потока-наблюдателя
+        self.incidents: Deque[Dict[str, Any]] = deque(maxlen=ring_size)
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._log_handler: Optional[_SlowCallbackHandler] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+        self._expected = 0.0
+        self._last_tick = 0.0
+        self._last_lag = 0.0
+        self._stall: Optional[Dict[str, Any]] = None
+
+        self.stats = {"ticks": 0, "max_lag": 0.0, "stalls": 0, "slow_callbacks": 0}
+
+    def start(self):
+        """Запуск; вызывается из работающего event loop"""
+        if self._thread is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+
+        if self.asyncio_debug:
+            # Отладочный режим asyncio замедляет цикл - включается только по настройке
+            self._loop.set_debug(True)
+            self._loop.slow_callback_duration = self.threshold
+            self._log_handler = _SlowCallbackHandler(self)
+            logging.getLogger("asyncio").addHandler(self._log_handler)
+
+        self._last_tick = time.monotonic()
+        self._expected = self._last_tick + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Сторож event loop запущен (порог {self.threshold}с, asyncio debug: {self.asyncio_debug})")
+
+    def stop(self):
+        """Остановка и сохранение буфера инцидентов"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._log_handler is not None:
+            logging.getLogger("asyncio").removeHandler(self._log_handler)
+            self._log_handler = None
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join(5)
+            self._thread = None
+        self._dump()
+
+    def _tick(self):
+        """Пульс в event loop: насколько позже запланированного он сработал"""
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_CURRENT.set(lag)
+        self.stats["ticks"] += 1
+        self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+
+        self._last_lag = lag
+        self._last_tick = now
+        self._expected = now + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        """Поток-наблюдатель: снимает стек зависшего цикла и пишет буфер в файл"""
+        check_interval = max(0.01, min(self.interval, self.threshold) / 2)
+        while not self._stopped.wait(check_interval):
+            stalled_for = time.monotonic() - self._last_tick - self.interval
+            if stalled_for >= self.threshold:
+                if self._stall is None:
+                    self._capture_stall(stalled_for)
+            elif self._stall is not None:
+                # Цикл ожил: пульс измерил полную длительность зависания
+                self._stall["duration"] = round(max(self._last_lag, self._stall["duration"]), 3)
+                self._add_incident(self._stall)
+                self._stall = None
+
+            if self._dirty:
+                self._dump()
+
+    def _capture_stall(self, stalled_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        self._stall = {
+            "kind": "stall",
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "duration": round(stalled_for, 3),
+            "stack": "".join(stack[-30:])
+        }
+        self.stats["stalls"] += 1
+        LOOP_STALLS.inc()
+
+        location = stack[-1].strip().splitlines()[0] if stack else "стек недоступен"
+        logger.warning(f"Event loop не отвечает {stalled_for:.2f}с, выполняется: {location}")
+
+    def record_slow_callback(self, handle: str, seconds: float):
+        """Медленный шаг корутины или колбэк по данным asyncio debug"""
+        self.stats["slow_callbacks"] += 1
+        SLOW_CALLBACKS.inc()
+        self._add_incident({
+            "kind": "slow_callback",
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "duration": round(seconds, 3),
+            "handle": handle[:2000]
+        })
+
+    def _add_incident(self, incident: Dict[str, Any]):
+        with self._lock:
+            self.incidents.append(incident)
+            self._dirty = True
+
+    def _dump(self):
+        """Атомарная запись буфера: временный файл и переименование"""
+        if self.dump_path is None:
+            return
+        with self._lock:
+            incidents = list(self.incidents)
+            self._dirty = False
+        try:
+            self.dump_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.dump_path.with_name(self.dump_path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "updated_at": datetime.now().isoformat(timespec="seconds"),
+                    "threshold": self.threshold,
+                    "stats": self.get_stats(),
+                    "incidents": incidents
+                }, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.dump_path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения инцидентов event loop в {self.dump_path}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "max_lag": round(self.stats["max_lag"], 4),
+            "last_lag": round(self._last_lag, 4),
+            "recent_incidents": len(self.incidents)
+        }
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Метрики в формате Prometheus (счетчики, gauge, гистограммы), HTTP /metrics и опциональные спаны OpenTelemetry
+"""
+
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Границы гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Ожидания FloodWait - от секунд до часов
+FLOODWAIT_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric(ABC):
+    """Общая часть метрик: имя, описание, значения по наборам меток"""
+
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values, **kwargs):
+        """Дочерняя метрика для набора меток (labels("a") или labels(key="a"))"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        """Метрика без меток"""
+        return self.labels()
+
+    def _label_text(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+    @abstractmethod
+    def _new_child(self):
+        """Значение метрики для нового набора меток"""
+
+    @abstractmethod
+    def _render_child(self, key: Tuple[str, ...], child) -> List[str]:
+        """Строки экспозиции одного набора меток"""
+
+
+class _Value:
+    __slots__ = ("value", "function", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при каждом чтении (например, длина очереди)"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return math.nan
+        return self.value
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def _render_child(self, key, child: _Value) -> List[str]:
+        return [f"{self.name}{self._label_text(key)} {_format_value(child.get())}"]
+
+
+class Gauge(Counter):
+    """Текущее значение, может уменьшаться"""
+
+    type_name = "gauge"
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, key, child: _HistogramValue) -> List[str]:
+        with child._lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._label_text(key, ('le', _format_value(bound)))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса; повторная регистрация с тем же именем возвращает существующую метрику"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, description, labelnames)
+
+    def gauge(self, name: str, description: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, description, labelnames)
+
+    def histogram(self, name: str, description: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, description, labelnames, buckets=buckets)
+
+    def _register(self, cls, name: str, description: str, labelnames: Sequence[str], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, description, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Метрика {name} уже зарегистрирована с другим типом или метками")
+            return metric
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition 0.0.4"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Время этапов обработки поста: где пост проводит время под нагрузкой
+STAGE_SECONDS = REGISTRY.histogram(
+    "rewirater_stage_seconds",
+    "Длительность этапов обработки поста",
+    ["stage"]
+)
+
+_tracer = None
+
+
+@contextmanager
+def timed(stage: str, **attributes) -> Iterator[Any]:
+    """Замер этапа: гистограмма rewirater_stage_seconds и (если включен) спан OpenTelemetry"""
+    started = time.perf_counter()
+    if _tracer is None:
+        try:
+            yield None
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+        return
+
+    with _tracer.start_as_current_span(stage, attributes=attributes) as span:
+        try:
+            yield span
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def set_span_attributes(span, **attributes):
+    """Атрибуты спана, известные только после выполнения этапа (токены, провайдер)"""
+    if span is None:
+        return
+    for key, value in attributes.items():
+        if value is not None:
+            span.set_attribute(key, value)
+
+
+def setup_tracing(service_name: str = "rewirater", endpoint: Optional[str] = None) -> bool:
+    """Экспорт спанов OpenTelemetry: OTLP/HTTP на endpoint или в консоль"""
+    global _tracer
+    if trace is None:
+        logger.warning("opentelemetry не установлен, спаны не экспортируются (pip install opentelemetry-sdk)")
+        return False
+
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if endpoint:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter(endpoint=endpoint)
+        else:
+            exporter = ConsoleSpanExporter()
+
+        provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        _tracer = trace.get_tracer("rewirater")
+        logger.info(f"Экспорт спанов OpenTelemetry включен ({endpoint or 'консоль'})")
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось настроить OpenTelemetry: {e}")
+        return False
+
+
+def shutdown_tracing():
+    """Отправляет накопленные спаны"""
+    global _tracer
+    if _tracer is None:
+        return
+    _tracer = None
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, "shutdown"):
+        provider.shutdown()
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics в отдельном потоке: отвечает, даже если event loop занят"""
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = "127.0.0.1", port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logger.warning(f"Не удалось запустить эндпоинт метрик на {self.host}:{self.port}: {e}")
+            return False
+
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token bucket для ограничения частоты запросов к внешним API
+"""
+
+import asyncio
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Token bucket с возможностью подстройки по заголовкам лимитов API"""
+
+    def __init__(self, capacity: float, refill_rate: float, name: str = ""):
+        self.name = name
+        self.capacity = float(capacity)
+        self.default_rate = float(refill_rate)
+        self.refill_rate = float(refill_rate)
+        self.tokens = float(capacity)
+
+        self._updated = time.monotonic()
+        # Момент сброса окна лимита (по данным API), до него действует темп из заголовков
+        self._reset_at: Optional[float] = None
+        # Обновления приходят и из потоков (ответы HTTP-клиента), поэтому нужна блокировка
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Забирает токены, если они есть; не ждет"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def refund(self, tokens: float = 1):
+        """Возвращает токены, взятые под запрос, который не был выполнен"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def time_until_available(self, tokens: float = 1) -> float:
+        """Сколько секунд ждать, пока появятся токены"""
+        with self._lock:
+            self._refill()
+            return self._wait_time(tokens)
+
+    async def acquire(self, tokens: float = 1):
+        """Ждет и забирает токены"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = self._wait_time(tokens)
+            await asyncio.sleep(wait)
+
+    def block_until(self, reset_epoch: float):
+        """Запрещает запросы до момента сброса лимита (unix time)"""
+        with self._lock:
+            self._refill()
+            self.tokens = 0.0
+            self.refill_rate = 0.0
+            self._reset_at = time.monotonic() + max(0.0, reset_epoch - time.time())
+
+    def update_from_headers(self, limit: Optional[int], remaining: Optional[int], reset_epoch: Optional[float],
+                            window_seconds: Optional[float] = None):
+        """Подстройка по заголовкам x-rate-limit-*: оставшиеся запросы равномерно до сброса окна"""
+        if remaining is None or reset_epoch is None:
+            return
+
+        if limit and window_seconds:
+            # Темп, который будет действовать после сброса окна
+            with self._lock:
+                self.default_rate = limit / window_seconds
+
+        if remaining <= 0:
+            self.block_until(reset_epoch)
+            return
+
+        with self._lock:
+            self._refill()
+            seconds_to_reset = max(1.0, reset_epoch - time.time())
+            self.tokens = min(self.tokens, float(remaining))
+            self.refill_rate = remaining / seconds_to_reset
+            self._reset_at = time.monotonic() + seconds_to_reset
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._reset_at is not None and now >= self._reset_at:
+            # Новое окно лимита: возвращаемся к обычному темпу
+            self.tokens = self.capacity
+            self.refill_rate = self.default_rate
+            self._reset_at = None
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    def _wait_time(self, tokens: float) -> float:
+        missing = tokens - self.tokens
+        if missing <= 0:
+            return 0.0
+        if self.refill_rate > 0:
+            wait = missing / self.refill_rate
+            if self._reset_at is not None:
+                wait = min(wait, max(0.0, self._reset_at - time.monotonic()))
+            return max(wait, 0.01)
+        if self._reset_at is not None:
+            return max(0.01, self._reset_at - time.monotonic())
+        return 1.0
+
+    def get_stats(self) -> dict:
+        """Состояние bucket"""
+        with self._lock:
+            self._refill()
+            return {
+                "tokens": round(self.tokens, 2),
+                "capacity": self.capacity,
+                "refill_rate": round(self.refill_rate, 4),
+                "reset_in": round(self._reset_at - time.monotonic(), 1) if self._reset_at else None
+            }